@@ -0,0 +1,388 @@
+# Blocked gzip (BGZF), as used by samtools and htslib.
+#
+# A BGZF file is a series of independent gzip members ("blocks"), each holding
+# at most MAX_BLOCK_DATA bytes of data and recording its own compressed size in
+# its header.  Ordinary gzip readers (gunzip, gzip.open, zcat) see one stream,
+# so outputs stay compatible with everything downstream.  But since each block
+# can be inflated on its own we can decompress them on several cores at once,
+# and start reading at any block.
+#
+# For each file we write a block index, <fname>.gzi, in htslib's format: a
+# little-endian uint64 count followed by (compressed offset, uncompressed
+# offset) uint64 pairs for every block after the first.  With it a reader can
+# find the block holding any position without scanning the file.
+#
+# zlib releases the GIL, so a thread pool is enough to use several cores.
+
+import io
+import os
+import gzip
+import zlib
+import struct
+import collections
+import concurrent.futures
+
+MAX_BLOCK_DATA = 0xFF00  # same as htslib, so compressed blocks fit in 64KiB
+MAX_BLOCK_SIZE = 0x10000
+DEFAULT_LEVEL = 6
+INDEX_SUFFIX = ".gzi"
+
+# Threads to inflate or deflate with when the caller doesn't say.  A process
+# that shares the machine (ex: a run.py sample worker) should lower this to
+# its share with set_default_threads, so each stream's pool fits in it.
+default_threads = os.cpu_count()
+
+# ID1 ID2 CM FLG MTIME XFL OS XLEN SI1 SI2 SLEN BSIZE, where BSIZE is the
+# total block size minus one.
+HEADER = struct.Struct("<BBBBIBBHBBHH")
+FOOTER = struct.Struct("<II")  # CRC32 ISIZE
+
+# The empty block htslib writes at the end of every file.
+EOF_BLOCK = bytes.fromhex(
+    "1f8b08040000000000ff0600424302001b0003000000000000000000"
+)
+
+
+def set_default_threads(threads):
+    global default_threads
+    default_threads = max(1, threads)
+
+
+def compress_block(data, level=DEFAULT_LEVEL):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    deflated = compressor.compress(data) + compressor.flush()
+    block_size = HEADER.size + len(deflated) + FOOTER.size
+    return (
+        HEADER.pack(31, 139, 8, 4, 0, 0, 255, 6, 66, 67, 2, block_size - 1)
+        + deflated
+        + FOOTER.pack(zlib.crc32(data), len(data))
+    )
+
+
+def block_size(header):
+    # Total size of the block starting with header, or None if header isn't
+    # the start of a BGZF block.
+    if len(header) < HEADER.size:
+        return None
+    fields = HEADER.unpack(header[: HEADER.size])
+    # gzip magic, deflate, FEXTRA; then a single 6-byte "BC" extra field
+    if fields[:4] != (31, 139, 8, 4) or fields[7:11] != (6, 66, 67, 2):
+        return None
+    return fields[11] + 1
+
+
+def decompress_block(block):
+    data = zlib.decompress(block[HEADER.size : -FOOTER.size], -15)
+    crc, size = FOOTER.unpack(block[-FOOTER.size :])
+    if len(data) != size or zlib.crc32(data) != crc:
+        raise Exception("Corrupt BGZF block")
+    return data
+
+
+def write_index(fname, offsets):
+    # offsets: [(compressed offset, uncompressed offset)] of every block,
+    # starting with (0, 0), which the file format leaves implicit.
+    with io.open(fname, "wb") as outf:
+        outf.write(struct.pack("<Q", len(offsets) - 1))
+        for offset_pair in offsets[1:]:
+            outf.write(struct.pack("<QQ", *offset_pair))
+
+
+def parse_index(data):
+    (count,) = struct.unpack_from("<Q", data)
+    offsets = [(0, 0)]
+    for i in range(count):
+        offsets.append(struct.unpack_from("<QQ", data, 8 + 16 * i))
+    return offsets
+
+
+class BgzfWriter(io.BufferedIOBase):
+    # A binary file object that writes BGZF, compressing batches of blocks in
+    # parallel, and on close() writes the block index.
+    BATCH_BLOCKS = 64
+
+    def __init__(self, fname, index=True, threads=None, level=DEFAULT_LEVEL):
+        self.outf = io.open(fname, "wb")
+        self.index_fname = fname + INDEX_SUFFIX if index else None
+        self.level = level
+        self.pending = bytearray()
+        self.offsets = []  # (compressed, uncompressed) offset of each block
+        self.compressed_offset = 0
+        self.uncompressed_offset = 0
+        self.pool = concurrent.futures.ThreadPoolExecutor(
+            threads or default_threads
+        )
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.pending += data
+        if len(self.pending) >= MAX_BLOCK_DATA * self.BATCH_BLOCKS:
+            self.write_blocks(final=False)
+        return len(data)
+
+    def write_blocks(self, final):
+        chunks = [
+            bytes(self.pending[i : i + MAX_BLOCK_DATA])
+            for i in range(0, len(self.pending), MAX_BLOCK_DATA)
+        ]
+        if chunks and len(chunks[-1]) < MAX_BLOCK_DATA and not final:
+            self.pending = bytearray(chunks.pop())
+        else:
+            self.pending = bytearray()
+
+        blocks = self.pool.map(
+            compress_block, chunks, [self.level] * len(chunks)
+        )
+        for chunk, block in zip(chunks, blocks):
+            self.offsets.append(
+                (self.compressed_offset, self.uncompressed_offset)
+            )
+            self.outf.write(block)
+            self.compressed_offset += len(block)
+            self.uncompressed_offset += len(chunk)
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            self.write_blocks(final=True)
+            self.outf.write(EOF_BLOCK)
+            self.outf.close()
+            if self.index_fname:
+                write_index(self.index_fname, self.offsets or [(0, 0)])
+        finally:
+            self.pool.shutdown()
+            super().close()
+
+
+def read_exactly(inf, n):
+    # Like inf.read(n), but raw streams may return less than asked for even
+    # before the end.
+    data = inf.read(n)
+    while data and len(data) < n:
+        more = inf.read(n - len(data))
+        if not more:
+            break
+        data += more
+    return data
+
+
+def read_block(inf):
+    # Reads the next whole block from a binary stream, or returns None at the
+    # end.
+    header = read_exactly(inf, HEADER.size)
+    if not header:
+        return None
+    size = block_size(header)
+    if size is None:
+        raise Exception("Not a BGZF block")
+    rest = read_exactly(inf, size - HEADER.size)
+    if len(rest) != size - HEADER.size:
+        raise Exception("Truncated BGZF block")
+    return header + rest
+
+
+def split_blocks(data):
+    # Splits bytes holding consecutive whole blocks into those blocks.
+    blocks = []
+    offset = 0
+    while offset + HEADER.size <= len(data):
+        size = block_size(data[offset : offset + HEADER.size])
+        if size is None or offset + size > len(data):
+            break
+        blocks.append(data[offset : offset + size])
+        offset += size
+    return blocks
+
+
+def parallel_map(fn, items, threads=None):
+    # Like map(fn, items), in order, but keeping up to a few items per thread
+    # in flight.
+    threads = threads or default_threads
+    with concurrent.futures.ThreadPoolExecutor(threads) as pool:
+        in_flight = collections.deque()
+        for item in items:
+            in_flight.append(pool.submit(fn, item))
+            if len(in_flight) >= threads * 4:
+                yield in_flight.popleft().result()
+        while in_flight:
+            yield in_flight.popleft().result()
+
+
+class ChunkStream(io.RawIOBase):
+    # A readable binary file object over an iterator of bytes.
+    def __init__(self, chunks, on_close=None):
+        self.chunks = iter(chunks)
+        self.current = memoryview(b"")
+        self.on_close = on_close
+
+    def readable(self):
+        return True
+
+    def close(self):
+        if not self.closed:
+            if hasattr(self.chunks, "close"):
+                self.chunks.close()
+            if self.on_close:
+                self.on_close()
+        super().close()
+
+    def readinto(self, buf):
+        while not self.current:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                return 0
+            self.current = memoryview(chunk)
+        n = min(len(buf), len(self.current))
+        buf[:n] = self.current[:n]
+        self.current = self.current[n:]
+        return n
+
+
+class PeekedStream(io.RawIOBase):
+    # A binary stream with some already read bytes put back in front.
+    def __init__(self, peeked, inf):
+        self.peeked = peeked
+        self.inf = inf
+
+    def readable(self):
+        return True
+
+    def readinto(self, buf):
+        if self.peeked:
+            n = min(len(buf), len(self.peeked))
+            buf[:n] = self.peeked[:n]
+            self.peeked = self.peeked[n:]
+            return n
+        data = self.inf.read(len(buf))
+        buf[: len(data)] = data
+        return len(data)
+
+
+def text_or_binary(raw, mode):
+    buffered = io.BufferedReader(raw)
+    if "b" in mode:
+        return buffered
+    return io.TextIOWrapper(buffered, encoding="utf-8")
+
+
+def decompress_blocks(inf, mode, threads, on_close=None):
+    def blocks():
+        while True:
+            block = read_block(inf)
+            if block is None:
+                return
+            yield block
+
+    return text_or_binary(
+        ChunkStream(
+            parallel_map(decompress_block, blocks(), threads),
+            on_close=on_close,
+        ),
+        mode,
+    )
+
+
+def open_stream(inf, mode="rt", threads=None):
+    # Like gzip.open(inf, mode) for reading a gzipped binary stream, which
+    # doesn't need to be seekable (ex: from storage.open).  If it's BGZF we
+    # inflate blocks in parallel; otherwise we fall back to gzip.  Closing
+    # the result doesn't close inf.
+    header = read_exactly(inf, HEADER.size)
+    stream = PeekedStream(header, inf)
+    if block_size(header) is None:
+        return gzip.open(io.BufferedReader(stream), mode)
+    return decompress_blocks(stream, mode, threads)
+
+
+def open(fname, mode="rt", threads=None, index=True):
+    # Like gzip.open, for local files.  Writing produces BGZF, and unless
+    # index=False also fname.gzi.  Reading accepts any gzip file.
+    if "w" in mode:
+        writer = BgzfWriter(fname, index=index, threads=threads)
+        if "b" in mode:
+            return writer
+        return io.TextIOWrapper(writer, encoding="utf-8")
+
+    with io.open(fname, "rb") as inf:
+        is_bgzf = block_size(inf.read(HEADER.size)) is not None
+    if not is_bgzf:
+        return gzip.open(fname, mode)
+    inf = io.open(fname, "rb")
+    return decompress_blocks(inf, mode, threads, on_close=inf.close)
+
+
+def compress_file(in_fname, out_fname, threads=None):
+    # Compresses an uncompressed local file, writing out_fname.gzi too.
+    with io.open(in_fname, "rb") as inf, BgzfWriter(
+        out_fname, threads=threads
+    ) as outf:
+        while data := inf.read(MAX_BLOCK_DATA * BgzfWriter.BATCH_BLOCKS):
+            outf.write(data)
+
+
+def recompress_file(fname, threads=None):
+    # Rewrites any local gzip file as BGZF in place, writing fname.gzi too.
+    tmp_fname = fname + ".bgzf"
+    with open(fname, "rb", threads=threads) as inf, BgzfWriter(
+        tmp_fname, threads=threads, index=False
+    ) as outf:
+        while data := inf.read(MAX_BLOCK_DATA * BgzfWriter.BATCH_BLOCKS):
+            outf.write(data)
+    os.replace(tmp_fname, fname)
+    write_index(fname + INDEX_SUFFIX, outf.offsets or [(0, 0)])
+
+
+class BgzfFile:
+    # Random access to a BGZF file.
+    #
+    # read_range(start, end) returns compressed bytes [start, end), or fewer
+    # at the end of the file, so this works the same on local files and on
+    # ranged reads from storage.  offsets are as in write_index.
+    def __init__(self, read_range, offsets, threads=None):
+        self.read_range = read_range
+        self.offsets = offsets
+        self.uncompressed_offsets = [u for _, u in offsets]
+        self.threads = threads
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def read_blocks(self, start_block, end_block):
+        # Compressed blocks [start_block, end_block), in one read.
+        start = self.offsets[start_block][0]
+        if end_block < len(self.offsets):
+            end = self.offsets[end_block][0]
+        else:
+            end = self.offsets[-1][0] + MAX_BLOCK_SIZE
+        blocks = split_blocks(self.read_range(start, end))
+        return blocks[: end_block - start_block]
+
+
+def open_local(fname, threads=None):
+    # BgzfFile for a local file, using fname.gzi if present and otherwise
+    # scanning block headers.
+    index_fname = fname + INDEX_SUFFIX
+    if os.path.exists(index_fname):
+        with io.open(index_fname, "rb") as inf:
+            offsets = parse_index(inf.read())
+    else:
+        offsets = []
+        uncompressed_offset = 0
+        with io.open(fname, "rb") as inf:
+            while True:
+                compressed_offset = inf.tell()
+                block = read_block(inf)
+                if block is None:
+                    break
+                offsets.append((compressed_offset, uncompressed_offset))
+                uncompressed_offset += FOOTER.unpack(block[-FOOTER.size :])[1]
+
+    def read_range(start, end):
+        with io.open(fname, "rb") as inf:
+            inf.seek(start)
+            return inf.read(end - start)
+
+    return BgzfFile(read_range, offsets or [(0, 0)], threads=threads)
@@ -7,6 +7,8 @@ import glob
 import gzip
 from Bio.SeqIO.FastaIO import SimpleFastaParser
 
+import resources
+
 THISDIR = os.path.abspath(os.path.dirname(__file__))
 
 
@@ -161,17 +163,20 @@ def build_db(bowtie_db_prefix, genomes_fname):
         return
     print("Building BowtieDB...")
 
-    subprocess.check_call(
-        [
-            "/home/ec2-user/bowtie2-2.5.2-linux-x86_64/bowtie2-build",
-            "-f",
-            "--threads",
-            "32",
-            "--verbose",
-            genomes_fname,
-            bowtie_db_prefix,
-        ]
-    )
+    with resources.thread_grant(
+        "bowtie2-build", os.path.getsize(genomes_fname), os.cpu_count()
+    ) as threads:
+        subprocess.check_call(
+            [
+                "/home/ec2-user/bowtie2-2.5.2-linux-x86_64/bowtie2-build",
+                "-f",
+                "--threads",
+                str(threads),
+                "--verbose",
+                genomes_fname,
+                bowtie_db_prefix,
+            ]
+        )
 
 
 def bowtie_db():
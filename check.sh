@@ -24,4 +24,26 @@ if ! black --check --diff --quiet .; then
     exit 1
 fi
 
+echo Checking hvreads is the same in every mode...
+if ! python3 check_hvreads.py > /dev/null; then
+    echo "FAIL: hvreads modes differ"
+    exit 1
+fi
+
+echo Checking read ID sets and Bloom filters...
+if ! python3 check_readids.py > /dev/null; then
+    echo "FAIL: read ID sets or Bloom filters"
+    exit 1
+fi
 
+echo Checking read counts...
+if ! python3 check_readcounts.py > /dev/null; then
+    echo "FAIL: read counts"
+    exit 1
+fi
+
+echo Checking taxonomy numbering...
+if ! python3 check_taxonomy.py > /dev/null 2>&1; then
+    echo "FAIL: taxonomy numbering"
+    exit 1
+fi
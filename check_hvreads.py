@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+
+# Checks that hvreads writes the same JSON, down to the order of each entry's
+# reads, whether it builds it in memory or on disk (--hvreads-memory-mb) and
+# whether or not interpret captured the reads (--capture-hvreads).
+#
+# We make a small delivery in a temporary directory, read through
+# LocalStorage.  Its discarded file has a second read for many read IDs that
+# are also in the collapsed and singleton files, and isn't covered by any
+# capture, so entries mix captured and scanned reads.
+
+import argparse
+import gzip
+import io
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+
+import run
+import storage
+
+DELIVERY = "CHECK"
+SAMPLE = "CHK1"
+NUM_READS = 20000
+
+
+def random_read(rng, length):
+    return (
+        "".join(rng.choice("ACGT") for _ in range(length)),
+        "".join(rng.choice("ABCDEFGHIJ") for _ in range(length)),
+    )
+
+
+def write_fastq(fname, records):
+    with gzip.open(fname, "wt") as outf:
+        for title, (sequence, quality) in records:
+            outf.write("@%s\n%s\n+\n%s\n" % (title, sequence, quality))
+
+
+def make_delivery(root, rng, hv_taxid):
+    # Returns the allmatches lines and the kraken files interpret would have
+    # captured.
+    cleaned = os.path.join(root, DELIVERY, "cleaned")
+    hvmatches = os.path.join(root, DELIVERY, run.full_s3_dirname("hvmatches"))
+    os.makedirs(cleaned)
+    os.makedirs(hvmatches)
+
+    roles = {"collapsed": [], "singleton": []}
+    for i in range(NUM_READS):
+        roles[rng.choice(sorted(roles))].append("%s.%s" % (SAMPLE, i))
+
+    all_matches = []
+    kraken_fnames = []
+    discarded = []
+    workdir = tempfile.mkdtemp()
+    try:
+        for role, read_ids in roles.items():
+            fastq_fname = os.path.join(workdir, "%s.%s.gz" % (SAMPLE, role))
+            write_fastq(
+                fastq_fname,
+                [
+                    ("%s extra" % read_id, random_read(rng, 40))
+                    for read_id in read_ids
+                ],
+            )
+            kraken_fname = os.path.join(workdir, "%s.kraken2.tsv" % role)
+            with open(kraken_fname, "w") as outf:
+                for read_id in read_ids:
+                    taxid = hv_taxid if rng.random() < 0.5 else 2
+                    # Long enough that on disk hvreads takes several runs.
+                    hits = " ".join(["0:1"] * 20 + ["%s:6" % taxid])
+                    line = "C\t%s\tName (taxid %s)\t40\t%s\n" % (
+                        read_id,
+                        taxid,
+                        hits,
+                    )
+                    outf.write(line)
+                    if taxid == hv_taxid:
+                        all_matches.append(line)
+                    if rng.random() < 0.3:
+                        discarded.append((read_id, random_read(rng, 20)))
+
+            kraken_input = "%s.%s.kraken2.tsv.gz" % (SAMPLE, role)
+            capture = run.hv_capture_fname(kraken_input)
+            os.chdir(workdir)
+            assert run.capture_hv_matches(
+                [os.path.basename(fastq_fname)], kraken_fname, capture
+            )
+            shutil.move(capture, os.path.join(hvmatches, capture))
+            shutil.move(fastq_fname, cleaned)
+            kraken_fnames.append(kraken_input)
+    finally:
+        os.chdir(run.THISDIR)
+        shutil.rmtree(workdir)
+
+    rng.shuffle(discarded)
+    write_fastq(os.path.join(cleaned, "%s.discarded.gz" % SAMPLE), discarded)
+    return all_matches, kraken_fnames
+
+
+def hvreads_json(all_matches, capture_inputs, memory_mb, workdir):
+    args = argparse.Namespace(
+        delivery=DELIVERY,
+        bloom_false_positive_rate=0.01,
+        fastq_workers=1,
+        hvreads_memory_mb=memory_mb,
+    )
+    cleaned_inputs = sorted(
+        run.get_files(args, run.final_fastq_dirname(args), min_size=100)
+    )
+    outf = io.StringIO()
+    if memory_mb:
+        run.write_hvreads_external(
+            args, all_matches, cleaned_inputs, capture_inputs, workdir, outf
+        )
+    else:
+        run.write_hvreads(
+            args, all_matches, cleaned_inputs, capture_inputs, outf
+        )
+    return outf.getvalue()
+
+
+def check():
+    rng = random.Random(0)
+    os.makedirs(os.path.expanduser("~/tmp"), exist_ok=True)  # for tempdir
+    root = tempfile.mkdtemp()
+    try:
+        run.S3_BUCKET = root
+        run.STORAGE = storage.open_storage(root)
+        run.LISTING_TTL = 0
+        with open(os.path.join(run.THISDIR, "human-viruses.tsv")) as inf:
+            hv_taxid = int(inf.readline().split("\t")[0])
+        all_matches, kraken_fnames = make_delivery(root, rng, hv_taxid)
+
+        outputs = {}
+        for captures in [False, True]:
+            for memory_mb in [0, 1]:
+                run.LISTINGS.clear()
+                mode = "%s, %s" % (
+                    "on disk" if memory_mb else "in memory",
+                    "captured" if captures else "not captured",
+                )
+                outputs[mode] = hvreads_json(
+                    all_matches,
+                    kraken_fnames if captures else [],
+                    memory_mb,
+                    root,
+                )
+
+        expected = outputs["in memory, not captured"]
+        entries = json.loads(expected)
+        assert len(entries) == len(all_matches)
+        assert any(len(entry) > 3 for entry in entries.values())
+        assert expected == json.dumps(entries, sort_keys=True)
+        ok = True
+        for mode, output in outputs.items():
+            if output != expected:
+                print("hvreads differs %s" % mode)
+                ok = False
+        return ok
+    finally:
+        shutil.rmtree(root)
+
+
+if __name__ == "__main__":
+    if not check():
+        sys.exit(1)
+    print("hvreads matches in every mode")
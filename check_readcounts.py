@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+
+# Checks readcounts.py: parse_settings against a sample AdapterRemoval
+# .settings file, and count_reads and count_lengths against counting FASTQ
+# records one at a time, including records split across chunks and a file
+# without a final newline.
+
+import io
+import random
+import collections
+
+import readcounts
+
+SETTINGS = """\
+AdapterRemoval ver. 2.3.1
+Trimming of paired-end reads
+
+
+[Adapter sequences]
+Adapter1[0]: AGATCGGAAGAGCACACGTCTGAACTCCAGTCACNNNNNNATCTCGTATGCCGTCTTCTGCTTG
+Adapter2[0]: AGATCGGAAGAGCGTCGTGTAGGGAAAGAGTGTAGATCTCGGTGGTCGCCGTATCATT
+
+
+[Adapter trimming]
+RNG seed: NA
+Alignment shift value: 2
+Global mismatch threshold: 0.333333
+Quality format (input): Phred+33
+Quality score max (input): 41
+Quality format (output): Phred+33
+Quality score max (output): 45
+Mate-number separator (input): '/'
+Trimming 5p: 0
+Trimming 3p: 0
+Trimming Ns: No
+Trimming Phred scores <= 2: No
+Trimming using sliding windows: No
+Minimum genomic length: 15
+Maximum genomic length: 4294967295
+Collapse overlapping reads: Yes
+Minimum overlap (in case of collapse): 11
+
+
+[Trimming statistics]
+Total number of read pairs: 20
+Number of unaligned read pairs: 9
+Number of well aligned read pairs: 11
+Number of discarded mate 1 reads: 2
+Number of singleton mate 1 reads: 1
+Number of discarded mate 2 reads: 3
+Number of singleton mate 2 reads: 0
+Number of reads with adapters[1]: 11
+Number of full-length collapsed pairs: 4
+Number of truncated collapsed pairs: 1
+Number of retained reads: 30
+Number of retained nucleotides: 3702
+Average length of retained reads: 123.4
+
+
+[Length distribution]
+Length\tMate1\tMate2\tSingleton\tCollapsed\tCollapsedTruncated\tDiscarded\tAll
+0\t0\t0\t0\t0\t0\t3\t3
+14\t0\t0\t0\t0\t0\t2\t2
+100\t4\t5\t0\t0\t0\t0\t9
+150\t4\t4\t1\t0\t0\t0\t9
+180\t0\t0\t0\t3\t1\t0\t4
+201\t0\t0\t0\t1\t0\t0\t1
+"""
+
+EXPECTED_SETTINGS = {
+    "S1.pair1.truncated.gz": {100: 4, 150: 4},
+    "S1.pair2.truncated.gz": {100: 5, 150: 4},
+    "S1.singleton.truncated.gz": {150: 1},
+    "S1.collapsed.gz": {180: 3, 201: 1},
+    "S1.collapsed.truncated.gz": {180: 1},
+    "S1.discarded.gz": {0: 3, 14: 2},
+}
+
+
+def check_settings():
+    lengths = readcounts.parse_settings("S1", io.StringIO(SETTINGS))
+    assert lengths == EXPECTED_SETTINGS, lengths
+
+    # Without the length distribution there's nothing to report.
+    without = SETTINGS[: SETTINGS.index("[Length distribution]")]
+    assert readcounts.parse_settings("S1", io.StringIO(without)) == {}
+
+
+def fastq(rng, count, final_newline):
+    # -> (FASTQ bytes, length -> reads)
+    records = []
+    lengths = collections.Counter()
+    for i in range(count):
+        length = rng.choice([0, 1, 35, 150, 151, rng.randrange(1, 1000)])
+        if i == count - 1 and not final_newline:
+            # Otherwise an empty quality line would be indistinguishable
+            # from no line at all.
+            length = max(length, 1)
+        lengths[length] += 1
+        sequence = "".join(rng.choice("ACGTN") for _ in range(length))
+        records.append("@r%s extra\n%s\n+\n%s\n" % (i, sequence, "F" * length))
+    data = "".join(records)
+    if not final_newline:
+        data = data[:-1]
+    return data.encode("ascii"), lengths
+
+
+def check_fastq():
+    rng = random.Random(0)
+    for count in [0, 1, 500]:
+        for final_newline in [True, False]:
+            data, expected = fastq(rng, count, final_newline)
+            for chunk_size in [1, 7, 4096, 1 << 20]:
+                readcounts.COUNT_CHUNK_SIZE = chunk_size
+                assert readcounts.count_reads(io.BytesIO(data)) == count
+                lengths = readcounts.count_lengths(io.BytesIO(data))
+                assert lengths == expected, (count, final_newline, chunk_size)
+
+
+def check():
+    check_settings()
+    check_fastq()
+
+
+if __name__ == "__main__":
+    check()
+    print("read counts match")
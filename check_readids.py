@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+
+# Checks readids.ReadIdSet against a plain Python set of the same IDs, with
+# repeated IDs in the input and, by swapping in a deliberately weak hash, with
+# many different IDs sharing each hash.  Also checks that a BloomFilter never
+# answers "definitely not present" for an ID it holds, and that its false
+# positive rate is about what we asked for.
+
+import random
+
+import numpy as np
+
+import readids
+
+
+def random_ids(rng, count):
+    # IDs like SRR14530724.123, of varying lengths, some of them repeated.
+    ids = [
+        "SRR%s.%s" % (rng.randrange(10), rng.randrange(count))
+        for _ in range(count)
+    ]
+    ids.extend(rng.choice(ids) for _ in range(count // 2))
+    rng.shuffle(ids)
+    return ids
+
+
+strong_hash_bounds = readids.hash_bounds
+
+
+def weak_hash_bounds(array, starts, ends):
+    # Only a few distinct values, so most hashes are shared by several IDs.
+    return strong_hash_bounds(array, starts, ends) % np.uint64(7)
+
+
+def check_set(read_ids, absent_ids, false_positive_rate=None):
+    id_set = readids.ReadIdSet(
+        read_ids,
+        false_positive_rate=false_positive_rate,
+        keep_input_positions=True,
+    )
+    expected = set(read_ids)
+    assert len(id_set) == len(expected)
+    assert set(id_set) == expected
+
+    # Every copy of an ID maps to the same position, holding that ID.
+    for read_id, position in zip(read_ids, id_set.input_positions.tolist()):
+        assert id_set.id_at(position).decode("utf-8") == read_id
+    positions = id_set.positions(read_ids)
+    assert (positions == id_set.input_positions).all()
+
+    assert not id_set.contains(absent_ids).any()
+    assert (id_set.positions(absent_ids) == -1).all()
+
+    assert [
+        id_set.id_at(position).decode("utf-8")
+        for position in id_set.sorted_positions().tolist()
+    ] == sorted(expected)
+
+
+def check_bloom_filter(read_ids, absent_ids, false_positive_rate):
+    bloom_filter = readids.BloomFilter(
+        *readids.encode_ids(read_ids), false_positive_rate
+    )
+    # A miss means the ID is absent.
+    assert bloom_filter.might_contain(*readids.encode_ids(read_ids)).all()
+    observed_rate = bloom_filter.might_contain(
+        *readids.encode_ids(absent_ids)
+    ).mean()
+    assert observed_rate < 2 * false_positive_rate, observed_rate
+
+
+def check():
+    rng = random.Random(0)
+    read_ids = random_ids(rng, 5000)
+    absent_ids = ["ERR%s" % i for i in range(1000)] + ["", "S", "SRR1."]
+
+    for false_positive_rate in [None, 0.01]:
+        check_set(read_ids, absent_ids, false_positive_rate)
+        check_set([], absent_ids, false_positive_rate)
+        check_set(["only"] * 3, absent_ids, false_positive_rate)
+
+    for false_positive_rate in [0.01, 0.1]:
+        check_bloom_filter(
+            read_ids,
+            ["ERR%s.%s" % (i % 10, i) for i in range(100000)],
+            false_positive_rate,
+        )
+
+    readids.hash_bounds = weak_hash_bounds
+    try:
+        check_set(read_ids, absent_ids)
+        check_set(read_ids, absent_ids, 0.01)
+    finally:
+        readids.hash_bounds = strong_hash_bounds
+
+
+if __name__ == "__main__":
+    check()
+    print("read ID sets match Python sets")
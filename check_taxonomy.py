@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+
+# Checks the compiled taxonomy's depth-first numbering: for a small nodes.dmp,
+# is_under and is_under_mask (entry/exit comparisons) have to agree with
+# walking up from each taxid through its parents, and bottom_up has to put
+# every taxid before its ancestors.
+#
+# The tree has gaps in its taxids, as the NCBI one does, and randomly
+# attached taxids so that siblings aren't numbered in order.
+
+import os
+import random
+import shutil
+import tempfile
+
+import numpy as np
+
+import taxonomy
+
+# taxid -> parent
+NODES = {
+    1: 1,
+    2: 1,
+    10: 2,
+    11: 2,
+    12: 10,
+    13: 10,
+    40: 1,
+    41: 40,
+    42: 41,
+    43: 41,
+}
+NUM_RANDOM_NODES = 200
+
+
+def write_dmps(dashboard_dir, nodes):
+    with open(os.path.join(dashboard_dir, "nodes.dmp"), "w") as outf:
+        for taxid, parent in nodes.items():
+            rank = "no rank" if taxid == parent else "species"
+            outf.write("%s\t|\t%s\t|\t%s\t|\n" % (taxid, parent, rank))
+    with open(os.path.join(dashboard_dir, "names.dmp"), "w") as outf:
+        for taxid in nodes:
+            outf.write(
+                "%s\t|\ttaxon %s\t|\t\t|\tscientific name\t|\n"
+                % (taxid, taxid)
+            )
+
+
+def walk_up(nodes, taxid):
+    # Every ancestor of taxid, including taxid, without the compiled arrays.
+    ancestors = {taxid}
+    while nodes[taxid] != taxid:
+        taxid = nodes[taxid]
+        ancestors.add(taxid)
+    return ancestors
+
+
+def check():
+    rng = random.Random(0)
+    nodes = dict(NODES)
+    for _ in range(NUM_RANDOM_NODES):
+        taxid = max(nodes) + rng.randrange(1, 4)
+        nodes[taxid] = rng.choice(sorted(nodes))
+    taxids = list(nodes)
+    rng.shuffle(taxids)
+    nodes = {taxid: nodes[taxid] for taxid in taxids}
+
+    dashboard_dir = tempfile.mkdtemp()
+    try:
+        write_dmps(dashboard_dir, nodes)
+        tax = taxonomy.load(dashboard_dir)
+
+        ancestors = {taxid: walk_up(nodes, taxid) for taxid in nodes}
+        # Not taxids: unclassified, gaps, and past the end.
+        others = [0, 3, max(nodes) + 1, -1]
+        queries = np.array(sorted(nodes) + others)
+        for clade in nodes:
+            expected = [clade in ancestors[taxid] for taxid in sorted(nodes)]
+            assert [
+                tax.is_under(taxid, clade) for taxid in sorted(nodes)
+            ] == expected
+            mask = tax.is_under_mask(queries, clade).tolist()
+            assert mask == expected + [False] * len(others)
+            assert set(tax.ancestors(clade)) == ancestors[clade]
+            assert set(tax.descendants(clade)) == {
+                taxid
+                for taxid in nodes
+                if clade in ancestors[taxid] and taxid != clade
+            }
+        assert not tax.is_under_mask(queries, 3).any()
+
+        order = tax.bottom_up(nodes).tolist()
+        assert sorted(order) == sorted(nodes)
+        position = {taxid: i for i, taxid in enumerate(order)}
+        for taxid in nodes:
+            for ancestor in ancestors[taxid] - {taxid}:
+                assert position[taxid] < position[ancestor]
+    finally:
+        shutil.rmtree(dashboard_dir)
+
+
+if __name__ == "__main__":
+    check()
+    print("taxonomy numbering matches walking up the tree")
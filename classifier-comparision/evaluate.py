@@ -12,12 +12,10 @@ THIS_DIR = os.path.dirname(__file__)
 MGS_PIPELINE_DIR = os.path.join(THIS_DIR, "..")
 DASHBOARD_DIR = os.path.join(MGS_PIPELINE_DIR, "dashboard")
 
-parents = {}
-with open(os.path.join(DASHBOARD_DIR, "nodes.dmp")) as inf:
-    for line in inf:
-        child_taxid, parent_taxid, *_ = \
-            line.replace("\t|\n", "").split("\t|\t")
-        parents[int(child_taxid)] = int(parent_taxid)
+sys.path.insert(0, MGS_PIPELINE_DIR)
+import taxonomy
+
+TAXONOMY = taxonomy.load(DASHBOARD_DIR)
 
 human_viruses = {}
 with open(os.path.join(MGS_PIPELINE_DIR, "human-viruses.tsv")) as inf:
@@ -26,11 +24,9 @@ with open(os.path.join(MGS_PIPELINE_DIR, "human-viruses.tsv")) as inf:
         human_viruses[int(taxid)] = name
 
 def taxid_under(clade, taxid):
-    while taxid not in [0, 1]:
-        if taxid == clade:
-            return True
-        taxid = parents[taxid]
-    return False
+    if taxid == 0:
+        return False  # unclassified
+    return TAXONOMY.is_under(taxid, clade)
 
 def is_bacterial(taxid):
     return taxid_under(2, taxid)
@@ -3,69 +3,167 @@
 # input: kraken output
 # output: tsv of taxid, assignments, hits
 
-import re
 import sys
 from collections import Counter
 
-parents = {}  # child_taxid -> parent_taxid
-with open("dashboard/nodes.dmp") as inf:
-    for line in inf:
-        child_taxid, parent_taxid, rank, *_ = line.replace("\t|\n", "").split(
-            "\t|\t"
-        )
-        child_taxid = int(child_taxid)
-        parent_taxid = int(parent_taxid)
-        parents[child_taxid] = parent_taxid
-
-direct_assignments = Counter()  # taxid -> direct assignments
-direct_hits = Counter()  # taxid -> direct hits
-clade_assignments = Counter()  # taxid -> clade assignments
-clade_hits = Counter()  # taxid -> clade hits
-
-for lineno, line in enumerate(sys.stdin):
-    line = line.strip()
-    if not line:
-        continue
-
-    try:
-        _, _, name_and_taxid, _, encoded_hits = line.split("\t")
-    except ValueError:
-        raise Exception("Bad line #%d: %r" % (
-            lineno, line))
-
-    (taxid,) = re.findall("^.*[(]taxid ([0-9]+)[)]$", name_and_taxid)
-    taxid = int(taxid)
-    direct_assignments[taxid] += 1
-    while True:
-        clade_assignments[taxid] += 1
-        if taxid in [0, 1]:
-            break
-        taxid = parents[taxid]
-
-    direct_incremented = set()
-    clade_incremented = set()
-    for hit in re.findall("([0-9]+):", encoded_hits):
-        hit = int(hit)
-        if hit not in direct_incremented:
-            direct_hits[hit] += 1
-            direct_incremented.add(hit)
-
-        while hit not in clade_incremented:
-            clade_hits[hit] += 1
-            clade_incremented.add(hit)
-
-            if hit in [0, 1]:
-                break
-            hit = parents[hit]
-
-for taxid in sorted(clade_hits):
-    print(
-        "%s\t%s\t%s\t%s\t%s"
-        % (
-            taxid,
-            direct_assignments[taxid],
-            direct_hits[taxid],
-            clade_assignments[taxid],
-            clade_hits[taxid],
-        )
-    )
+import kraken
+import taxonomy
+
+
+class CladeCounter:
+    # Rather than walking the tree for every read, we accumulate reads in bulk
+    # and resolve them against the taxonomy once, in finish():
+    #
+    #  * Clade assignments are direct assignments propagated up the tree,
+    #    visiting each assigned taxid and its ancestors once, children before
+    #    parents.
+    #
+    #  * A read counts once toward the clade hits of every taxid in the union
+    #    of its hits' lineages.  Reads are grouped by their set of distinct
+    #    hits, which many reads share, and we take that union once per set.
+    #
+    # Distinct hit sets are resolved early once there are MAX_HIT_SETS of
+    # them, so memory stays bounded on large inputs.
+    #
+    # Every count is a sum over reads, so counters for disjoint sets of reads
+    # (ex: one per kraken output file) can be saved as partials and merged.
+    # Merging doesn't need a taxonomy.
+    MAX_HIT_SETS = 100000
+
+    def __init__(self, tax):
+        self.taxonomy = tax
+        self.lineages = {}  # taxid -> frozenset of taxid and its ancestors
+        self.assigned = Counter()  # taxid -> reads not yet propagated
+        self.hit_sets = Counter()  # frozenset of hit taxids -> reads
+        self.direct_assignments = Counter()  # taxid -> direct assignments
+        self.direct_hits = Counter()  # taxid -> direct hits
+        self.clade_assignments = Counter()  # taxid -> clade assignments
+        self.clade_hits = Counter()  # taxid -> clade hits
+
+    def lineage(self, taxid):
+        if taxid not in self.lineages:
+            if taxid == 0:
+                # Unclassified, which isn't part of the taxonomy.
+                self.lineages[taxid] = frozenset([0])
+            else:
+                self.lineages[taxid] = frozenset(
+                    self.taxonomy.ancestors(taxid)
+                )
+        return self.lineages[taxid]
+
+    def add_read(self, taxid, hits):
+        self.assigned[taxid] += 1
+        self.hit_sets[frozenset(hits)] += 1
+        if len(self.hit_sets) >= self.MAX_HIT_SETS:
+            self.finish()
+
+    def finish(self):
+        for hit_set, count in self.hit_sets.items():
+            for hit in hit_set:
+                self.direct_hits[hit] += count
+            for ancestor in frozenset().union(*map(self.lineage, hit_set)):
+                self.clade_hits[ancestor] += count
+        self.hit_sets.clear()
+
+        if not self.assigned:
+            return
+        clade_assignments = Counter(self.assigned)
+        involved = set().union(*map(self.lineage, self.assigned))
+        involved.discard(0)
+        taxids = self.taxonomy.bottom_up(involved)
+        parents = self.taxonomy.parent_array[taxids].tolist()
+        for taxid, parent in zip(taxids.tolist(), parents):
+            if parent != taxid:  # the root is its own parent
+                clade_assignments[parent] += clade_assignments[taxid]
+        self.direct_assignments.update(self.assigned)
+        self.clade_assignments.update(clade_assignments)
+        self.assigned.clear()
+
+    def counters(self):
+        return [
+            self.direct_assignments,
+            self.direct_hits,
+            self.clade_assignments,
+            self.clade_hits,
+        ]
+
+    def merge(self, other):
+        self.finish()
+        other.finish()
+        for counts, other_counts in zip(self.counters(), other.counters()):
+            counts.update(other_counts)
+
+    def write_partial(self, outf):
+        # Same columns as write(), but for every taxid with any nonzero count,
+        # so that merging partials gives exactly the combined counts.
+        self.finish()
+        taxids = set().union(*self.counters())
+        for taxid in sorted(taxids):
+            outf.write(
+                "%s\t%s\n"
+                % (taxid, "\t".join(str(c[taxid]) for c in self.counters()))
+            )
+
+    def add_partial(self, inf):
+        for line in inf:
+            taxid, *counts = line.rstrip("\n").split("\t")
+            for counter, count in zip(self.counters(), counts):
+                if int(count):
+                    counter[int(taxid)] += int(count)
+
+    def write(self, outf):
+        self.finish()
+        for taxid in sorted(self.clade_hits):
+            outf.write(
+                "%s\t%s\t%s\t%s\t%s\n"
+                % (
+                    taxid,
+                    self.direct_assignments[taxid],
+                    self.direct_hits[taxid],
+                    self.clade_assignments[taxid],
+                    self.clade_hits[taxid],
+                )
+            )
+
+
+class CladeCountsConsumer(kraken.Consumer):
+    # Counts each file separately, so that callers can also save per-file
+    # partials.
+    def __init__(self, tax):
+        self.taxonomy = tax
+        self.counters = {}  # fname -> CladeCounter
+
+    def start_file(self, fname):
+        # Resolve earlier files' reads, so we don't keep their hit sets.
+        for counter in self.counters.values():
+            counter.finish()
+        self.counters[fname] = CladeCounter(self.taxonomy)
+        self.counter = self.counters[fname]
+
+    def consume(self, record):
+        self.counter.add_read(record.taxid, record.hits)
+
+    def write(self, outf):
+        merged = CladeCounter(self.taxonomy)
+        for counter in self.counters.values():
+            merged.merge(counter)
+        merged.write(outf)
+
+
+def count_clades(lines, tax):
+    counter = CladeCounter(tax)
+    for lineno, line in enumerate(lines):
+        if not line.strip():
+            continue
+
+        try:
+            record = kraken.KrakenRecord(line)
+        except ValueError:
+            raise Exception("Bad line #%d: %r" % (lineno, line))
+
+        counter.add_read(record.taxid, record.hits)
+    return counter
+
+
+if __name__ == "__main__":
+    count_clades(sys.stdin, taxonomy.load()).write(sys.stdout)
@@ -1,6 +1,8 @@
 #!/usr/bin/env python3
 import sys
 
+import taxonomy
+
 # For human-viruses.tsv we want a list of all viruses that infect humans, but
 # human-viruses-raw.tsv from the Virus Host DB doesn't always include all
 # taxonomic children.  Make an expanded list by adding the missing ones.
@@ -13,46 +15,15 @@ with open(in_fname) as inf:
         taxid, name = line.strip().split("\t")
         raw_hv.add(int(taxid))
 
-children = {}
-with open("dashboard/nodes.dmp") as inf:
-    for line in inf:
-        child_taxid, parent_taxid, rank, *_ = line.replace("\t|\n", "").split(
-            "\t|\t"
-        )
-        child_taxid = int(child_taxid)
-        parent_taxid = int(parent_taxid)
-
-        if parent_taxid not in children:
-            children[parent_taxid] = []
-        children[parent_taxid].append(child_taxid)
+tax = taxonomy.load()
 
 hv = set()
-
-
-def add_children(taxid):
-    hv.add(taxid)
-    for child in children.get(taxid, []):
-        add_children(child)
-
-
 for taxid in raw_hv:
-    add_children(taxid)
-
-
-# taxid -> [name]
-# first name is scientific name
-taxonomic_names = {}
-with open("dashboard/names.dmp") as inf:
-    for line in inf:
-        taxid, name, unique_name, name_class = line.replace("\t|\n", "").split(
-            "\t|\t"
-        )
-        taxid = int(taxid)
-
-        if taxid in hv:
-            if taxid not in taxonomic_names or name_class == "scientific name":
-                taxonomic_names[taxid] = name
+    hv.add(taxid)
+    if taxid in tax:
+        hv.update(tax.descendants(taxid))
 
 with open(out_fname, "w") as outf:
     for taxid in sorted(hv):
-        outf.write("%s\t%s\n" % (taxid, taxonomic_names[taxid]))
+        # Scientific name, or if there isn't one the first name listed.
+        outf.write("%s\t%s\n" % (taxid, tax.name(taxid)))
@@ -0,0 +1,91 @@
+# Sorting and joining more data than fits in memory.
+#
+# Items are (key, value) pairs, where keys are lists or tuples of strings and
+# ints and values are anything JSON can hold.  We buffer items until their
+# JSON takes max_bytes, sort the buffer, and write it out as a run file of
+# JSON lines.  Reading the runs back with a k-way merge gives every item in
+# key order while holding only one line per run in memory.
+#
+# Keys compare the way Python compares them, so string keys come out in code
+# point order, the same order json.dump(..., sort_keys=True) uses.
+
+import heapq
+import itertools
+import json
+import os
+
+# The most run files we read at once; with more, we merge them in rounds.
+MAX_MERGE_FILES = 64
+
+
+class RunWriter:
+    def __init__(self, workdir, prefix, max_bytes):
+        self.workdir = workdir
+        self.prefix = prefix
+        self.max_bytes = max_bytes
+        self.buffer = []
+        self.buffered_bytes = 0
+        self.run_fnames = []
+        self.runs_written = 0
+
+    def new_fname(self):
+        self.runs_written += 1
+        return os.path.join(
+            self.workdir, "%s.%s.run.jsonl" % (self.prefix, self.runs_written)
+        )
+
+    def add(self, key, value):
+        line = json.dumps([key, value]) + "\n"
+        self.buffer.append((key, line))
+        self.buffered_bytes += len(line)
+        if self.buffered_bytes >= self.max_bytes:
+            self.flush()
+
+    def flush(self):
+        if not self.buffer:
+            return
+        # Sort on the key alone: keys are unique in practice, and comparing
+        # lines would order equal keys by their values.
+        self.buffer.sort(key=lambda item: item[0])
+        fname = self.new_fname()
+        with open(fname, "w") as outf:
+            for _, line in self.buffer:
+                outf.write(line)
+        self.run_fnames.append(fname)
+        self.buffer = []
+        self.buffered_bytes = 0
+
+    def sorted_items(self):
+        # Yields every item added, as [key, value], in key order.  Keys and
+        # values come back the way JSON round-trips them: tuples as lists.
+        self.flush()
+        while len(self.run_fnames) > MAX_MERGE_FILES:
+            batch = self.run_fnames[:MAX_MERGE_FILES]
+            del self.run_fnames[:MAX_MERGE_FILES]
+            fname = self.new_fname()
+            with open(fname, "w") as outf:
+                for key, value in merge_runs(batch):
+                    outf.write(json.dumps([key, value]) + "\n")
+            for merged_fname in batch:
+                os.remove(merged_fname)
+            self.run_fnames.append(fname)
+        yield from merge_runs(self.run_fnames)
+
+
+def read_run(fname):
+    with open(fname) as inf:
+        for line in inf:
+            yield json.loads(line)
+
+
+def merge_runs(fnames):
+    return heapq.merge(
+        *[read_run(fname) for fname in fnames], key=lambda item: item[0]
+    )
+
+
+def group_by_first(items):
+    # Items are [key, value] with keys that are lists whose first element is
+    # what we're grouping on.  Yields (first element, [value, ...]).
+    for first, group in itertools.groupby(items, key=lambda item: item[0][0]):
+        yield first, [value for _, value in group]
@@ -0,0 +1,141 @@
+# Fast scanning of FASTQ for a few reads by ID.
+#
+# Several stages read hundreds of millions of FASTQ records to keep a few
+# thousand of them.  FastqGeneralIterator spends most of that time making
+# three Python strings per record that we then throw away.  Instead we read
+# large decompressed buffers of whole records, find every newline with NumPy,
+# and compute where each record's read ID starts and ends from those offsets.
+# The IDs are then checked against a readids.ReadIdSet a whole buffer at a
+# time (optionally screened first by a Bloom filter, see readids.py), and only
+# records whose ID is wanted are decoded.  Buffers are
+# independent, so they can be scanned in a process pool.
+#
+# Like the rest of the pipeline, this assumes four-line FASTQ records, which
+# is what AdapterRemoval, samtools, and bowtie2 write.  Records come back as
+# the (title, sequence, quality) tuples FastqGeneralIterator would give.
+
+import collections
+import concurrent.futures
+
+import numpy as np
+
+import readids
+
+BUFFER_SIZE = 16 << 20  # bytes
+NEWLINE = ord("\n")
+
+# The targets of the current filter_records, in pool workers.
+_TARGETS = None
+
+
+def record_buffers(inf, buffer_size=BUFFER_SIZE):
+    # Reads a binary stream of uncompressed FASTQ into buffers of whole
+    # records.
+    carry = b""
+    while True:
+        chunk = inf.read(buffer_size)
+        if not chunk:
+            break
+        data = carry + chunk
+        ends = np.flatnonzero(np.frombuffer(data, dtype=np.uint8) == NEWLINE)
+        complete_lines = len(ends) - len(ends) % 4
+        if not complete_lines:
+            carry = data
+            continue
+        cut = int(ends[complete_lines - 1]) + 1
+        yield data[:cut]
+        carry = data[cut:]
+    if carry.strip():
+        yield carry if carry.endswith(b"\n") else carry + b"\n"
+
+
+def read_id_bounds(data):
+    # -> (line ends, read ID starts, read ID ends) for a buffer of whole
+    # records.  A read ID is the title up to the first whitespace, without a
+    # trailing /1 or /2, the same as run.py's fastq_seq_id.
+    array = np.frombuffer(data, dtype=np.uint8)
+    ends = np.flatnonzero(array == NEWLINE)
+    if len(ends) % 4:
+        raise Exception("Not four-line FASTQ")
+    title_ends = ends[0::4]
+    id_starts = np.concatenate(([0], ends[3::4][:-1] + 1)) + 1  # skip "@"
+
+    spaces = np.flatnonzero((array == ord(" ")) | (array == ord("\t")))
+    id_ends = title_ends
+    if len(spaces):
+        first_space = np.searchsorted(spaces, id_starts)
+        in_range = first_space < len(spaces)
+        space_ends = spaces[np.where(in_range, first_space, 0)]
+        id_ends = np.where(
+            in_range & (space_ends < title_ends), space_ends, title_ends
+        )
+
+    mate_suffix = (
+        (id_ends - id_starts >= 2)
+        & (array[np.maximum(id_ends - 2, 0)] == ord("/"))
+        & np.isin(array[np.maximum(id_ends - 1, 0)], [ord("1"), ord("2")])
+    )
+    return ends, id_starts, id_ends - 2 * mate_suffix
+
+
+def read_ids(data):
+    # Every record's read ID, as bytes.
+    _, id_starts, id_ends = read_id_bounds(data)
+    return [
+        data[start:end]
+        for start, end in zip(id_starts.tolist(), id_ends.tolist())
+    ]
+
+
+def scan_buffer(data, targets):
+    # Records in data whose read ID is in targets, a readids.ReadIdSet.
+    ends, id_starts, id_ends = read_id_bounds(data)
+    matches = targets.contains_bounds(
+        np.frombuffer(data, dtype=np.uint8), id_starts, id_ends
+    )
+    found = []
+    for i in np.flatnonzero(matches).tolist():
+        title_end, seq_end, plus_end, qual_end = ends[
+            4 * i : 4 * i + 4
+        ].tolist()
+        found.append(
+            (
+                data[id_starts[i] : title_end].decode("utf-8"),
+                data[title_end + 1 : seq_end].decode("utf-8"),
+                data[plus_end + 1 : qual_end].decode("utf-8"),
+            )
+        )
+    return found
+
+
+def _set_targets(targets):
+    global _TARGETS
+    _TARGETS = targets
+
+
+def _scan_with_targets(data):
+    return scan_buffer(data, _TARGETS)
+
+
+def filter_records(inf, targets, processes=1):
+    # Yields (title, sequence, quality) for each record in the binary stream
+    # inf whose read ID is in targets, in order.  targets is a
+    # readids.ReadIdSet, or any iterable of IDs.  With processes > 1, buffers
+    # are scanned in that many worker processes while we read ahead.
+    if not isinstance(targets, readids.ReadIdSet):
+        targets = readids.ReadIdSet(targets)
+    if processes <= 1:
+        for data in record_buffers(inf):
+            yield from scan_buffer(data, targets)
+        return
+
+    with concurrent.futures.ProcessPoolExecutor(
+        processes, initializer=_set_targets, initargs=(targets,)
+    ) as pool:
+        in_flight = collections.deque()
+        for data in record_buffers(inf):
+            in_flight.append(pool.submit(_scan_with_targets, data))
+            if len(in_flight) >= processes * 2:
+                yield from in_flight.popleft().result()
+        while in_flight:
+            yield from in_flight.popleft().result()
@@ -0,0 +1,171 @@
+# Read ID index for block-gzipped FASTQ, to fetch a few reads by ID without
+# reading the whole file.
+#
+# For a BGZF FASTQ file (ex: cleaned/SRR14530724.collapsed.gz, with its block
+# index in cleaned-gzi/, or a BGZF copy the readindex stage made in
+# readindex/) the readindex stage writes readindex/, ex:
+#
+#   SRR14530724.collapsed.gz.ridx
+#
+# which is these arrays, one after the other in .npy format, uncompressed so
+# it can be memory-mapped:
+#
+#   hashes   uint64, readids.py hash of each record's read ID, sorted
+#   blocks   int32, for each hash, the block (counting from zero, as in the
+#              .gzi) that the record starts in
+#   offsets  uint16, where the record starts in that block's uncompressed data
+#   sizes    uint32, length of the record in bytes
+#
+# Different IDs can share a hash, so fetch_records checks each candidate's
+# actual ID.  Records we want are read with one ranged read per run of
+# adjacent blocks.
+
+import numpy as np
+import numpy.lib.format
+
+import bgzf
+import fastq
+import readids
+
+ARRAYS = ["hashes", "blocks", "offsets", "sizes"]
+DTYPES = {
+    "hashes": np.uint64,
+    "blocks": np.int32,
+    "offsets": np.uint16,
+    "sizes": np.uint32,
+}
+
+MAX_RUN_BLOCKS = 64  # most blocks to fetch in one read
+
+
+def index_fname(fastq_fname):
+    return fastq_fname + ".ridx"
+
+
+def build_index(bgzf_fname, out_fname):
+    # Indexes a local BGZF FASTQ file.
+    block_starts = np.array(
+        bgzf.open_local(bgzf_fname).uncompressed_offsets, dtype=np.int64
+    )
+    parts = {array_name: [] for array_name in ARRAYS}
+    buffer_start = 0
+    with bgzf.open(bgzf_fname, "rb") as inf:
+        for data in fastq.record_buffers(inf):
+            line_ends, id_starts, id_ends = fastq.read_id_bounds(data)
+            record_starts = id_starts - 1  # before the "@"
+            record_ends = line_ends[3::4] + 1
+            positions = buffer_start + record_starts
+            blocks = np.searchsorted(block_starts, positions, "right") - 1
+
+            parts["hashes"].append(
+                readids.hash_bounds(
+                    np.frombuffer(data, dtype=np.uint8), id_starts, id_ends
+                )
+            )
+            parts["blocks"].append(blocks)
+            parts["offsets"].append(positions - block_starts[blocks])
+            parts["sizes"].append(record_ends - record_starts)
+            buffer_start += len(data)
+
+    arrays = {
+        array_name: np.concatenate(parts[array_name] or [np.zeros(0)]).astype(
+            DTYPES[array_name]
+        )
+        for array_name in ARRAYS
+    }
+    order = np.argsort(arrays["hashes"], kind="stable")
+    with open(out_fname, "wb") as outf:
+        for array_name in ARRAYS:
+            numpy.lib.format.write_array(
+                outf, arrays[array_name][order], allow_pickle=False
+            )
+
+
+def load_index(fname):
+    # array name -> memory-mapped array
+    arrays = {}
+    with open(fname, "rb") as inf:
+        for array_name in ARRAYS:
+            if numpy.lib.format.read_magic(inf) == (1, 0):
+                read_header = numpy.lib.format.read_array_header_1_0
+            else:
+                read_header = numpy.lib.format.read_array_header_2_0
+            shape, fortran_order, dtype = read_header(inf)
+            offset = inf.tell()
+            if np.prod(shape):
+                arrays[array_name] = np.memmap(
+                    fname, dtype=dtype, mode="r", offset=offset, shape=shape
+                )
+            else:
+                arrays[array_name] = np.empty(shape, dtype=dtype)
+            inf.seek(offset + int(np.prod(shape)) * dtype.itemsize)
+    return arrays
+
+
+def block_runs(blocks):
+    # Sorted block numbers -> [(start, end)] runs of adjacent blocks.
+    runs = []
+    for block in blocks:
+        if (
+            runs
+            and runs[-1][1] == block
+            and block - runs[-1][0] < MAX_RUN_BLOCKS
+        ):
+            runs[-1][1] = block + 1
+        else:
+            runs.append([block, block + 1])
+    return runs
+
+
+def fetch_records(bgzf_file, index, read_ids):
+    # Yields (title, sequence, quality) for each record in bgzf_file (a
+    # bgzf.BgzfFile) whose read ID is in read_ids, in file order.  read_ids
+    # is a readids.ReadIdSet, or any iterable of IDs.
+    if not isinstance(read_ids, readids.ReadIdSet):
+        read_ids = readids.ReadIdSet(read_ids)
+    if not len(read_ids):
+        return
+    firsts = np.searchsorted(index["hashes"], read_ids.hashes, "left")
+    lasts = np.searchsorted(index["hashes"], read_ids.hashes, "right")
+    rows = np.unique(
+        np.concatenate(
+            [np.arange(first, last) for first, last in zip(firsts, lasts)]
+        )
+    ).astype(np.int64)
+    if not len(rows):
+        return
+
+    block_starts = np.array(bgzf_file.uncompressed_offsets, dtype=np.int64)
+    starts = block_starts[index["blocks"][rows]] + index["offsets"][rows]
+    ends = starts + index["sizes"][rows]
+    first_blocks = np.searchsorted(block_starts, starts, "right") - 1
+    last_blocks = np.searchsorted(block_starts, ends - 1, "right") - 1
+
+    needed = sorted(
+        set(
+            block
+            for first, last in zip(first_blocks.tolist(), last_blocks.tolist())
+            for block in range(first, last + 1)
+        )
+    )
+    data = {}  # block -> uncompressed data
+    for run_start, run_end in block_runs(needed):
+        compressed = bgzf_file.read_blocks(run_start, run_end)
+        for block, block_data in zip(
+            range(run_start, run_end),
+            bgzf.parallel_map(
+                bgzf.decompress_block, compressed, bgzf_file.threads
+            ),
+        ):
+            data[block] = block_data
+
+    for i in np.argsort(starts, kind="stable").tolist():
+        record = b"".join(
+            data[block]
+            for block in range(int(first_blocks[i]), int(last_blocks[i]) + 1)
+        )
+        skip = int(starts[i] - block_starts[first_blocks[i]])
+        record = record[skip : skip + int(index["sizes"][rows[i]])]
+        if not record.endswith(b"\n"):
+            record += b"\n"  # the last record of a file without a newline
+        yield from fastq.scan_buffer(record, read_ids)
@@ -0,0 +1,264 @@
+# Parsing and single-pass consumption of kraken2 output.
+#
+# Kraken output (processed/*.kraken2.tsv.gz) is the largest thing most stages
+# read.  Instead of each stage downloading and parsing it separately, we parse
+# each line once into a KrakenRecord and hand it to every Consumer that wants
+# it.  Adding a new per-read aggregation means writing a new Consumer, not
+# another pass over the data.
+#
+# A line looks like:
+#
+#   C  read_id  Name (taxid 1234)  150|148  2:3 1234:5 |:| 0:7
+#
+# (tab-separated) with the classification flag, read ID, assignment, read
+# length (or lengths, for pairs), and hits.  The hits are taxid:kmer-count
+# runs, "A:n" for ambiguous nucleotides, and "|:|" separating the two mates of
+# a pair.
+
+import itertools
+from collections import Counter
+from collections import defaultdict
+
+import numpy as np
+
+
+class KrakenRecord:
+    __slots__ = [
+        "line",
+        "read_id",
+        "assignment",
+        "taxid",
+        "lengths",
+        "encoded_hits",
+        "_hits",
+    ]
+
+    def __init__(self, line):
+        self.line = line
+        (
+            _,
+            self.read_id,
+            self.assignment,
+            self.lengths,
+            self.encoded_hits,
+        ) = line.rstrip("\n").split("\t")
+        self.taxid = int(
+            self.assignment[self.assignment.rindex("(taxid ") + 7 : -1]
+        )
+        self._hits = None
+
+    @property
+    def hits(self):
+        # Taxids of each hit run, in order, skipping ambiguous nucleotides and
+        # the paired-end separator.
+        if self._hits is None:
+            self._hits = [
+                int(taxid)
+                for taxid, _ in (
+                    hit.split(":") for hit in self.encoded_hits.split()
+                )
+                if taxid not in ["A", "|"]
+            ]
+        return self._hits
+
+
+class Consumer:
+    # Sees every record of every kraken output file for a sample, in order,
+    # and then writes one output file.
+    def start_file(self, fname):
+        pass
+
+    def consume(self, record):
+        raise NotImplementedError()
+
+    def write(self, outf):
+        raise NotImplementedError()
+
+    def file_done(self):
+        # Whether the consumer has everything it needs from the current file.
+        # Once every consumer does, we skip the rest of the file.
+        return False
+
+
+# How many records to hand out between checks of Consumer.file_done().
+CONSUME_BATCH_SIZE = 4096
+
+
+def parse(lines):
+    for line in lines:
+        yield KrakenRecord(line)
+
+
+def consume(named_inputs, consumers):
+    # named_inputs: iterable of (fname, iterable of records), where records are
+    # KrakenRecords or anything that behaves like them (ex:
+    # krakencols.ColumnRecord).
+    #
+    # Callers should close each file's records once we move on, since we may
+    # stop reading them early.
+    for fname, records in named_inputs:
+        for consumer in consumers:
+            consumer.start_file(fname)
+        records = iter(records)
+        while not all(consumer.file_done() for consumer in consumers):
+            batch = list(itertools.islice(records, CONSUME_BATCH_SIZE))
+            if not batch:
+                break
+            for record in batch:
+                for consumer in consumers:
+                    consumer.consume(record)
+
+
+class HumanVirusesConsumer(Consumer):
+    # How many reads kraken assigned to each human-infecting virus.
+    def __init__(self, human_viruses):
+        self.human_viruses = human_viruses  # taxid -> name
+        self.counts = Counter()
+
+    def consume(self, record):
+        if record.taxid in self.human_viruses:
+            self.counts[record.taxid] += 1
+
+    def write(self, outf):
+        for taxid, count in sorted(self.counts.items()):
+            outf.write(
+                "%s\t%s\t%s\n" % (taxid, count, self.human_viruses[taxid])
+            )
+
+
+class AllMatchesConsumer(Consumer):
+    # Kraken output lines for reads with any hit against a human virus.
+    def __init__(self, human_viruses):
+        self.human_viruses = human_viruses
+        self.kept = []
+
+    def matches(self, record):
+        return any(taxid in self.human_viruses for taxid in record.hits)
+
+    def consume(self, record):
+        if self.matches(record):
+            self.kept.append(record.line)
+
+    def write(self, outf):
+        for line in self.kept:
+            outf.write(line)
+
+
+class SampleReadsConsumer(Consumer):
+    # Example read IDs for each category.  We keep the first target_len IDs
+    # of each category from each file, and then subset them in proportion to
+    # how many reads of that category each file had.
+    #
+    # Reads are categorized in chunks, with one vectorized clade-membership
+    # check per category per chunk instead of one per read.
+    #
+    # If each file's category totals are known up front (see
+    # set_file_totals), so is how many IDs we'll keep from each file, and we
+    # stop reading a file as soon as we have them.
+    CATEGORIES = ["all", "bacterial", "viral", "humanviral"]
+    CLADES = {
+        "bacterial": 2,
+        "viral": 10239,
+    }
+    CHUNK_SIZE = 65536
+
+    def __init__(self, tax, human_viruses, target_len):
+        self.taxonomy = tax
+        self.human_viruses = human_viruses
+        self.human_virus_taxids = np.array(sorted(human_viruses))
+        self.target_len = target_len
+        self.read_ids = {}  # fname -> category -> [read_id]
+        self.full_counts = Counter()  # category -> count
+        self.fname_counts = defaultdict(Counter)  # fname -> category -> count
+        self.fname = None
+        self.pending_taxids = []
+        self.pending_read_ids = []
+        self.totals_known = False
+        self.current_file_done = False
+
+    def set_file_totals(self, fname, direct_assignments, clade_assignments):
+        # Category totals for one file, from its clade counts (see
+        # count_clades.py).  Call for every file before consuming any, or for
+        # none.
+        totals = {
+            "all": sum(direct_assignments.values()),
+            "humanviral": sum(
+                direct_assignments[taxid] for taxid in self.human_viruses
+            ),
+        }
+        for category, clade in self.CLADES.items():
+            totals[category] = clade_assignments[clade]
+        for category, total in totals.items():
+            if total:
+                self.full_counts[category] += total
+                self.fname_counts[fname][category] += total
+        self.totals_known = True
+
+    def quota(self, fname, category):
+        # How many of fname's IDs in category we keep.
+        full_count = self.full_counts[category]
+        fname_count = self.fname_counts[fname][category]
+        if full_count <= self.target_len:
+            return fname_count
+        return self.target_len * fname_count // full_count
+
+    def category_mask(self, taxids, category):
+        if category == "all":
+            return np.ones(len(taxids), dtype=bool)
+        if category == "humanviral":
+            return np.isin(taxids, self.human_virus_taxids)
+        return self.taxonomy.is_under_mask(taxids, self.CLADES[category])
+
+    def flush(self):
+        if not self.pending_taxids:
+            return
+        taxids = np.array(self.pending_taxids)
+        for category, read_ids in self.read_ids[self.fname].items():
+            matches = np.flatnonzero(self.category_mask(taxids, category))
+            if not len(matches):
+                continue
+            if not self.totals_known:
+                self.full_counts[category] += len(matches)
+                self.fname_counts[self.fname][category] += len(matches)
+            for i in matches[: self.target_len - len(read_ids)].tolist():
+                read_ids.append(self.pending_read_ids[i])
+        self.pending_taxids = []
+        self.pending_read_ids = []
+        self.current_file_done = self.totals_known and all(
+            len(read_ids) >= self.quota(self.fname, category)
+            for category, read_ids in self.read_ids[self.fname].items()
+        )
+
+    def start_file(self, fname):
+        self.flush()
+        self.fname = fname
+        self.read_ids[fname] = {category: [] for category in self.CATEGORIES}
+        self.current_file_done = False
+
+    def file_done(self):
+        return self.current_file_done
+
+    def consume(self, record):
+        self.pending_taxids.append(record.taxid)
+        self.pending_read_ids.append(record.read_id)
+        if len(self.pending_taxids) >= self.CHUNK_SIZE:
+            self.flush()
+
+    def subsetted_ids(self):
+        subsetted_ids = {}
+        for category, full_count in self.full_counts.items():
+            subsetted_ids[category] = []
+            for fname in self.read_ids:
+                subsetted_ids[category].extend(
+                    self.read_ids[fname][category][
+                        : self.quota(fname, category)
+                    ]
+                )
+        return subsetted_ids
+
+    def write(self, outf):
+        self.flush()
+        subsetted_ids = self.subsetted_ids()
+        for category in sorted(subsetted_ids):
+            for selected_read_id in sorted(subsetted_ids[category]):
+                outf.write("%s\t%s\n" % (category[0], selected_read_id))
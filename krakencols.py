@@ -0,0 +1,283 @@
+# Columnar sidecar for kraken output.
+#
+# processed/*.kraken2.tsv.gz repeats the full scientific name on every line and
+# spells out every hit as text, and each consumer has to parse it all back.
+# When run with --kraken-columns, interpret also writes the same information
+# as NumPy arrays to krakencols/, ex:
+#
+#   SRR14530724.collapsed.kraken2.cols.gz
+#
+# The file is a sequence of chunks of up to CHUNK_SIZE reads.  Each chunk is
+# the arrays in ARRAYS, one after the other, in .npy format, and the file ends
+# with an empty chunk.  Because every piece is a plain .npy array it can be
+# streamed from any file object, including a gzip or S3 stream (read_chunks).
+#
+# The original text can be reconstructed exactly, so consumers that need whole
+# lines (ex: allmatches) can still use it.
+
+import gzip
+
+import numpy as np
+import numpy.lib.format
+
+import kraken
+
+CHUNK_SIZE = 1 << 20  # reads
+
+# Special values in hit_taxids.
+AMBIGUOUS = -1  # "A:n", a run of k-mers with ambiguous nucleotides
+MATE_SEPARATOR = -2  # "|:|", between the hits of the two mates of a pair
+
+NO_LENGTH = -1  # second length, for reads that aren't pairs
+
+ARRAYS = [
+    # Read i's ID is read_ids[read_id_offsets[i]:read_id_offsets[i+1]],
+    # utf-8 encoded.
+    "read_id_offsets",  # int64
+    "read_ids",  # uint8
+    "taxids",  # int32, assigned taxid, 0 if unclassified
+    "lengths",  # int32, (reads, 2), mate lengths or (length, NO_LENGTH)
+    # Read i's hits are hit_taxids[hit_offsets[i]:hit_offsets[i+1]], each
+    # covering the corresponding count of k-mers.
+    "hit_offsets",  # int64
+    "hit_taxids",  # int32
+    "hit_kmers",  # uint32
+    # Kraken's assignment text ("Name (taxid N)") for each taxid assigned in
+    # the chunk, stored once per chunk instead of once per read.
+    "name_taxids",  # int32, sorted
+    "name_offsets",  # int64
+    "names",  # uint8
+]
+
+
+def sidecar_fname(kraken_fname):
+    # ex: SRR14530724.collapsed.kraken2.tsv.gz ->
+    #       SRR14530724.collapsed.kraken2.cols.gz
+    return kraken_fname.replace(".kraken2.tsv.gz", ".kraken2.cols.gz")
+
+
+def encode_strings(strings):
+    # -> (offsets, blob)
+    encoded = [string.encode("utf-8") for string in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(x) for x in encoded], out=offsets[1:])
+    return offsets, np.frombuffer(b"".join(encoded), dtype=np.uint8)
+
+
+class ColumnWriter:
+    # Accepts kraken.KrakenRecords and writes them to a binary file object.
+    # Call close() when done, which finishes the file but doesn't close outf.
+    def __init__(self, outf, chunk_size=CHUNK_SIZE):
+        self.outf = outf
+        self.chunk_size = chunk_size
+        self.reset()
+
+    def reset(self):
+        self.read_ids = []
+        self.taxids = []
+        self.lengths = []
+        self.hit_counts = []
+        self.hit_taxids = []
+        self.hit_kmers = []
+        self.assignments = {}  # taxid -> assignment text
+
+    def add(self, record):
+        self.read_ids.append(record.read_id)
+        self.taxids.append(record.taxid)
+        self.assignments[record.taxid] = record.assignment
+
+        mate1, _, mate2 = record.lengths.partition("|")
+        self.lengths.append((int(mate1), int(mate2) if mate2 else NO_LENGTH))
+
+        hits = record.encoded_hits.split()
+        for hit in hits:
+            taxid, kmers = hit.split(":")
+            if taxid == "A":
+                self.hit_taxids.append(AMBIGUOUS)
+                self.hit_kmers.append(int(kmers))
+            elif taxid == "|":
+                self.hit_taxids.append(MATE_SEPARATOR)
+                self.hit_kmers.append(0)
+            else:
+                self.hit_taxids.append(int(taxid))
+                self.hit_kmers.append(int(kmers))
+        self.hit_counts.append(len(hits))
+
+        if len(self.taxids) >= self.chunk_size:
+            self.flush()
+
+    def flush(self, final=False):
+        if not self.taxids and not final:
+            return
+
+        arrays = {}
+        arrays["read_id_offsets"], arrays["read_ids"] = encode_strings(
+            self.read_ids
+        )
+        arrays["taxids"] = np.array(self.taxids, dtype=np.int32)
+        arrays["lengths"] = np.array(self.lengths, dtype=np.int32).reshape(
+            -1, 2
+        )
+        arrays["hit_offsets"] = np.zeros(len(self.hit_counts) + 1, np.int64)
+        np.cumsum(self.hit_counts, out=arrays["hit_offsets"][1:])
+        arrays["hit_taxids"] = np.array(self.hit_taxids, dtype=np.int32)
+        arrays["hit_kmers"] = np.array(self.hit_kmers, dtype=np.uint32)
+        name_taxids = sorted(self.assignments)
+        arrays["name_taxids"] = np.array(name_taxids, dtype=np.int32)
+        arrays["name_offsets"], arrays["names"] = encode_strings(
+            self.assignments[taxid] for taxid in name_taxids
+        )
+
+        for array_name in ARRAYS:
+            numpy.lib.format.write_array(
+                self.outf, arrays[array_name], allow_pickle=False
+            )
+        self.reset()
+
+    def close(self):
+        self.flush()
+        self.flush(final=True)  # empty chunk, marking the end
+
+
+def write_columns(records, outf):
+    writer = ColumnWriter(outf)
+    for record in records:
+        writer.add(record)
+    writer.close()
+
+
+def compress_kraken_output(kraken_fname, out_fname):
+    # Reads a local, uncompressed kraken output file and writes its sidecar.
+    with open(kraken_fname) as inf, gzip.open(
+        out_fname, "wb", compresslevel=6
+    ) as outf:
+        write_columns(kraken.parse(inf), outf)
+
+
+class Chunk:
+    def __init__(self, arrays):
+        for array_name in ARRAYS:
+            setattr(self, array_name, arrays[array_name])
+        self._names = None
+
+    def __len__(self):
+        return len(self.taxids)
+
+    def assignment_names(self):
+        # taxid -> assignment text
+        if self._names is None:
+            offsets = self.name_offsets.tolist()
+            blob = self.names.tobytes()
+            self._names = {
+                taxid: blob[offsets[i] : offsets[i + 1]].decode("utf-8")
+                for i, taxid in enumerate(self.name_taxids.tolist())
+            }
+        return self._names
+
+    def records(self):
+        # ColumnRecords, which behave like kraken.KrakenRecords.
+        columns = ChunkColumns(self)
+        for i in range(len(self)):
+            yield ColumnRecord(columns, i)
+
+
+class ChunkColumns:
+    # A chunk's arrays as Python lists, which are much faster to index one
+    # element at a time.
+    def __init__(self, chunk):
+        self.read_id_offsets = chunk.read_id_offsets.tolist()
+        self.read_ids = chunk.read_ids.tobytes()
+        self.taxids = chunk.taxids.tolist()
+        self.lengths = chunk.lengths.tolist()
+        self.hit_offsets = chunk.hit_offsets.tolist()
+        self.hit_taxids = chunk.hit_taxids.tolist()
+        self.hit_kmers = chunk.hit_kmers.tolist()
+        self.names = chunk.assignment_names()
+
+
+class ColumnRecord:
+    __slots__ = ["columns", "i", "read_id", "taxid", "_hits"]
+
+    def __init__(self, columns, i):
+        self.columns = columns
+        self.i = i
+        self.read_id = columns.read_ids[
+            columns.read_id_offsets[i] : columns.read_id_offsets[i + 1]
+        ].decode("utf-8")
+        self.taxid = columns.taxids[i]
+        self._hits = None
+
+    @property
+    def assignment(self):
+        return self.columns.names[self.taxid]
+
+    @property
+    def lengths(self):
+        mate1, mate2 = self.columns.lengths[self.i]
+        if mate2 == NO_LENGTH:
+            return str(mate1)
+        return "%s|%s" % (mate1, mate2)
+
+    def hit_range(self):
+        return range(
+            self.columns.hit_offsets[self.i],
+            self.columns.hit_offsets[self.i + 1],
+        )
+
+    @property
+    def hits(self):
+        if self._hits is None:
+            hit_taxids = self.columns.hit_taxids
+            self._hits = [
+                hit_taxids[j] for j in self.hit_range() if hit_taxids[j] >= 0
+            ]
+        return self._hits
+
+    @property
+    def encoded_hits(self):
+        encoded = []
+        for j in self.hit_range():
+            taxid = self.columns.hit_taxids[j]
+            if taxid == MATE_SEPARATOR:
+                encoded.append("|:|")
+            else:
+                encoded.append(
+                    "%s:%s"
+                    % (
+                        "A" if taxid == AMBIGUOUS else taxid,
+                        self.columns.hit_kmers[j],
+                    )
+                )
+        return " ".join(encoded)
+
+    @property
+    def line(self):
+        return "%s\t%s\t%s\t%s\t%s\n" % (
+            "U" if self.taxid == 0 else "C",
+            self.read_id,
+            self.assignment,
+            self.lengths,
+            self.encoded_hits,
+        )
+
+
+def read_chunks(inf):
+    # Streams Chunks from a binary file object, which doesn't need to be
+    # seekable.
+    while True:
+        chunk = Chunk(
+            {
+                array_name: numpy.lib.format.read_array(
+                    inf, allow_pickle=False
+                )
+                for array_name in ARRAYS
+            }
+        )
+        if not len(chunk):
+            return
+        yield chunk
+
+
+def records(chunks):
+    for chunk in chunks:
+        yield from chunk.records()
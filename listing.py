@@ -0,0 +1,226 @@
+# One recursive listing per delivery, shared by every stage.
+#
+# Instead of listing each stage's input and output directories separately, we
+# list everything under <bucket>/<delivery>/ once and answer directory
+# listings from an in-memory index of (dirname, fname) -> (size, mtime).  The
+# index is updated as we upload files, so later stages in the same run see
+# earlier stages' outputs.
+#
+# The index is also persisted under ~/tmp/listings/ for a limited time, so
+# that when reprocess.py --sample-level starts many copies of run.py for the
+# same delivery only the first one needs to list the bucket.  The persisted
+# copy is a snapshot of the listing plus a journal of uploads since, one JSON
+# line each.  Uploads are appended to the journal under a lock, so concurrent
+# runs see each other's uploads without rewriting the snapshot each time.
+
+import os
+import json
+import time
+import fcntl
+import tempfile
+import contextlib
+import urllib.parse
+
+import storage
+
+CACHE_DIR = os.path.expanduser("~/tmp/listings/")
+DEFAULT_TTL = 600  # seconds
+
+
+class DeliveryListing:
+    def __init__(self, storage_backend, delivery_url, ttl=DEFAULT_TTL):
+        # delivery_url: "s3://bucket/delivery/", or a local path with a
+        # trailing slash.
+        self.storage = storage_backend
+        self.delivery_url = delivery_url
+        self.ttl = ttl
+        self.dirs = {}  # dirname -> fname -> (size, mtime)
+        self.added = {}  # (dirname, fname) -> (size, mtime), uploaded by us
+        self.refresh()
+
+    def cache_fname(self):
+        return os.path.join(
+            CACHE_DIR,
+            "%s.json" % urllib.parse.quote(self.delivery_url, safe=""),
+        )
+
+    @contextlib.contextmanager
+    def locked_cache(self):
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        with open(self.cache_fname() + ".lock", "w") as lockf:
+            fcntl.flock(lockf, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lockf, fcntl.LOCK_UN)
+
+    def journal_fname(self):
+        return self.cache_fname() + ".journal"
+
+    def read_cache(self):
+        # Returns (listed_at, dirs) from the persisted copy, or None if it's
+        # missing or expired.
+        try:
+            with open(self.cache_fname()) as inf:
+                cached = json.load(inf)
+        except FileNotFoundError:
+            return None
+        if time.time() - cached["listed_at"] > self.ttl:
+            return None
+        dirs = {}
+        for dirname, fname, size, mtime in cached["entries"]:
+            dirs.setdefault(dirname, {})[fname] = (size, mtime)
+        try:
+            with open(self.journal_fname()) as inf:
+                for line in inf:
+                    dirname, fname, size, mtime = json.loads(line)
+                    dirs.setdefault(dirname, {})[fname] = (size, mtime)
+        except FileNotFoundError:
+            pass
+        return cached["listed_at"], dirs
+
+    def write_cache(self, listed_at):
+        fd, tmp_fname = tempfile.mkstemp(dir=CACHE_DIR)
+        with os.fdopen(fd, "w") as outf:
+            json.dump(
+                {
+                    "listed_at": listed_at,
+                    "entries": [
+                        [dirname, fname, size, mtime]
+                        for dirname, fnames in sorted(self.dirs.items())
+                        for fname, (size, mtime) in sorted(fnames.items())
+                    ],
+                },
+                outf,
+            )
+        os.replace(tmp_fname, self.cache_fname())
+        # The snapshot has everything the journal had.
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(self.journal_fname())
+
+    def list_storage(self):
+        dirs = {}
+        for info in self.storage.list(self.delivery_url, recursive=True):
+            dirname, _, fname = info.name.rpartition("/")
+            if not fname:
+                continue  # directory marker
+            dirs.setdefault(dirname, {})[fname] = (info.size, info.mtime)
+        return dirs
+
+    def refresh(self, force=False):
+        if not self.ttl:
+            self.dirs = self.list_storage()
+            return
+
+        with self.locked_cache():
+            cached = None if force else self.read_cache()
+            if cached is not None:
+                _, self.dirs = cached
+                return
+
+            listed_at = time.time()
+            self.dirs = self.list_storage()
+            self.write_cache(listed_at)
+
+    def ls(self, dirname, prefix=""):
+        # Same conventions as storage.list: yields ObjectInfo for files
+        # directly in dirname whose names start with prefix.
+        for fname, (size, mtime) in self.dirs.get(dirname, {}).items():
+            if fname.startswith(prefix):
+                yield storage.ObjectInfo(fname, size, mtime)
+
+    def add(self, dirname, fname, size):
+        info = (size, storage.format_mtime(time.time()))
+        self.dirs.setdefault(dirname, {})[fname] = info
+        self.added[dirname, fname] = info
+
+        if not self.ttl:
+            return
+
+        with self.locked_cache():
+            # The snapshot's mtime is when it was listed.
+            try:
+                listed_at = os.path.getmtime(self.cache_fname())
+            except FileNotFoundError:
+                return
+            if time.time() - listed_at > self.ttl:
+                return  # expired; the next run will list from scratch
+            with open(self.journal_fname(), "a") as outf:
+                outf.write(json.dumps([dirname, fname, *info]) + "\n")
+
+    def merge(self, added):
+        # Records another process's uploads (ex: a run.py sample worker's
+        # added), which it has already merged into the persisted copy.
+        for (dirname, fname), info in added.items():
+            self.dirs.setdefault(dirname, {})[fname] = info
+            self.added[dirname, fname] = info
+
+
+# Roles a file can play within a sample, from the tokens AdapterRemoval puts
+# in its output names (and that downstream stages keep, ex:
+# SRR14530724.collapsed.kraken2.tsv.gz).  Anything else is "other".  Block
+# indexes (see bgzf.py), which older runs left next to the compressed files,
+# are "index".
+ROLES = [
+    "pair1",
+    "pair2",
+    "collapsed",
+    "singleton",
+    "discarded",
+    "settings",
+    "index",
+]
+
+
+def file_role(fname):
+    if fname.endswith(".gzi"):
+        return "index"
+    for token in fname.split(".")[1:]:
+        if token in ROLES:
+            return token
+    return "other"
+
+
+class SampleIndex:
+    # Maps each sample to its files, grouped by role.
+    #
+    # A file belongs to a sample if its name is the sample followed by "." or,
+    # for raw paired-end input, "_1." or "_2.".  Since sample names can't
+    # contain "." this is an exact lookup, so SRR1 never picks up SRR10's
+    # files, and building the index is linear in the number of files.
+    def __init__(self, samples, fnames):
+        self.by_sample = {sample: {} for sample in samples}
+        for fname in sorted(fnames):
+            sample = self.sample_for(fname)
+            if sample is not None:
+                self.by_sample[sample].setdefault(file_role(fname), []).append(
+                    fname
+                )
+
+    def sample_for(self, fname):
+        candidate = fname.split(".")[0]
+        if candidate in self.by_sample:
+            return candidate
+        if candidate[-2:] in ["_1", "_2"] and candidate[:-2] in self.by_sample:
+            return candidate[:-2]
+        return None
+
+    def files(self, sample, roles=None, exclude=()):
+        # Indexes are only included if asked for by role.
+        if roles is None:
+            exclude = [*exclude, "index"]
+        return sorted(
+            fname
+            for role, fnames in self.by_sample.get(sample, {}).items()
+            if (roles is None or role in roles) and role not in exclude
+            for fname in fnames
+        )
+
+    def samples(self):
+        # Samples with at least one file.
+        return [
+            sample for sample, by_role in self.by_sample.items() if by_role
+        ]
+
+    def __contains__(self, sample):
+        return bool(self.by_sample.get(sample))
@@ -0,0 +1,167 @@
+# Read counts for FASTQ files, without parsing the FASTQ.
+#
+# AdapterRemoval already counts everything it writes: the "[Length
+# distribution]" section of cleaned/<sample>.settings has, for each read
+# length, how many reads of that length went to each of its output files:
+#
+#   [Length distribution]
+#   Length  Mate1  Mate2  Singleton  Collapsed  CollapsedTruncated  ...  All
+#   0       0      0      0          0          0                        1
+#   1       0      0      0          0          0                        3
+#   ...
+#
+# (tab-separated, with Discarded before All).  When there's no settings file
+# (ex: nonhuman/ output) we count lines instead, at the byte level, which is
+# still much faster than FastqGeneralIterator.
+#
+# The clean and nonhuman stages save what they find in readcounts/, one
+# manifest per sample and directory, ex:
+#
+#   SRR14530724.cleaned.readcounts.json
+#
+# which maps each of the sample's files in that directory to its reads, bases,
+# and [length, reads] pairs.  Anything that needs read counts can look them up
+# there instead of rescanning FASTQ.
+
+import json
+import collections
+
+import numpy as np
+
+# Settings file length distribution column -> the output file it describes,
+# as the part of the filename after "<sample>."
+SETTINGS_COLUMNS = {
+    "Mate1": "pair1.truncated.gz",
+    "Mate2": "pair2.truncated.gz",
+    "Singleton": "singleton.truncated.gz",
+    "Collapsed": "collapsed.gz",
+    "CollapsedTruncated": "collapsed.truncated.gz",
+    "Discarded": "discarded.gz",
+}
+
+COUNT_CHUNK_SIZE = 1 << 20  # bytes
+
+
+def settings_fname(sample):
+    return "%s.settings" % sample
+
+
+def manifest_fname(sample, dirname):
+    return "%s.%s.readcounts.json" % (sample, dirname)
+
+
+def parse_settings(sample, lines):
+    # -> output fname -> length -> reads
+    lengths = {}
+    header = None
+    in_distribution = False
+    for line in lines:
+        line = line.rstrip("\n")
+        if line.startswith("["):
+            in_distribution = line == "[Length distribution]"
+            continue
+        if not in_distribution or not line.strip():
+            continue
+
+        row = line.split("\t")
+        if header is None:
+            header = row
+            for column in header:
+                if column in SETTINGS_COLUMNS:
+                    lengths["%s.%s" % (sample, SETTINGS_COLUMNS[column])] = (
+                        collections.Counter()
+                    )
+            continue
+
+        length = int(row[0])
+        for column, value in zip(header, row):
+            if column in SETTINGS_COLUMNS and int(value):
+                lengths["%s.%s" % (sample, SETTINGS_COLUMNS[column])][
+                    length
+                ] = int(value)
+    return lengths
+
+
+def count_reads(inf):
+    # Reads in a binary stream of uncompressed four-line FASTQ, which is what
+    # AdapterRemoval and samtools write.
+    lines = 0
+    last_byte = b"\n"
+    while True:
+        chunk = inf.read(COUNT_CHUNK_SIZE)
+        if not chunk:
+            break
+        lines += chunk.count(b"\n")
+        last_byte = chunk[-1:]
+    if last_byte != b"\n":
+        lines += 1  # no newline at the end of the file
+    return lines // 4
+
+
+def count_lengths(inf):
+    # -> length -> reads, for a binary stream of uncompressed four-line FASTQ.
+    # Sequence lengths are the distances between newlines on every fourth
+    # line, so we never make Python strings for individual records.
+    totals = np.zeros(0, dtype=np.int64)
+    carry = b""  # incomplete last line of the previous chunk
+    line_number = 0  # of the first line in carry
+    while True:
+        chunk = inf.read(COUNT_CHUNK_SIZE)
+        if not chunk:
+            break
+        data = np.frombuffer(carry + chunk, dtype=np.uint8)
+        ends = np.flatnonzero(data == ord("\n"))
+        if not len(ends):
+            carry += chunk
+            continue
+        starts = np.concatenate(([0], ends[:-1] + 1))
+        seq_lengths = (ends - starts)[(1 - line_number) % 4 :: 4]
+        counts = np.bincount(seq_lengths)
+        if len(counts) > len(totals):
+            counts[: len(totals)] += totals
+            totals = counts
+        else:
+            totals[: len(counts)] += counts
+        line_number += len(ends)
+        carry = data[ends[-1] + 1 :].tobytes()
+
+    lengths = collections.Counter(
+        {
+            length: count
+            for length, count in enumerate(totals.tolist())
+            if count
+        }
+    )
+    if carry and line_number % 4 == 1:
+        lengths[len(carry)] += 1  # no newline at the end of the file
+    return lengths
+
+
+def summarize(lengths):
+    # length -> reads to a manifest entry
+    return {
+        "reads": sum(lengths.values()),
+        "bases": sum(length * count for length, count in lengths.items()),
+        "lengths": sorted(lengths.items()),
+    }
+
+
+def write_manifest(lengths_by_fname, outf):
+    # lengths_by_fname: fname -> length -> reads
+    json.dump(
+        {
+            fname: summarize(lengths)
+            for fname, lengths in sorted(lengths_by_fname.items())
+        },
+        outf,
+    )
+
+
+def load_manifest(inf):
+    # -> fname -> {"reads": reads, "bases": bases, "lengths": length -> reads}
+    manifest = json.load(inf)
+    for entry in manifest.values():
+        entry["lengths"] = {
+            length: count for length, count in entry["lengths"]
+        }
+    return manifest
@@ -0,0 +1,278 @@
+# 64-bit hashes of read IDs, computed for many IDs at once.
+#
+# We use FNV-1a, which mixes in one byte at a time.  For a batch of IDs we go
+# position by position instead of ID by ID, so hashing a batch costs a few
+# NumPy operations per byte of the longest ID rather than a Python call per
+# ID.  IDs can come straight out of a buffer of FASTQ (see fastq.py) as start
+# and end offsets, without being sliced out first.
+#
+# The same ID always has the same hash, in any process and on any machine, so
+# hashes can be stored (ex: fastqindex.py).
+
+import math
+import itertools
+
+import numpy as np
+
+FNV_OFFSET = np.uint64(0xCBF29CE484222325)
+FNV_PRIME = np.uint64(0x100000001B3)
+
+# suffix_fingerprints mixes in each ID's length and up to this many of its
+# last bytes, and then multiplies so that every output bit depends on them.
+SUFFIX_BYTES = 8
+FINGERPRINT_MULTIPLIER = np.uint64(0x9E3779B97F4A7C15)
+
+# How many IDs encode_id_stream holds as Python objects at once.
+ENCODE_BATCH_SIZE = 65536
+
+
+def hash_bounds(array, starts, ends):
+    # Hashes of array[starts[i]:ends[i]] for each i, where array is uint8.
+    starts = np.asarray(starts, dtype=np.int64)
+    lengths = np.asarray(ends, dtype=np.int64) - starts
+    hashes = np.full(len(starts), FNV_OFFSET, dtype=np.uint64)
+    if not len(starts) or not len(array):
+        return hashes
+    for position in range(int(lengths.max())):
+        values = array[np.minimum(starts + position, len(array) - 1)]
+        mixed = (hashes ^ values.astype(np.uint64)) * FNV_PRIME
+        hashes = np.where(lengths > position, mixed, hashes)
+    return hashes
+
+
+def encode_ids(read_ids):
+    # -> (uint8 array, starts, ends) for a sequence of str or bytes IDs.
+    encoded = [
+        read_id.encode("utf-8") if isinstance(read_id, str) else read_id
+        for read_id in read_ids
+    ]
+    lengths = np.array([len(read_id) for read_id in encoded], dtype=np.int64)
+    ends = np.cumsum(lengths)
+    starts = ends - lengths
+    return np.frombuffer(b"".join(encoded), dtype=np.uint8), starts, ends
+
+
+def encode_id_stream(read_ids):
+    # Like encode_ids, for an iterable of any length (ex: a generator over a
+    # large file), only holding a batch of the IDs as Python objects at once.
+    read_ids = iter(read_ids)
+    blob = bytearray()
+    lengths = [np.zeros(0, dtype=np.int64)]
+    while batch := list(itertools.islice(read_ids, ENCODE_BATCH_SIZE)):
+        array, starts, ends = encode_ids(batch)
+        blob += array.tobytes()
+        lengths.append(ends - starts)
+    lengths = np.concatenate(lengths)
+    ends = np.cumsum(lengths)
+    starts = ends - lengths
+    return np.frombuffer(blob, dtype=np.uint8), starts, ends
+
+
+def hash_ids(read_ids):
+    return hash_bounds(*encode_ids(read_ids))
+
+
+def suffix_fingerprints(array, starts, ends):
+    # A 64-bit fingerprint of each ID array[starts[i]:ends[i]] from its length
+    # and last SUFFIX_BYTES bytes.  Read IDs mostly differ at the end (ex: the
+    # read number in SRR14530724.123456), so this tells them apart almost as
+    # well as hash_bounds, for a fixed handful of NumPy operations instead of
+    # a few per byte of the longest ID.
+    starts = np.asarray(starts, dtype=np.int64)
+    ends = np.asarray(ends, dtype=np.int64)
+    lengths = ends - starts
+    fingerprints = lengths.astype(np.uint64)
+    if not len(array):
+        return fingerprints
+    for position in range(1, SUFFIX_BYTES + 1):
+        values = array[np.maximum(ends - position, 0)].astype(np.uint64)
+        fingerprints = (fingerprints * FNV_PRIME) ^ np.where(
+            lengths >= position, values, np.uint64(0)
+        )
+    return fingerprints * FINGERPRINT_MULTIPLIER
+
+
+class BloomFilter:
+    # Answers "definitely not present" or "maybe present" for IDs, with about
+    # false_positive_rate of absent IDs answered "maybe", from their
+    # suffix_fingerprints alone.  That's cheaper than hashing every ID, so
+    # when nearly every ID checked is absent we only hash the few that pass.
+    #
+    # We use a single probe: each additional one costs about as much as the
+    # fingerprint, and with one probe the bit array needs about
+    # 1 / false_positive_rate bits per ID.
+    def __init__(self, array, starts, ends, false_positive_rate):
+        n = max(len(starts), 1)
+        num_bits = n / -math.log1p(-false_positive_rate)
+        self.bits_log2 = max(6, math.ceil(math.log2(num_bits)))
+        self.bits = np.zeros(1 << (self.bits_log2 - 3), dtype=np.uint8)
+        probe = self.probe(array, starts, ends)
+        np.bitwise_or.at(self.bits, probe >> np.uint64(3), self.masks(probe))
+
+    def probe(self, array, starts, ends):
+        return suffix_fingerprints(array, starts, ends) >> np.uint64(
+            64 - self.bits_log2
+        )
+
+    def masks(self, probe):
+        return np.left_shift(1, (probe & np.uint64(7)).astype(np.uint8))
+
+    def might_contain(self, array, starts, ends):
+        # Boolean array: False where an ID is definitely absent.
+        probe = self.probe(array, starts, ends)
+        return (self.bits[probe >> np.uint64(3)] & self.masks(probe)) != 0
+
+
+class ReadIdSet:
+    # A set of read IDs, stored as their hashes in a sorted array plus the ID
+    # bytes in one blob, instead of as Python strings.  Membership is checked
+    # for a whole batch of IDs at once: a vectorized hash and binary search,
+    # and then an exact comparison only for the IDs whose hash matched, so
+    # colliding hashes never give false positives.
+    #
+    # With a false_positive_rate, a BloomFilter screens out almost every
+    # absent ID before we hash it.  That's worth it when, as when scanning
+    # FASTQ for a few reads, nearly every ID checked is absent.
+    #
+    # read_ids may repeat IDs, and is read in batches, so it can be a stream
+    # of more IDs than would fit in memory as strings.  With
+    # keep_input_positions, input_positions[i] is the position (see
+    # positions_of_bounds) of the i-th of read_ids, so callers can key their
+    # own data by position without holding the IDs themselves.
+    def __init__(
+        self, read_ids=(), false_positive_rate=None, keep_input_positions=False
+    ):
+        array, starts, ends = encode_id_stream(read_ids)
+        hashes = hash_bounds(array, starts, ends)
+        order = np.argsort(hashes, kind="stable")
+        sorted_hashes = hashes[order]
+
+        # Drop repeated IDs.  Copies of an ID have the same hash, and the
+        # stable sort keeps them together unless a different ID has that hash
+        # too, which almost never happens.  So we compare each ID with the
+        # one before it all at once, and only sort out runs of hashes shared
+        # by different IDs one ID at a time.  first[i] is where the ID
+        # sorted at i first appears.
+        sorted_starts = starts[order]
+        sorted_lengths = (ends - starts)[order]
+        same_hash = np.flatnonzero(sorted_hashes[1:] == sorted_hashes[:-1]) + 1
+        same_id = same_hash[
+            sorted_lengths[same_hash] == sorted_lengths[same_hash - 1]
+        ]
+        lengths = sorted_lengths[same_id]
+        for position in range(int(lengths.max(initial=0))):
+            check = lengths > position
+            current = array[(sorted_starts[same_id] + position) * check]
+            previous = array[(sorted_starts[same_id - 1] + position) * check]
+            matching = ~check | (current == previous)
+            same_id = same_id[matching]
+            lengths = lengths[matching]
+        is_first = np.ones(len(order), dtype=bool)
+        is_first[same_id] = False
+        first = np.maximum.accumulate(
+            np.where(is_first, np.arange(len(order)), 0)
+        )
+
+        # Where a different ID has the same hash as the one before it.
+        shared = np.zeros(len(order), dtype=bool)
+        shared[same_hash] = True
+        shared[same_id] = False
+        for shared_hash in np.unique(sorted_hashes[shared]):
+            seen = {}
+            for i in range(
+                np.searchsorted(sorted_hashes, shared_hash, "left"),
+                np.searchsorted(sorted_hashes, shared_hash, "right"),
+            ):
+                read_id = array[
+                    sorted_starts[i] : sorted_starts[i] + sorted_lengths[i]
+                ].tobytes()
+                first[i] = seen.setdefault(read_id, i)
+        unique = first == np.arange(len(order))
+        if keep_input_positions:
+            self.input_positions = np.empty(len(order), dtype=np.int64)
+            self.input_positions[order] = (np.cumsum(unique) - 1)[first]
+        order = order[unique]
+        self.hashes = sorted_hashes[unique]
+
+        # The IDs in the same order, with ID i at
+        # blob[offsets[i]:offsets[i+1]].
+        lengths = (ends - starts)[order]
+        self.offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=self.offsets[1:])
+        self.blob = array[
+            np.repeat(starts[order] - self.offsets[:-1], lengths)
+            + np.arange(self.offsets[-1])
+        ]
+
+        self.bloom_filter = None
+        if false_positive_rate:
+            self.bloom_filter = BloomFilter(
+                self.blob,
+                self.offsets[:-1],
+                self.offsets[1:],
+                false_positive_rate,
+            )
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def id_at(self, position):
+        # As bytes.
+        return self.blob[
+            self.offsets[position] : self.offsets[position + 1]
+        ].tobytes()
+
+    def sorted_positions(self):
+        # Positions in order of their IDs' bytes, which for UTF-8 is the
+        # order of their code points, as in json.dump(..., sort_keys=True).
+        # We sort the IDs as one fixed-width array rather than as strings.
+        lengths = np.diff(self.offsets)
+        width = max(1, int(lengths.max())) if len(self) else 1
+        padded = np.zeros((len(self), width), dtype=np.uint8)
+        for column in range(width):
+            rows = np.flatnonzero(lengths > column)
+            padded[rows, column] = self.blob[self.offsets[rows] + column]
+        return np.argsort(padded.view("S%s" % width).ravel(), kind="stable")
+
+    def __iter__(self):
+        for position in range(len(self)):
+            yield self.id_at(position).decode("utf-8")
+
+    def __contains__(self, read_id):
+        return bool(self.positions([read_id])[0] >= 0)
+
+    def positions_of_bounds(self, array, starts, ends):
+        # For each ID array[starts[i]:ends[i]], its position in the set (a
+        # stable number in [0, len(self)) that callers can use to index
+        # their own arrays), or -1 if it isn't in the set.
+        positions = np.full(len(starts), -1, dtype=np.int64)
+        if not len(self) or not len(starts):
+            return positions
+        starts = np.asarray(starts, dtype=np.int64)
+        ends = np.asarray(ends, dtype=np.int64)
+        candidates = np.arange(len(starts))
+        if self.bloom_filter is not None:
+            candidates = np.flatnonzero(
+                self.bloom_filter.might_contain(array, starts, ends)
+            )
+        hashes = hash_bounds(array, starts[candidates], ends[candidates])
+        firsts = np.searchsorted(self.hashes, hashes, "left")
+        lasts = np.searchsorted(self.hashes, hashes, "right")
+        for j in np.flatnonzero(lasts > firsts).tolist():
+            i = candidates[j]
+            read_id = array[starts[i] : ends[i]].tobytes()
+            for position in range(firsts[j], lasts[j]):
+                if self.id_at(position) == read_id:
+                    positions[i] = position
+                    break
+        return positions
+
+    def positions(self, read_ids):
+        return self.positions_of_bounds(*encode_ids(read_ids))
+
+    def contains_bounds(self, array, starts, ends):
+        return self.positions_of_bounds(array, starts, ends) >= 0
+
+    def contains(self, read_ids):
+        # Boolean array: whether each of read_ids is in the set.
+        return self.positions(read_ids) >= 0
@@ -22,16 +22,40 @@
 #    ./reprocess.py \
 #        --deliveries PRJNA729801 --sample-level --max-jobs 12 \
 #        --log-prefix rl -- --stages readlengths
+#
+# Each job (a delivery, or with --sample-level a sample) runs its stages as
+# separate ./run.py --stages <stage> invocations, scheduled with
+# scheduling.Scheduler like run.py --sample-workers schedules samples: a
+# job's stage starts once the earlier stages it depends on are done for that
+# job and the cores and memory it declares in run.py's STAGE_RESOURCES fit in
+# what's left of --cpu-budget and --memory-budget-gb.  So a 28-thread
+# RiboDetector stage only holds its cores while it runs, and jobs that are
+# waiting on the network don't reserve them.  --max-jobs caps how many
+# ./run.py run at once.
+#
+# Each finished stage's input bytes and time are added to log/throughput.json
+# under its name.  We estimate how long each job will take from its stages'
+# input sizes and those rates, and start the longest jobs first, so a few huge
+# deliveries don't start last and become a long tail.
 
 import os
 import re
 import sys
+import json
+import time
 import random
 import datetime
 import argparse
+import threading
 import subprocess
+import collections
 from concurrent.futures import ThreadPoolExecutor
 
+import run
+import listing
+import storage
+import scheduling
+
 log_date = datetime.datetime.now().date().isoformat()
 log_dir = "log"
 if not os.path.exists(log_dir):
@@ -47,21 +71,153 @@ if os.path.exists(restricted_dir):
     )
 
 
-def prepare_job(delivery, log_prefix, sample, run_args):
+throughput_fname = os.path.join(log_dir, "throughput.json")
+throughput_lock = threading.Lock()
+
+Job = collections.namedtuple(
+    "Job", ["logfile", "cmd", "delivery", "sample", "stage_bytes"]
+)
+
+
+def prepare_job(delivery, log_prefix, sample, run_args, stage_bytes):
+    # stage_bytes: stage -> bytes of input the stage reads for this job
     logfile = "%s/%s.%s.%s" % (log_dir, log_date, log_prefix, delivery)
     if sample:
         logfile = "%s.%s" % (logfile, sample)
         run_args = list(run_args) + ["--sample", sample]
 
-    return logfile, ["./run.py", "--delivery", delivery, *run_args]
+    return Job(
+        logfile,
+        ["./run.py", "--delivery", delivery, *run_args],
+        delivery,
+        sample,
+        stage_bytes,
+    )
 
 
-def run_job(job):
-    logfile, cmd = job
-    with open(logfile, "w") as outf:
-        result = subprocess.run(cmd, stdout=outf, stderr=subprocess.STDOUT)
+def run_stage(job, stage):
+    start_time = time.time()
+    with open("%s.%s" % (job.logfile, stage), "w") as outf:
+        result = subprocess.run(
+            job.cmd + ["--stages", stage],
+            stdout=outf,
+            stderr=subprocess.STDOUT,
+        )
         if result.returncode != 0:
             outf.write("ERROR: %s\n" % (result.returncode))
+    if result.returncode == 0 and job.stage_bytes[stage]:
+        record_throughput(
+            stage, job.stage_bytes[stage], time.time() - start_time
+        )
+    return result.returncode == 0
+
+
+def load_throughput():
+    # stage -> {"bytes": input bytes, "seconds": seconds}, over every run of
+    # the stage that's finished.
+    try:
+        with open(throughput_fname) as inf:
+            return json.load(inf)
+    except FileNotFoundError:
+        return {}
+
+
+def record_throughput(stage, input_bytes, seconds):
+    with throughput_lock:
+        throughput = load_throughput()
+        totals = throughput.setdefault(stage, {"bytes": 0, "seconds": 0})
+        totals["bytes"] += input_bytes
+        totals["seconds"] += seconds
+        with open(throughput_fname + ".tmp", "w") as outf:
+            json.dump(throughput, outf, indent=2, sort_keys=True)
+        os.replace(throughput_fname + ".tmp", throughput_fname)
+
+
+def parse_run_args(run_args):
+    # The run.py arguments that matter for scheduling.
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument(
+        "--stages",
+        default=",".join(
+            stage
+            for stage in run.STAGES_ORDERED
+            if stage not in run.OPTIONAL_STAGES
+        ),
+    )
+    parser.add_argument("--skip-stages", default="")
+    parser.add_argument("--storage-root")
+    run_config, _ = parser.parse_known_args(run_args)
+    skipped_stages = run_config.skip_stages.split(",")
+    selected_stages = run_config.stages.split(",")
+    run_config.stages = [
+        stage
+        for stage in run.STAGES_ORDERED
+        if stage in selected_stages and stage not in skipped_stages
+    ]
+    return run_config
+
+
+# How many deliveries to list at once when sizing jobs.
+LISTING_THREADS = 16
+
+
+def input_sizes(delivery, restricted, run_config, samples):
+    # -> stage -> (total bytes of the files the stage reads, sample -> bytes).
+    # We only list the directories the stages read, not the whole delivery;
+    # block indexes don't count.
+    bucket = run.bucket_for(restricted, run_config.storage_root)
+    storage_backend = storage.open_storage(bucket)
+    stage_dirnames = {}  # stage -> dirnames
+    for stage in run_config.stages:
+        inputs, _ = run.STAGE_ARTIFACTS[stage]
+        stage_dirnames[stage] = [
+            dirname
+            for dirname in inputs
+            if not dirname.endswith(run.BLOCK_INDEX_DIR_SUFFIX)
+        ]
+
+    dir_sizes = {}  # dirname -> (total bytes, sample -> bytes)
+    for dirname in sorted(set().union(*stage_dirnames.values())):
+        sizes = {}  # fname -> bytes
+        for info in storage_backend.list(
+            "%s/%s/%s/" % (bucket, delivery, run.full_s3_dirname(dirname))
+        ):
+            sizes[info.name] = info.size
+        sample_index = listing.SampleIndex(samples, sizes)
+        sample_sizes = collections.Counter()
+        for fname, size in sizes.items():
+            sample = sample_index.sample_for(fname)
+            if sample is not None:
+                sample_sizes[sample] += size
+        dir_sizes[dirname] = sum(sizes.values()), sample_sizes
+
+    stage_sizes = {}
+    for stage, dirnames in stage_dirnames.items():
+        sample_sizes = collections.Counter()
+        for dirname in dirnames:
+            sample_sizes.update(dir_sizes[dirname][1])
+        stage_sizes[stage] = (
+            sum(dir_sizes[dirname][0] for dirname in dirnames),
+            sample_sizes,
+        )
+    return stage_sizes
+
+
+def stage_rates():
+    # stage -> bytes of input per second, for stages we've run before.
+    return {
+        stage: totals["bytes"] / totals["seconds"]
+        for stage, totals in load_throughput().items()
+        if totals["bytes"] and totals["seconds"]
+    }
+
+
+def stage_seconds(job, stage, rates):
+    # For stages we haven't run before we assume the average rate of the
+    # ones we have, or with no history at all go by input bytes alone.
+    default_rate = sum(rates.values()) / len(rates) if rates else 1
+    return job.stage_bytes[stage] / rates.get(stage, default_rate)
+
 
 def get_sample_priority(sample):
     m = re.findall(r"L00\d$", sample)
@@ -71,8 +227,12 @@ def get_sample_priority(sample):
     return m
 
 def parallelize(config, deliveries, run_args):
-    job_queue = []
+    run_config = parse_run_args(run_args)
+    if not run_config.stages:
+        print("No stages to run")
+        return
 
+    delivery_samples = {}  # delivery -> (run.py args, prioritized samples)
     for delivery in deliveries:
         args = run_args[:]
         if delivery in restricted_deliveries:
@@ -83,28 +243,142 @@ def parallelize(config, deliveries, run_args):
         else:
             raise Exception("Unknown delivery %r" % delivery)
 
+        prioritized_samples = []
+        with open(
+            os.path.join(
+                root_dir, "deliveries", delivery, "metadata", "metadata.tsv"
+            )
+        ) as inf:
+            for line in inf:
+                sample = line.strip().split()[0]
+                prioritized_samples.append(
+                    (get_sample_priority(sample), sample)
+                )
+        prioritized_samples.sort()
+        delivery_samples[delivery] = args, prioritized_samples
+
+    # Listing is mostly waiting on storage, so list deliveries in parallel.
+    with ThreadPoolExecutor(max_workers=LISTING_THREADS) as executor:
+        sizes = dict(
+            zip(
+                deliveries,
+                executor.map(
+                    lambda delivery: input_sizes(
+                        delivery,
+                        delivery in restricted_deliveries,
+                        run_config,
+                        [
+                            sample
+                            for _, sample in delivery_samples[delivery][1]
+                        ],
+                    ),
+                    deliveries,
+                ),
+            )
+        )
+
+    job_queue = []
+    for delivery in deliveries:
+        args, prioritized_samples = delivery_samples[delivery]
+        stage_sizes = sizes[delivery]
         if config.sample_level:
-            prioritized_samples = []
-            with open(os.path.join(root_dir, "deliveries", delivery,
-                                   "metadata", "metadata.tsv")) as inf:
-                for line in inf:
-                    sample = line.strip().split()[0]
-                    prioritized_samples.append(
-                        (get_sample_priority(sample), sample))
-            prioritized_samples.sort()
             for priority, sample in prioritized_samples:
-                job_queue.append(prepare_job(
-                    delivery, config.log_prefix, sample, args))
+                stage_bytes = {
+                    stage: sample_bytes[sample]
+                    for stage, (_, sample_bytes) in stage_sizes.items()
+                }
+                job_queue.append(
+                    prepare_job(
+                        delivery, config.log_prefix, sample, args, stage_bytes
+                    )
+                )
         else:
-            job_queue.append(prepare_job(
-                delivery, config.log_prefix, None, args))
+            stage_bytes = {
+                stage: delivery_bytes
+                for stage, (delivery_bytes, _) in stage_sizes.items()
+            }
+            job_queue.append(
+                prepare_job(
+                    delivery, config.log_prefix, None, args, stage_bytes
+                )
+            )
+
+    if not job_queue:
+        return
 
+    rates = stage_rates()
     if config.shuffle:
         random.shuffle(job_queue)
-            
-    with ThreadPoolExecutor(max_workers=config.max_jobs) as executor:
-        for job in job_queue:
-            executor.submit(run_job, job)
+    else:
+        # Longest first.  The sort is stable, so equal estimates keep sample
+        # priority order.
+        job_queue.sort(
+            key=lambda job: -sum(
+                stage_seconds(job, stage, rates) for stage in run_config.stages
+            )
+        )
+
+    # The scheduler starts tasks earlier in the list first, so a job's later
+    # stages keep its place in line.
+    dependencies = run.stage_dependencies(run_config.stages)
+    tasks = []
+    for i, job in enumerate(job_queue):
+        for stage in run_config.stages:
+            resources = run.stage_resources(stage)
+            tasks.append(
+                scheduling.Task(
+                    key=(i, stage),
+                    deps=[
+                        (i, dependency) for dependency in dependencies[stage]
+                    ],
+                    resource_class=resources.resource_class,
+                    cpus=resources.cpus,
+                    memory_gb=resources.memory_gb,
+                )
+            )
+
+    total_bytes = sum(sum(job.stage_bytes.values()) for job in job_queue)
+    print(
+        "%s jobs, %s stage runs, %.1f GB of stage input"
+        % (len(job_queue), len(tasks), total_bytes / 1e9)
+    )
+    if all(stage in rates for stage in run_config.stages):
+        core_seconds = sum(
+            stage_seconds(job, stage, rates) * run.stage_resources(stage).cpus
+            for job in job_queue
+            for stage in run_config.stages
+        )
+        print(
+            "Estimated %.1f hours if the CPU budget stays full"
+            % (core_seconds / config.cpu_budget / 3600)
+        )
+
+    max_workers = config.max_jobs or len(tasks)
+    scheduler = scheduling.Scheduler(
+        tasks,
+        max_workers=max_workers,
+        cpu_budget=config.cpu_budget,
+        memory_budget_gb=config.memory_budget_gb,
+        class_limits=scheduling.parse_class_limits(config.class_limits),
+    )
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        status = scheduler.run(
+            pool,
+            lambda pool, task: pool.submit(
+                run_stage, job_queue[task.key[0]], task.key[1]
+            ),
+            lambda task, future: future.result(),
+        )
+
+    failed = [
+        key for key, value in status.items() if value != scheduling.SUCCEEDED
+    ]
+    if failed:
+        print("Failed or skipped:")
+        for i, stage in sorted(failed):
+            job = job_queue[i]
+            print("  %s %s %s" % (job.delivery, job.sample or "", stage))
+        exit(1)
 
 
 def start():
@@ -120,8 +394,30 @@ def start():
         "--max-jobs",
         metavar="N",
         type=int,
-        required=True,
-        help="maximum number of jobs to run at once",
+        help="maximum number of ./run.py to run at once, in addition to "
+        "the CPU and memory budgets",
+    )
+    parser.add_argument(
+        "--cpu-budget",
+        type=int,
+        default=os.cpu_count(),
+        help="Cores running stages may use in total, going by what they "
+        "declare in run.py's STAGE_RESOURCES",
+    )
+    parser.add_argument(
+        "--memory-budget-gb",
+        type=float,
+        default=os.sysconf("SC_PAGE_SIZE")
+        * os.sysconf("SC_PHYS_PAGES")
+        / (1 << 30),
+        help="Memory running stages may use in total, going by what they "
+        "declare in run.py's STAGE_RESOURCES",
+    )
+    parser.add_argument(
+        "--class-limits",
+        default="",
+        help="How many stages of each resource class in run.py's "
+        "STAGE_RESOURCES to run at once, as class=limit pairs, ex: db=2",
     )
     parser.add_argument(
         "--log-prefix",
@@ -140,8 +436,8 @@ def start():
     parser.add_argument(
         "--shuffle",
         action="store_true",
-        help="Run jobs in random order. Allows greater parallelism if "
-        "inputs vary dramatically in size")
+        help="Run jobs in random order instead of largest first",
+    )
 
     config = parser.parse_args(our_args)
 
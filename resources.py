@@ -0,0 +1,133 @@
+# Thread counts for external tools, sized to their input and to what else is
+# running on the machine.
+#
+# Instead of always giving kraken2 or bowtie2 a fixed number of threads, a
+# stage asks for a grant before running the tool.  How many threads the tool
+# wants depends on:
+#
+#  * Its input: small inputs don't have enough work to split, so we want at
+#    most one thread per bytes_per_thread.
+#  * How well it scales: we model each tool as Amdahl's law with a parallel
+#    fraction, and stop adding threads once one more would speed it up by less
+#    than MIN_MARGINAL_SPEEDUP.
+#
+# It gets the smaller of that and the cores no other grant holds, but never
+# fewer than min_threads: run.py passes the count its stage declares in
+# STAGE_RESOURCES, which its scheduler has already set aside, so a large input
+# can grow into idle cores without a small one being starved.  Grants are
+# tracked in a file under ~/tmp/threads/, updated under a lock, so separate
+# run.py processes (ex: from reprocess.py) see each other's.  Grants from
+# processes that have exited are dropped.  A tool always gets at least one
+# thread, even when the machine is fully granted, so nothing waits.
+
+import os
+import json
+import math
+import time
+import fcntl
+import tempfile
+import contextlib
+import collections
+
+GRANTS_DIR = os.path.expanduser("~/tmp/threads/")
+GRANTS_FNAME = os.path.join(GRANTS_DIR, "grants.json")
+
+# We haven't measured how these tools scale, so the parallel fractions are
+# rough guesses, chosen so that large inputs want more threads than the
+# fixed counts we used before grants (4 for AdapterRemoval, kraken2, and
+# bowtie2, 28 for RiboDetector).  Update them as we measure.
+ToolScaling = collections.namedtuple(
+    "ToolScaling", ["parallel_fraction", "bytes_per_thread", "max_threads"]
+)
+TOOL_SCALING = {
+    "AdapterRemoval": ToolScaling(0.95, 256 << 20, 8),
+    "kraken2": ToolScaling(0.97, 256 << 20, 16),
+    "bowtie2": ToolScaling(0.97, 64 << 20, 32),
+    "ribodetector": ToolScaling(0.99, 1 << 20, 56),
+    "bowtie2-build": ToolScaling(0.99, 64 << 20, 32),
+}
+
+MIN_MARGINAL_SPEEDUP = 0.5
+
+
+def speedup(scaling, threads):
+    return 1 / (
+        (1 - scaling.parallel_fraction) + scaling.parallel_fraction / threads
+    )
+
+
+def wanted_threads(tool, input_bytes):
+    scaling = TOOL_SCALING[tool]
+    threads = 1
+    while (
+        threads < scaling.max_threads
+        and speedup(scaling, threads + 1) - speedup(scaling, threads)
+        >= MIN_MARGINAL_SPEEDUP
+    ):
+        threads += 1
+    return max(
+        1, min(threads, math.ceil(input_bytes / scaling.bytes_per_thread))
+    )
+
+
+def is_running(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass  # someone else's
+    return True
+
+
+@contextlib.contextmanager
+def locked_grants():
+    # Yields grant id -> {"pid", "tool", "threads"} for live processes, and
+    # saves any changes.
+    os.makedirs(GRANTS_DIR, exist_ok=True)
+    with open(GRANTS_FNAME + ".lock", "w") as lockf:
+        fcntl.flock(lockf, fcntl.LOCK_EX)
+        try:
+            try:
+                with open(GRANTS_FNAME) as inf:
+                    grants = json.load(inf)
+            except FileNotFoundError:
+                grants = {}
+            grants = {
+                grant_id: grant
+                for grant_id, grant in grants.items()
+                if is_running(grant["pid"])
+            }
+            yield grants
+
+            fd, tmp_fname = tempfile.mkstemp(dir=GRANTS_DIR)
+            with os.fdopen(fd, "w") as outf:
+                json.dump(grants, outf)
+            os.replace(tmp_fname, GRANTS_FNAME)
+        finally:
+            fcntl.flock(lockf, fcntl.LOCK_UN)
+
+
+@contextlib.contextmanager
+def thread_grant(tool, input_bytes, total_cores, min_threads=1):
+    # Yields how many threads to run tool with, holding them until we exit.
+    # min_threads is what the caller has already set aside for the tool.
+    wanted = max(min_threads, wanted_threads(tool, input_bytes))
+    grant_id = "%s-%s" % (os.getpid(), time.time_ns())
+    with locked_grants() as grants:
+        free = total_cores - sum(grant["threads"] for grant in grants.values())
+        threads = max(min_threads, 1, min(wanted, free))
+        grants[grant_id] = {
+            "pid": os.getpid(),
+            "tool": tool,
+            "threads": threads,
+        }
+    print(
+        "%s: %s threads (wanted %s, %s free)"
+        % (tool, threads, wanted, max(free, 0))
+    )
+    try:
+        yield threads
+    finally:
+        with locked_grants() as grants:
+            grants.pop(grant_id, None)
@@ -1,5 +1,6 @@
 #!/usr/bin/env python3
 
+import io
 import re
 import os
 import warnings
@@ -10,9 +11,15 @@ import math
 import time
 import atexit
 import argparse
+import traceback
 import tempfile
+import copy
+import functools
+import collections
+import itertools
 import contextlib
 import subprocess
+import concurrent.futures
 import numpy as np
 import random
 from collections import Counter
@@ -22,7 +29,25 @@ from Bio.SeqIO.QualityIO import FastqGeneralIterator
 from Bio.Seq import Seq
 from Bio.SeqRecord import SeqRecord
 
+import kraken
+import storage
+import bgzf
+import extsort
+import fastq
+import listing
+import taxonomy
+import krakencols
+import readcounts
+import readids
+import resources
+import scheduling
+import fastqindex
+import count_clades
+
 S3_BUCKET = None
+STORAGE = None
+LISTING_TTL = listing.DEFAULT_TTL
+LISTINGS = {}  # delivery -> listing.DeliveryListing
 WORK_ROOT = None
 THISDIR = os.path.abspath(os.path.dirname(__file__))
 
@@ -49,6 +74,12 @@ def check_output_shell(cmd):
     )
 
 
+def bucket_for(restricted, storage_root=None):
+    if storage_root:
+        return os.path.abspath(storage_root)
+    return "s3://nao-restricted" if restricted else "s3://nao-mgs"
+
+
 def work_fname(*fnames):
     return os.path.join(THISDIR, WORK_ROOT, *fnames)
 
@@ -94,47 +125,43 @@ def tempdir(stage, msg):
 
 
 def exists_s3_prefix(s3_path):
-    try:
-        subprocess.check_call(
-            ["aws", "s3", "ls", s3_path], stdout=subprocess.DEVNULL
+    return STORAGE.exists(s3_path)
+
+
+def delivery_listing(delivery):
+    if delivery not in LISTINGS:
+        LISTINGS[delivery] = listing.DeliveryListing(
+            STORAGE, "%s/%s/" % (S3_BUCKET, delivery), ttl=LISTING_TTL
         )
-        return True  # exit code 0 if present
-    except subprocess.CalledProcessError as e:
-        if e.returncode == 1:
-            return False  # exit code 1 if absent
+    return LISTINGS[delivery]
 
-        raise  # any other exit code means something else is wrong
 
+def ls_s3_infos(s3_dir):
+    # Anything within a delivery is answered from that delivery's listing, so
+    # we only list the bucket once per delivery.
+    delivery, _, path = s3_dir.removeprefix(S3_BUCKET + "/").partition("/")
+    if s3_dir.startswith(S3_BUCKET + "/") and path:
+        dirname, _, prefix = path.rpartition("/")
+        infos = delivery_listing(delivery).ls(dirname, prefix)
+    else:
+        infos = STORAGE.list(s3_dir)
 
-def ls_s3_dir(s3_dir, min_size=0, min_date=""):
-    try:
-        cmd_out = subprocess.check_output(["aws", "s3", "ls", s3_dir])
-    except subprocess.CalledProcessError as e:
-        if e.returncode == 1:
-            return []  # exit code 1 if absent or empty
-        raise  # any other exit code means something is wrong
+    for info in infos:
+        if info.name:  # skip directory markers
+            yield info
 
-    for line in cmd_out.split(b"\n"):
-        if not line.strip():
-            continue
-        if line.endswith(b"0 "):
-            continue
-        try:
-            date, time, size, fname = line.split()
-        except ValueError:
-            print(line)
-            print(s3_dir)
-            raise
 
-        if int(size) < min_size:
+def ls_s3_dir(s3_dir, min_size=0, min_date=""):
+    for info in ls_s3_infos(s3_dir):
+        if info.size < min_size:
             continue
-        if date.decode("utf-8") < min_date:
+        if info.mtime < min_date:
             continue
 
-        yield fname.decode("utf-8")
+        yield info.name
 
 
-def get_adapters(ins, adapter1_fname, adapter2_fname):
+def get_adapters(ins, adapter1_fname, adapter2_fname, threads):
     cmd = [
         "AdapterRemoval",
     ]
@@ -158,7 +185,7 @@ def get_adapters(ins, adapter1_fname, adapter2_fname):
         "--qualitymax",
         "45",  # Aviti goes up to N
         "--threads",
-        "4",
+        str(threads),
     ])
 
 
@@ -244,62 +271,110 @@ def adapter_removal(args, dirname, trim_quality, collapse):
                     ins_raw, ins):
                 s3_copy_down(args, "raw", remote_fname, local_fname=local_fname)
 
-            adapter1_fname = os.path.join(adapter_dir, "%s.fwd" % sample)
-            adapter2_fname = os.path.join(adapter_dir, "%s.rev" % sample)
+            with tool_threads(args, "clean", "AdapterRemoval", ins) as threads:
+                adapter1_fname = os.path.join(adapter_dir, "%s.fwd" % sample)
+                adapter2_fname = os.path.join(adapter_dir, "%s.rev" % sample)
 
-            if not os.path.exists(adapter1_fname) or not os.path.exists(
-                adapter2_fname
-            ):
-                get_adapters(ins, adapter1_fname, adapter2_fname)
+                if not os.path.exists(adapter1_fname) or not os.path.exists(
+                    adapter2_fname
+                ):
+                    get_adapters(ins, adapter1_fname, adapter2_fname, threads)
 
-            with open(adapter1_fname) as inf:
-                adapter1 = inf.read().strip()
-            with open(adapter2_fname) as inf:
-                adapter2 = inf.read().strip()
+                with open(adapter1_fname) as inf:
+                    adapter1 = inf.read().strip()
+                with open(adapter2_fname) as inf:
+                    adapter2 = inf.read().strip()
 
-            cmd = [
-                "AdapterRemoval",
-            ]
+                cmd = [
+                    "AdapterRemoval",
+                ]
+
+                if len(ins) == 2:
+                    cmd.extend([
+                        "--file1",
+                        ins[0],
+                        "--file2",
+                        ins[1],
+                    ])
+                elif len(ins) == 1:
+                    cmd.extend([
+                        "--interleaved-input",
+                        "--file1",
+                        ins[0]
+                    ])
+                else:
+                    assert False
 
-            if len(ins) == 2:
-                cmd.extend([
-                    "--file1",
-                    ins[0],
-                    "--file2",
-                    ins[1],
-                ])
-            elif len(ins) == 1:
                 cmd.extend([
-                    "--interleaved-input",
-                    "--file1",
-                    ins[0]
+                    "--basename",
+                    sample,
+                    "--threads",
+                    str(threads),
+                    "--qualitymax",
+                    "45",  # Aviti goes up to N
+                    "--adapter1",
+                    adapter1,
+                    "--adapter2",
+                    adapter2,
+                    "--gzip",
                 ])
-            else:
-                assert False
 
-            cmd.extend([
-                "--basename",
+                if trim_quality:
+                    cmd.extend(["--trimns", "--trimqualities"])
+                if collapse:
+                    cmd.append("--collapse")
+
+                subprocess.check_call(cmd)
+
+            if args.bgzf_cleaned:
+                for output in glob.glob("%s.*.gz" % sample):
+                    bgzf.recompress_file(output)
+
+            outputs = sorted(glob.glob("%s.*" % sample))
+            for output in outputs:
+                if not output.endswith(bgzf.INDEX_SUFFIX):
+                    s3_copy_up(args, output, dirname)
+            for output in outputs:
+                if output.endswith(bgzf.INDEX_SUFFIX):
+                    s3_copy_up(args, output, block_index_dirname(dirname))
+
+            save_read_counts(
+                args,
                 sample,
-                "--threads",
-                "4",
-                "--qualitymax",
-                "45",  # Aviti goes up to N
-                "--adapter1",
-                adapter1,
-                "--adapter2",
-                adapter2,
-                "--gzip",
-            ])
-
-            if trim_quality:
-                cmd.extend(["--trimns", "--trimqualities"])
-            if collapse:
-                cmd.append("--collapse")
-
-            subprocess.check_call(cmd)
-
-            for output in glob.glob("%s.*" % sample):
-                s3_copy_up(args, output, dirname)
+                dirname,
+                glob.glob("%s.*.gz" % sample),
+                settings=readcounts.settings_fname(sample),
+            )
+
+def save_read_counts(args, sample, dirname, fnames, settings=None):
+    # Records the read counts of the local files fnames, which we just
+    # uploaded to dirname; see readcounts.py.
+    lengths = {}
+    if settings and os.path.exists(settings):
+        with open(settings) as inf:
+            lengths = readcounts.parse_settings(sample, inf)
+    manifest = {}
+    for fname in fnames:
+        if fname not in lengths:
+            with bgzf.open(fname, "rb") as inf:
+                lengths[fname] = readcounts.count_lengths(inf)
+        manifest[fname] = lengths[fname]
+
+    manifest_fname = readcounts.manifest_fname(sample, dirname)
+    with open(manifest_fname, "w") as outf:
+        readcounts.write_manifest(manifest, outf)
+    s3_copy_up(args, manifest_fname, "readcounts")
+
+def load_read_counts(args, sample, dirname):
+    # -> fname -> {"reads": ..., "bases": ..., "lengths": ...}, or None if
+    # there's no manifest.
+    manifest_fname = readcounts.manifest_fname(sample, dirname)
+    if manifest_fname not in get_files(args, "readcounts"):
+        return None
+    with contextlib.closing(
+        s3_open(args, "readcounts", manifest_fname)
+    ) as stream:
+        return readcounts.load_manifest(stream)
 
 def clean(args):
     if is_nanopore(args):
@@ -308,10 +383,46 @@ def clean(args):
     adapter_removal(args, "cleaned", trim_quality=True, collapse=True)
 
 def full_s3_dirname(dirname):
-    if dirname in ["raw", "cleaned", "ribofrac", "nonhuman"]:
+    if dirname.endswith(BLOCK_INDEX_DIR_SUFFIX):
+        return (
+            full_s3_dirname(dirname[: -len(BLOCK_INDEX_DIR_SUFFIX)])
+            + BLOCK_INDEX_DIR_SUFFIX
+        )
+    if dirname in [
+        "raw",
+        "cleaned",
+        "ribofrac",
+        "nonhuman",
+        "readcounts",
+        "readindex",
+    ]:
         return dirname
     return "%s-%s" % (dirname, REFERENCE_SUFFIX)
 
+# Block indexes (see bgzf.py) of the files in a directory live in a sibling
+# directory, so that listing the data directory only gives data files.  Ex:
+# processed-2024-06/SRR14530724.collapsed.kraken2.tsv.gz has its index at
+# processed-2024-06-gzi/SRR14530724.collapsed.kraken2.tsv.gz.gzi.
+BLOCK_INDEX_DIR_SUFFIX = "-gzi"
+
+
+def block_index_dirname(dirname):
+    return dirname + BLOCK_INDEX_DIR_SUFFIX
+
+
+def s3_copy_up_block_index(args, local_fname, dirname, remote_fname=None):
+    # Uploads local_fname's block index, for the copy of local_fname at
+    # dirname/remote_fname.  Call after uploading the data file, so the index
+    # is never older than it.
+    if not remote_fname:
+        remote_fname = os.path.basename(local_fname)
+    s3_copy_up(
+        args,
+        local_fname + bgzf.INDEX_SUFFIX,
+        block_index_dirname(dirname),
+        remote_fname=remote_fname + bgzf.INDEX_SUFFIX,
+    )
+
 def s3_dir(args, dirname):
     return "%s/%s/%s/" % (S3_BUCKET, args.delivery, full_s3_dirname(dirname))
 
@@ -321,25 +432,21 @@ def s3_file(args, dirname, fname):
 def s3_copy_down(args, dirname, remote_fname, local_fname=None):
     if not local_fname:
         local_fname = os.path.basename(remote_fname)
-    subprocess.check_call([
-        "aws",
-        "s3",
-        "cp",
-        s3_file(args, dirname, remote_fname),
-        local_fname,
-    ])
+    STORAGE.download(s3_file(args, dirname, remote_fname), local_fname)
 
 def s3_copy_up(args, local_fname, dirname, remote_fname=None):
     if not remote_fname:
         remote_fname = os.path.basename(local_fname)
+    STORAGE.upload(local_fname, s3_file(args, dirname, remote_fname))
+    delivery_listing(args.delivery).add(
+        full_s3_dirname(dirname), remote_fname, os.path.getsize(local_fname)
+    )
 
-    subprocess.check_call([
-        "aws",
-        "s3",
-        "cp",
-        local_fname,
-        s3_file(args, dirname, remote_fname),
-    ])
+def s3_open(args, dirname, remote_fname):
+    # Streams the remote file without making a local copy.  Use with
+    # contextlib.closing(), so that if we stop reading early we also stop
+    # downloading.
+    return STORAGE.open(s3_file(args, dirname, remote_fname))
 
 
 def get_files(args, dirname, min_size=1, min_date=""):
@@ -347,12 +454,25 @@ def get_files(args, dirname, min_size=1, min_date=""):
                          min_size=min_size,
                          min_date=min_date))
 
+def get_file_mtimes(args, dirname):
+    # fname -> mtime, as "YYYY-MM-DD HH:MM:SS"
+    return {
+        info.name: info.mtime for info in ls_s3_infos(s3_dir(args, dirname))
+    }
+
+def get_sample_files(args, dirname, min_size=1, min_date=""):
+    # Like get_files, but indexed by sample and role; see listing.SampleIndex.
+    return listing.SampleIndex(
+        get_samples(args),
+        get_files(args, dirname, min_size=min_size, min_date=min_date),
+    )
+
 
 
 def ribofrac(args, subset_size=1000):
     """Fast algorithm to compute fraction of reads identified as rRNA by RiboDetector"""
 
-    available_inputs = get_files(
+    available_inputs = get_sample_files(
         args,
         no_adapters_dirname(args),
         # tiny files are empty; ignore them
@@ -360,57 +480,65 @@ def ribofrac(args, subset_size=1000):
     )
     existing_outputs = get_files(args, "ribofrac", min_date="2023-10-12")
 
-    def first_subset_fastq(file_paths, subset_size):
-        """Selects the first subset of reads from gzipped fastq files"""
-        print(
-            f"Counting reads in input and selecting the first {subset_size}..."
-        )
-        output_files = []
-        total_reads = 0
-        # Count the total number of reads only for the first input file
-        with gzip.open(file_paths[0], "rt") as f:
-            total_reads = sum(1 for _ in FastqGeneralIterator(f))
-
-        for fp in file_paths:
-            # When reads in file < subset_size, return actual number of reads in subset
-            actual_subset_size = 0
-
-            with gzip.open(fp, "rt") as f:
-                # Create an output file handle
-                output_file = fp.replace(".fq.gz", ".subset.fq")
-                with open(output_file, "w") as out_handle:
-                    for index, (title, seq, qual) in enumerate(
-                        FastqGeneralIterator(f)
-                    ):
-                        if index >= subset_size:
-                            break
-                        actual_subset_size += 1
-                        out_handle.write(
-                            "@%s\n%s\n+\n%s\n" % (title, seq, qual)
-                        )
-
-                output_files.append(output_file)
-
-        return output_files, total_reads, actual_subset_size
-
-    def file_integrity_check(filename):
-        """
-        Checks if the file exists and contains any reads.
-        If either condition fails, it raises a warning.
-        """
-        if not os.path.exists(filename):
-            warnings.warn(f"File {filename} does not exist!")
-            return False
-
-        with gzip.open(filename, "rt") as f:
-            try:
-                # Check for the first read using the iterator
-                next(FastqGeneralIterator(f))
-            except StopIteration:
-                warnings.warn(f"File {filename} contains no reads!")
-                return False
-
-        return True
+    input_sizes = {
+        info.name: info.size
+        for info in ls_s3_infos(s3_dir(args, no_adapters_dirname(args)))
+    }
+
+    def first_subset_fastq(input_fname, subset_size):
+        """Writes the first subset of reads from a remote gzipped fastq file,
+        downloading only as much of its start as that takes"""
+        print(f"Selecting the first {subset_size} reads of {input_fname}...")
+        subset_fname = input_fname.replace(".gz", ".subset.fq")
+        subset_reads = 0
+        subset_len = 0
+        with contextlib.closing(
+            storage.RangeReader(
+                STORAGE,
+                s3_file(args, no_adapters_dirname(args), input_fname),
+                input_sizes[input_fname],
+            )
+        ) as stream, bgzf.open_stream(stream, threads=1) as inf, open(
+            subset_fname, "w"
+        ) as out_handle:
+            for title, seq, qual in itertools.islice(
+                FastqGeneralIterator(inf), subset_size
+            ):
+                subset_reads += 1
+                subset_len += len(seq)
+                out_handle.write("@%s\n%s\n+\n%s\n" % (title, seq, qual))
+
+        if not subset_reads:
+            warnings.warn(f"File {input_fname} contains no reads!")
+        return subset_fname, subset_reads, subset_len
+
+    def load_total_reads(sample):
+        """Read counts for the sample's files, from the clean stage's
+        manifest or AdapterRemoval's settings file"""
+        manifest = load_read_counts(args, sample, no_adapters_dirname(args))
+        if manifest is not None:
+            return {fname: entry["reads"] for fname, entry in manifest.items()}
+
+        settings = readcounts.settings_fname(sample)
+        if settings not in available_inputs.files(sample, roles=["settings"]):
+            return {}
+        with contextlib.closing(
+            s3_open(args, no_adapters_dirname(args), settings)
+        ) as stream:
+            lengths = readcounts.parse_settings(
+                sample, io.TextIOWrapper(stream, encoding="utf-8")
+            )
+        return {
+            fname: sum(counts.values()) for fname, counts in lengths.items()
+        }
+
+    def count_total_reads(input_fname):
+        """Counts reads in a remote file without a settings file entry"""
+        print(f"Counting reads in {input_fname}...")
+        with contextlib.closing(
+            s3_open(args, no_adapters_dirname(args), input_fname)
+        ) as stream, bgzf.open_stream(stream, "rb") as inf:
+            return readcounts.count_reads(inf)
 
     for sample in get_samples(args):
         # Check for name of output file
@@ -424,13 +552,10 @@ def ribofrac(args, subset_size=1000):
         total_reads_dict = {}
         subset_reads_dict = {}
         rrna_reads_dict = {}
-        for potential_input in available_inputs:
-            if not potential_input.startswith(sample):
-                continue
-            if ".settings" in potential_input:
-                continue
-            if "discarded" in potential_input:
-                continue
+        read_counts = load_total_reads(sample)
+        for potential_input in available_inputs.files(
+            sample, exclude=["settings", "discarded"]
+        ):
             total_files_in_sample += 1
 
             # Number of output and input files must match
@@ -450,78 +575,61 @@ def ribofrac(args, subset_size=1000):
                 continue
 
             with tempdir("ribofrac", sample + " inputs") as workdir:
+                subsets = []
                 for input_fname in inputs:
-                    s3_copy_down(args, no_adapters_dirname(args), input_fname)
-
-                    # Check file integrity
-                    file_valid = file_integrity_check(input_fname)
-                    if not file_valid:
-                        empty_files_in_sample += 1
-
-                    # Ribodetector gets angry if the .fq extension isn't in the filename
-                    os.rename(
-                        input_fname, input_fname.replace(".gz", ".fq.gz")
+                    subset, subset_reads, subset_len = first_subset_fastq(
+                        input_fname, subset_size
                     )
+                    subsets.append(subset)
+                    if not subset_reads:
+                        empty_files_in_sample += 1
+                    if input_fname == inputs[0]:
+                        # For paired-end reads, counts and average length
+                        # are computed only from pair1 reads.
+                        first_subset_reads = subset_reads
+                        first_subset_len = subset_len
 
                 if total_files_in_sample == empty_files_in_sample:
                     print(f"Skipping {sample}... all files are empty.")
                     continue
 
-                # Add .fq extensions to input files
-                inputs = [i.replace(".gz", ".fq.gz") for i in inputs]
+                subset_reads_dict[inputs[0]] = first_subset_reads
+                if inputs[0] in read_counts:
+                    total_reads_dict[inputs[0]] = read_counts[inputs[0]]
+                else:
+                    total_reads_dict[inputs[0]] = count_total_reads(inputs[0])
 
-                # Get subset of inputs
-                subsets, total_reads, subset_reads = first_subset_fastq(
-                    inputs, subset_size
-                )
-                subset_reads_dict[inputs[0]] = subset_reads
-                total_reads_dict[inputs[0]] = total_reads
-
-                # Compute average read lengths. For paired-end reads, average length is
-                # computed only from pair1 reads.
-                print("Calculating average read length...")
-
-                def calculate_average_read_length(file_path):
-                    total_len = 0
-                    total_reads = 0
-                    with open(file_path, "rt") as inf:
-                        for title, sequence, quality in FastqGeneralIterator(
-                            inf
-                        ):
-                            total_len += len(sequence)
-                            total_reads += 1
-                    return round(total_len / total_reads)
-
-                avg_length = calculate_average_read_length(subsets[0])
-                print("Done. Average read length is ", avg_length)
-
-                ribodetector_cmd = [
-                    "ribodetector_cpu",
-                    "--ensure",
-                    "rrna",
-                    "--threads",
-                    "28",
-                ]
-                ribodetector_cmd.extend(["--len", str(avg_length)])
+                avg_length = round(first_subset_len / first_subset_reads)
+                print("Average read length is ", avg_length)
+
+                with tool_threads(
+                    args, "ribofrac", "ribodetector", subsets
+                ) as threads:
+                    ribodetector_cmd = [
+                        "ribodetector_cpu",
+                        "--ensure",
+                        "rrna",
+                        "--threads",
+                        str(threads),
+                    ]
+                    ribodetector_cmd.extend(["--len", str(avg_length)])
 
-                ribodetector_cmd.append("--input")
-                ribodetector_cmd.extend(subsets)
+                    ribodetector_cmd.append("--input")
+                    ribodetector_cmd.extend(subsets)
 
-                # RiboDetector outputs fastq files containing non-rRNA sequences
-                # https://github.com/hzi-bifo/RiboDetector
-                ribodetector_cmd.append("--output")
-                ribodetector_cmd.extend(tmp_fq_outputs)
+                    # RiboDetector outputs fastq files containing non-rRNA
+                    # sequences https://github.com/hzi-bifo/RiboDetector
+                    ribodetector_cmd.append("--output")
+                    ribodetector_cmd.extend(tmp_fq_outputs)
 
-                subprocess.check_call(ribodetector_cmd)
+                    subprocess.check_call(ribodetector_cmd)
 
                 # Count number of rRNA reads in subset
-                non_rrna_count = sum(
-                    1
-                    for _ in FastqGeneralIterator(
-                        open(tmp_fq_outputs[0], "rt")
-                    )
+                with open(tmp_fq_outputs[0], "rb") as inf:
+                    non_rrna_count = readcounts.count_reads(inf)
+                rrna_reads_dict[inputs[0]] = (
+                    first_subset_reads - non_rrna_count
                 )
-                rrna_reads_dict[inputs[0]] = subset_reads - non_rrna_count
         if not total_files_in_sample:
             print("%s wasn't processed by ribofrac because it's not present in cleaned" % sample)
             continue
@@ -555,7 +663,7 @@ def ribofrac(args, subset_size=1000):
             s3_copy_up(args, ribofrac_file, "ribofrac")
 
 def interpret(args):
-    available_inputs = get_files(
+    available_inputs = get_sample_files(
         args,
         final_fastq_dirname(args),
         # tiny files are empty; ignore them
@@ -564,14 +672,9 @@ def interpret(args):
     existing_outputs = get_files(args, "processed")
 
     for sample in get_samples(args):
-        for potential_input in available_inputs:
-            if not potential_input.startswith(sample):
-                continue
-            if ".settings" in potential_input:
-                continue
-            if "discarded" in potential_input:
-                continue
-
+        for potential_input in available_inputs.files(
+            sample, exclude=["settings", "discarded"]
+        ):
             output = potential_input.replace(".gz", ".kraken2.tsv")
             inputs = [potential_input]
             if ".pair1." in output:
@@ -589,177 +692,450 @@ def interpret(args):
                 for input_fname in inputs:
                     s3_copy_down(args, final_fastq_dirname(args), input_fname)
 
-                kraken_cmd = [
-                    "/home/ec2-user/kraken2-install/kraken2",
-                    "--use-names",
-                    "--output",
-                    output,
-                ]
-
-                db = "/dev/shm/kraken-db/"
-                kraken_cmd.append("--memory-mapping")
-                threads = "4"
-
-                assert os.path.exists(db)
-                kraken_cmd.append("--db")
-                kraken_cmd.append(db)
-                kraken_cmd.append("--threads")
-                kraken_cmd.append(threads)
-
-                if len(inputs) > 1:
-                    kraken_cmd.append("--paired")
-                kraken_cmd.extend(inputs)
-
-                subprocess.check_call(kraken_cmd)
-                subprocess.check_call(["gzip", output])
+                with tool_threads(
+                    args, "interpret", "kraken2", inputs
+                ) as threads:
+                    kraken_cmd = [
+                        "/home/ec2-user/kraken2-install/kraken2",
+                        "--use-names",
+                        "--output",
+                        output,
+                    ]
+
+                    db = "/dev/shm/kraken-db/"
+                    kraken_cmd.append("--memory-mapping")
+
+                    assert os.path.exists(db)
+                    kraken_cmd.append("--db")
+                    kraken_cmd.append(db)
+                    kraken_cmd.append("--threads")
+                    kraken_cmd.append(str(threads))
+
+                    if len(inputs) > 1:
+                        kraken_cmd.append("--paired")
+                    kraken_cmd.extend(inputs)
+
+                    subprocess.check_call(kraken_cmd)
+                if args.kraken_columns:
+                    sidecar = krakencols.sidecar_fname(compressed_output)
+                    krakencols.compress_kraken_output(output, sidecar)
+                capture = hv_capture_fname(compressed_output)
+                captured = args.capture_hvreads and capture_hv_matches(
+                    inputs, output, capture
+                )
+                bgzf.compress_file(output, compressed_output)
                 s3_copy_up(args, compressed_output, "processed")
+                s3_copy_up_block_index(args, compressed_output, "processed")
+                # After the kraken output, so they're never older than it.
+                if args.kraken_columns:
+                    s3_copy_up(args, sidecar, "krakencols")
+                if captured:
+                    s3_copy_up(args, capture, "hvmatches")
+
+@functools.cache
+def load_human_viruses():
+    human_viruses = {}  # taxid -> name
+    with open(os.path.join(THISDIR, "human-viruses.tsv")) as inf:
+        for line in inf:
+            taxid, name = line.strip().split("\t")
+            human_viruses[int(taxid)] = name
+    return human_viruses
 
-def cladecounts(args):
-    available_inputs = get_files(args, "processed")
-    existing_outputs = get_files(
-        args, "cladecounts", min_size=100, min_date="2023-05-19"
+
+@functools.cache
+def load_taxonomy():
+    subprocess.check_call(
+        ["bash", os.path.join(THISDIR, "download-taxonomy.sh")],
+        cwd=THISDIR,
     )
+    return taxonomy.load(os.path.join(THISDIR, "dashboard"))
 
-    for sample in get_samples(args):
-        output = "%s.tsv.gz" % sample
-        if output in existing_outputs:
-            continue
 
-        if not any(x.startswith(sample) for x in available_inputs):
-            continue
+SAMPLE_READS_TARGET_LEN = 100_000
 
-        subprocess.check_call(
-            ["./count_clades.sh",
-             S3_BUCKET,
-             args.delivery,
-             sample,
-             REFERENCE_SUFFIX]
+# How many read IDs to check against a readids.ReadIdSet at once.
+READ_ID_BATCH_SIZE = 65536
+
+# Stages whose output is computed from a single pass over kraken output, by a
+# kraken.Consumer.  When regenerating one of these, bump its min_date here.
+KRAKEN_CONSUMER_OUTPUTS = {
+    # stage: (output fname pattern, get_files filters for existing outputs)
+    "cladecounts": ("%s.tsv.gz", {"min_size": 100, "min_date": "2023-05-19"}),
+    "humanviruses": ("%s.humanviruses.tsv", {}),
+    "allmatches": ("%s.allmatches.tsv", {}),
+    "samplereads": ("%s.sr.tsv.gz", {"min_date": "2023-11-03"}),
+}
+
+
+def make_kraken_consumer(stage):
+    if stage == "cladecounts":
+        return count_clades.CladeCountsConsumer(load_taxonomy())
+    elif stage == "humanviruses":
+        return kraken.HumanVirusesConsumer(load_human_viruses())
+    elif stage == "allmatches":
+        return kraken.AllMatchesConsumer(load_human_viruses())
+    elif stage == "samplereads":
+        return kraken.SampleReadsConsumer(
+            load_taxonomy(),
+            set(load_human_viruses()),
+            SAMPLE_READS_TARGET_LEN,
         )
+    else:
+        assert False
 
 
-SAMPLE_READS_TARGET_LEN = 100_000
+def get_fresh_derived(args, dirname, derived_fname):
+    # Files in dirname made from processed/ files, named by
+    # derived_fname(kraken_fname), that are at least as new as what they were
+    # made from.
+    derived_mtimes = get_file_mtimes(args, dirname)
+    return set(
+        derived_fname(kraken_fname)
+        for kraken_fname, mtime in get_file_mtimes(args, "processed").items()
+        if derived_mtimes.get(derived_fname(kraken_fname), "") >= mtime
+    )
 
 
-def samplereads(args):
-    human_viruses = set()
-    with open(os.path.join(THISDIR, "human-viruses.tsv")) as inf:
-        for line in inf:
-            taxid, _ = line.strip().split("\t")
-            human_viruses.add(int(taxid))
+def get_fresh_sidecars(args):
+    # Columnar sidecars; see krakencols.py.
+    return get_fresh_derived(args, "krakencols", krakencols.sidecar_fname)
+
+
+def fastq_seq_id(title):
+    # The read ID kraken reports for a FASTQ record.
+    seq_id = title.split()[0]
+    if seq_id.endswith("/1") or seq_id.endswith("/2"):
+        seq_id = seq_id[:-2]
+    return seq_id
+
+
+def hv_capture_fname(kraken_fname):
+    # Reads with human virus hits, captured by interpret; see
+    # capture_hv_matches.
+    # ex: SRR14530724.collapsed.kraken2.tsv.gz ->
+    #       SRR14530724.collapsed.hvmatches.json.gz
+    return kraken_fname.replace(".kraken2.tsv.gz", ".hvmatches.json.gz")
+
+
+def capture_hv_matches(fastq_fnames, kraken_fname, capture_fname):
+    # Kraken writes one output line per input read (or pair), in input order,
+    # so we can walk interpret's local inputs in lockstep with its output and
+    # capture the reads allmatches and hvreads need without downloading and
+    # parsing the FASTQ again later.
+    #
+    # The capture is gzipped JSON lines: first fastq_fnames, then for each
+    # read allmatches would keep, [kraken line, [[seq_id, sequence, quality]
+    # for each fastq]].
+    #
+    # Returns whether the capture is complete; if the inputs and output don't
+    # line up we don't write one and later stages read the FASTQ as before.
+    matcher = kraken.AllMatchesConsumer(load_human_viruses())
+    with contextlib.ExitStack() as stack:
+        fastqs = [
+            FastqGeneralIterator(stack.enter_context(bgzf.open(fname)))
+            for fname in fastq_fnames
+        ]
+        inf = stack.enter_context(open(kraken_fname))
+        outf = stack.enter_context(gzip.open(capture_fname, "wt"))
+        json.dump(fastq_fnames, outf)
+        outf.write("\n")
+        for record in kraken.parse(inf):
+            reads = [
+                (fastq_seq_id(title), sequence, quality)
+                for title, sequence, quality in (
+                    next(fastq, (None, None, None)) for fastq in fastqs
+                )
+                if title is not None
+            ]
+            if len(reads) != len(fastqs) or any(
+                seq_id != record.read_id for seq_id, _, _ in reads
+            ):
+                break
+            if matcher.matches(record):
+                json.dump([record.line, reads], outf)
+                outf.write("\n")
+        else:
+            if all(next(fastq, None) is None for fastq in fastqs):
+                return True
 
-    parents = {}
-    with open(os.path.join(THISDIR, "dashboard", "nodes.dmp")) as inf:
-        for line in inf:
-            child_taxid, parent_taxid, *_ = line.replace("\t|\n", "").split(
-                "\t|\t"
-            )
-            parents[int(child_taxid)] = int(parent_taxid)
+    print(
+        "%s doesn't line up with %s; not capturing"
+        % (kraken_fname, ", ".join(fastq_fnames))
+    )
+    os.remove(capture_fname)
+    return False
+
+
+def load_hv_capture(args, kraken_fname):
+    # -> fastq_fnames, [(kraken line, [(seq_id, sequence, quality)])]
+    with contextlib.closing(
+        s3_open(args, "hvmatches", hv_capture_fname(kraken_fname))
+    ) as stream, bgzf.open_stream(stream) as inf:
+        fastq_fnames = json.loads(next(inf))
+        return fastq_fnames, [json.loads(line) for line in inf]
+
+
+def kraken_records(args, input_fname, fresh_sidecars):
+    # Streams the records of a processed/ file, from its columnar sidecar if
+    # it has an up-to-date one since that skips parsing text.
+    sidecar = krakencols.sidecar_fname(input_fname)
+    if sidecar in fresh_sidecars:
+        with contextlib.closing(
+            s3_open(args, "krakencols", sidecar)
+        ) as stream, gzip.open(stream, "rb") as inf:
+            yield from krakencols.records(krakencols.read_chunks(inf))
+    else:
+        with contextlib.closing(
+            s3_open(args, "processed", input_fname)
+        ) as stream, bgzf.open_stream(stream) as inf:
+            yield from kraken.parse(inf)
+
+
+def clade_partial_fname(input_fname):
+    # Per-file clade counts, in cladepartials/, that cladecounts merges.
+    # ex: SRR14530724.collapsed.kraken2.tsv.gz ->
+    #       SRR14530724.collapsed.cladecounts.tsv.gz
+    return input_fname.replace(".kraken2.tsv.gz", ".cladecounts.tsv.gz")
+
+
+def count_clade_partial(args, input_fname, fresh_sidecars):
+    # Runs in a worker process, so instead of updating the listing it returns
+    # the partial's size for the parent to record.
+    partial = clade_partial_fname(input_fname)
+    with tempdir("cladecounts", input_fname) as workdir:
+        counter = count_clades.CladeCounter(load_taxonomy())
+        for record in kraken_records(args, input_fname, fresh_sidecars):
+            counter.add_read(record.taxid, record.hits)
+        with gzip.open(partial, "wt") as outf:
+            counter.write_partial(outf)
+        STORAGE.upload(partial, s3_file(args, "cladepartials", partial))
+        return os.path.getsize(partial)
+
+
+def count_clade_partials(args, input_fnames, fresh_sidecars):
+    if not input_fnames:
+        return
 
-    def taxid_under(clade, taxid):
-        while taxid not in [0, 1]:
-            if taxid == clade:
-                return True
-            taxid = parents[taxid]
-        return False
-
-    def taxid_matches(taxid, category):
-        if category == "all":
-            return True
-        if category == "humanviral":
-            return taxid in human_viruses
-        return taxid_under(
-            {
-                "bacterial": 2,
-                "viral": 10239,
-            }[category],
-            taxid,
+    load_taxonomy()  # download and compile once, before forking
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers=min(args.clade_workers, len(input_fnames))
+    ) as pool:
+        sizes = pool.map(
+            count_clade_partial,
+            itertools.repeat(args),
+            input_fnames,
+            itertools.repeat(fresh_sidecars),
         )
+        for input_fname, size in zip(input_fnames, sizes):
+            delivery_listing(args.delivery).add(
+                full_s3_dirname("cladepartials"),
+                clade_partial_fname(input_fname),
+                size,
+            )
+
+
+def load_clade_partials(args, input_fnames, counter):
+    for input_fname in input_fnames:
+        with contextlib.closing(
+            s3_open(args, "cladepartials", clade_partial_fname(input_fname))
+        ) as stream, bgzf.open_stream(stream) as inf:
+            counter.add_partial(inf)
+
+
+def load_clade_counts(args, cladecounts_fname, counter):
+    # cladecounts/ has the same columns as a partial, though only for taxids
+    # with clade hits.
+    with contextlib.closing(
+        s3_open(args, "cladecounts", cladecounts_fname)
+    ) as stream, bgzf.open_stream(stream) as inf:
+        counter.add_partial(inf)
+
+
+def merge_clade_partials(args, input_fnames, output):
+    counter = count_clades.CladeCounter(tax=None)
+    load_clade_partials(args, input_fnames, counter)
+    with gzip.open(output, "wt") as outf:
+        counter.write(outf)
+
+
+def write_human_viruses(counter, outf):
+    # humanviruses output from clade counts: a read counts toward a human
+    # virus exactly when kraken assigned it directly to that taxid.
+    human_viruses = load_human_viruses()
+    consumer = kraken.HumanVirusesConsumer(human_viruses)
+    for taxid in human_viruses:
+        if counter.direct_assignments[taxid]:
+            consumer.counts[taxid] = counter.direct_assignments[taxid]
+    consumer.write(outf)
+
+
+def run_kraken_consumers(args, stages):
+    # Streams each of a sample's kraken output files once, feeding every
+    # record to a consumer for each of the stages whose output is missing.
+    #
+    # cladecounts is instead a merge of per-file partials, so it only needs to
+    # count files whose partials are missing or older than their kraken
+    # output.  If we're streaming the sample for other stages anyway we count
+    # them in that pass, and otherwise in parallel, one file per process.
+    # Since merging is cheap, we also regenerate cladecounts whenever any of
+    # its inputs is newer, ex: a late-arriving lane.
+    #
+    # humanviruses is a projection of the clade counts, and only falls back
+    # to reading kraken output when there aren't any.
+    available_inputs = get_sample_files(args, "processed")
+    fresh_sidecars = get_fresh_sidecars(args)
+    fresh_captures = get_fresh_derived(args, "hvmatches", hv_capture_fname)
+    existing_outputs = {
+        stage: get_files(args, stage, **KRAKEN_CONSUMER_OUTPUTS[stage][1])
+        for stage in stages
+    }
+    input_mtimes = get_file_mtimes(args, "processed")
+    partial_mtimes = get_file_mtimes(args, "cladepartials")
+    cladecounts_mtimes = get_file_mtimes(args, "cladecounts")
+    cladecounts_pattern, cladecounts_filters = KRAKEN_CONSUMER_OUTPUTS[
+        "cladecounts"
+    ]
+    valid_cladecounts = get_files(args, "cladecounts", **cladecounts_filters)
 
-    available_inputs = get_files(args, "processed")
-    existing_outputs = get_files(args, "samplereads", min_date="2023-11-03")
     for sample in get_samples(args):
-        output = "%s.sr.tsv.gz" % sample
-        if output in existing_outputs:
+        inputs = available_inputs.files(sample, exclude=["discarded"])
+        if not inputs:
             continue
 
-        inputs = [x for x in available_inputs if x.startswith(sample)]
-        if not any(inputs):
+        newest_input = max(input_mtimes[input_fname] for input_fname in inputs)
+        stale_partials = [
+            input_fname
+            for input_fname in inputs
+            if partial_mtimes.get(clade_partial_fname(input_fname), "")
+            < input_mtimes[input_fname]
+        ]
+        partials_fresh = not stale_partials
+        cladecounts_output = cladecounts_pattern % sample
+        cladecounts_fresh = (
+            cladecounts_output in valid_cladecounts
+            and cladecounts_mtimes[cladecounts_output] >= newest_input
+        )
+
+        outputs = {}  # stage -> output fname
+        for stage in stages:
+            output = KRAKEN_CONSUMER_OUTPUTS[stage][0] % sample
+            if output not in existing_outputs[stage]:
+                outputs[stage] = output
+            elif stage == "cladecounts" and not cladecounts_fresh:
+                outputs[stage] = output
+        if not outputs:
             continue
 
-        read_ids = {}
-        full_counts = Counter()
-        fname_counts = defaultdict(Counter)
+        # humanviruses is just cladecounts' direct assignments to human
+        # viruses, so if we have (or are about to make) clade counts for
+        # every file we take it from them instead of reading kraken output.
+        # Partials cover every taxid with any count, so prefer them.
+        humanviruses_source = None
+        if "humanviruses" in outputs:
+            if partials_fresh or "cladecounts" in outputs:
+                humanviruses_source = "cladepartials"
+            elif cladecounts_fresh:
+                humanviruses_source = "cladecounts"
+
+        if "cladecounts" not in outputs:
+            stale_partials = []
+
+        # If interpret captured every file's human virus matches, allmatches
+        # is just their concatenation.
+        captured = all(
+            hv_capture_fname(input_fname) in fresh_captures
+            for input_fname in inputs
+        )
 
-        for fname in inputs:
-            read_ids[fname] = {
-                "all": [],
-                "bacterial": [],
-                "viral": [],
-                "humanviral": [],
-            }
-            process = subprocess.Popen(
-                [
-                    "aws",
-                    "s3",
-                    "cp",
-                    s3_file(args, "processed", fname),
-                    "-",
-                ],
-                stdout=subprocess.PIPE,
-                shell=False,
-            )
+        consumers = {
+            stage: make_kraken_consumer(stage)
+            for stage in outputs
+            if stage != "cladecounts"
+            and not (stage == "allmatches" and captured)
+            and not (stage == "humanviruses" and humanviruses_source)
+        }
+        if not consumers:
+            count_clade_partials(args, stale_partials, fresh_sidecars)
+            stale_partials = []
+        elif stale_partials:
+            consumers["cladecounts"] = make_kraken_consumer("cladecounts")
+
+        # With every file's clade counts already in hand, samplereads knows
+        # each category's totals up front and only needs to read each file
+        # until it has that file's share of IDs.
+        if "samplereads" in consumers and partials_fresh:
+            for input_fname in inputs:
+                counter = count_clades.CladeCounter(tax=None)
+                load_clade_partials(args, [input_fname], counter)
+                consumers["samplereads"].set_file_totals(
+                    input_fname,
+                    counter.direct_assignments,
+                    counter.clade_assignments,
+                )
 
-            try:
-                with gzip.open(process.stdout, "rt") as inf:
-                    for line in inf:
-                        bits = line.rstrip("\n").split("\t")
-                        read_id = bits[1]
-                        full_assignment = bits[2]
-
-                        taxid = int(full_assignment.split()[-1].rstrip(")"))
-
-                        for category in read_ids[fname]:
-                            if taxid_matches(taxid, category):
-                                full_counts[category] += 1
-                                fname_counts[fname][category] += 1
-                                if (
-                                    len(read_ids[fname][category])
-                                    < SAMPLE_READS_TARGET_LEN
-                                ):
-                                    read_ids[fname][category].append(read_id)
-            finally:
-                process.terminate()
-
-        subsetted_ids = {}
-        for category, full_count in full_counts.items():
-            subsetted_ids[category] = []
-            for fname in read_ids:
-                if full_count <= SAMPLE_READS_TARGET_LEN:
-                    subsetted_ids[category].extend(read_ids[fname][category])
+        def named_inputs():
+            for input_fname in inputs:
+                print("%s: reading %s" % (", ".join(consumers), input_fname))
+                with contextlib.closing(
+                    kraken_records(args, input_fname, fresh_sidecars)
+                ) as records:
+                    yield input_fname, records
+
+        if consumers:
+            kraken.consume(named_inputs(), consumers.values())
+
+        with tempdir(", ".join(outputs), sample) as workdir:
+            for input_fname in stale_partials:
+                counter = consumers["cladecounts"].counters[input_fname]
+                partial = clade_partial_fname(input_fname)
+                with gzip.open(partial, "wt") as outf:
+                    counter.write_partial(outf)
+                s3_copy_up(args, partial, "cladepartials")
+
+            for stage, output in outputs.items():
+                if stage == "cladecounts":
+                    merge_clade_partials(args, inputs, output)
+                elif stage == "humanviruses" and humanviruses_source:
+                    counter = count_clades.CladeCounter(tax=None)
+                    if humanviruses_source == "cladepartials":
+                        load_clade_partials(args, inputs, counter)
+                    else:
+                        load_clade_counts(args, cladecounts_output, counter)
+                    with open(output, "w") as outf:
+                        write_human_viruses(counter, outf)
+                elif stage == "allmatches" and captured:
+                    with open(output, "w") as outf:
+                        for input_fname in inputs:
+                            _, matches = load_hv_capture(args, input_fname)
+                            for line, _ in matches:
+                                outf.write(line)
                 else:
-                    target = (
-                        SAMPLE_READS_TARGET_LEN
-                        * fname_counts[fname][category]
-                        // full_count
-                    )
+                    if output.endswith(".gz"):
+                        outf = gzip.open(output, "wt")
+                    else:
+                        outf = open(output, "w")
+                    with outf:
+                        consumers[stage].write(outf)
+                s3_copy_up(args, output, stage)
 
-                    subsetted_ids[category].extend(
-                        read_ids[fname][category][:target]
-                    )
 
-        with tempdir("samplereads", sample) as workdir:
-            with gzip.open(output, "wt") as outf:
-                for category in sorted(subsetted_ids):
-                    for selected_read_id in sorted(subsetted_ids[category]):
-                        outf.write(
-                            "%s\t%s\n" % (category[0], selected_read_id)
-                        )
+def krakenpass(args):
+    # All the stages that only need kraken output, in a single pass.
+    run_kraken_consumers(args, list(KRAKEN_CONSUMER_OUTPUTS))
+
+
+def cladecounts(args):
+    run_kraken_consumers(args, ["cladecounts"])
+
+
+def samplereads(args):
+    run_kraken_consumers(args, ["samplereads"])
 
-            s3_copy_up(args, output, "samplereads")
 
 def readlengths(args):
-    available_samplereads_inputs = get_files(args, "samplereads")
-    available_cleaned_inputs = get_files(args, final_fastq_dirname(args))
+    available_samplereads_inputs = get_sample_files(args, "samplereads")
+    available_kraken_inputs = get_sample_files(args, "processed")
+    fresh_sidecars = get_fresh_sidecars(args)
     existing_outputs = get_files(args, "readlengths", min_date="2023-11-04")
 
     for sample in get_samples(args):
@@ -767,43 +1143,43 @@ def readlengths(args):
         if output in existing_outputs:
             continue
 
-        inputs = [
-            x for x in available_samplereads_inputs if x.startswith(sample)
-        ]
+        inputs = available_samplereads_inputs.files(sample)
         if not any(inputs):
             continue
         (fname,) = inputs
 
-        target_read_ids = defaultdict(set)
-        process = subprocess.Popen(
-            [
-                "aws",
-                "s3",
-                "cp",
-                s3_file(args, "samplereads", fname),
-                "-",
-            ],
-            stdout=subprocess.PIPE,
-            shell=False,
+        category_read_ids = defaultdict(list)  # category -> [read_id]
+        with contextlib.closing(
+            s3_open(args, "samplereads", fname)
+        ) as stream, bgzf.open_stream(stream) as inf:
+            for line in inf:
+                bits = line.rstrip("\n").split("\t")
+                category, read_id = bits
+                category_read_ids[category].append(read_id)
+
+        # Targets are identified by their position in the set from here on.
+        targets = readids.ReadIdSet(
+            itertools.chain.from_iterable(category_read_ids.values()),
+            false_positive_rate=args.bloom_false_positive_rate,
         )
-        try:
-            with gzip.open(process.stdout, "rt") as inf:
-                for line in inf:
-                    bits = line.rstrip("\n").split("\t")
-                    category, read_id = bits
-                    target_read_ids[read_id].add(category)
-        finally:
-            process.terminate()
-
-        inputs = [x for x in available_cleaned_inputs if x.startswith(sample)]
-        assert inputs
-
-        lengths = {}
+        in_category = {}  # category -> bool per target
         for category in "abhv":
-            lengths[category] = {"NC": 0}
+            in_category[category] = np.zeros(len(targets), dtype=bool)
+            in_category[category][
+                targets.positions(category_read_ids.pop(category, []))
+            ] = True
+        target_lengths = np.full(len(targets), -1, dtype=np.int64)
+        remaining = len(targets)
+
+        inputs = available_kraken_inputs.files(sample, exclude=["discarded"])
+        assert inputs
 
+        # Kraken records each read's length, so we can get them from its
+        # output instead of from the much larger FASTQ.
         for fname in inputs:
-            if ".collapsed." not in fname and not is_nanopore(args):
+            if listing.file_role(fname) != "collapsed" and not is_nanopore(
+                args
+            ):
                 # We can only get fragment lengths from cases where we could
                 # collapse.  Fragments longer than fwd + rev - minoverlap could be
                 # any length for all we know.
@@ -812,39 +1188,37 @@ def readlengths(args):
                 # that's a ton of work)
                 continue
 
-            process = subprocess.Popen(
-                [
-                    "aws",
-                    "s3",
-                    "cp",
-                    s3_file(args, final_fastq_dirname(args), fname),
-                    "-",
-                ],
-                stdout=subprocess.PIPE,
-                shell=False,
-            )
-            try:
-                with gzip.open(process.stdout, "rt") as inf:
-                    for title, sequence, quality in FastqGeneralIterator(inf):
-                        title = title.split()[0]
-                        if title not in target_read_ids:
-                            continue
-
-                        for category in target_read_ids[title]:
-                            seql = len(sequence)
-                            if seql not in lengths[category]:
-                                lengths[category][seql] = 1
-                            else:
-                                lengths[category][seql] += 1
-
-                        del target_read_ids[title]
-            finally:
-                process.terminate()
+            if not remaining:
+                break
+
+            with contextlib.closing(
+                kraken_records(args, fname, fresh_sidecars)
+            ) as records:
+                while remaining:
+                    batch = list(itertools.islice(records, READ_ID_BATCH_SIZE))
+                    if not batch:
+                        break
+                    positions = targets.positions(
+                        [record.read_id for record in batch]
+                    )
+                    for i in np.flatnonzero(positions >= 0).tolist():
+                        if target_lengths[positions[i]] < 0:
+                            target_lengths[positions[i]] = int(
+                                batch[i].lengths
+                            )
+                            remaining -= 1
 
-        # We removed as we went, so any left here are non-collapsed
-        for target_read_id, categories in target_read_ids.items():
-            for category in categories:
-                lengths[category]["NC"] += 1
+        lengths = {}
+        for category in "abhv":
+            lengths[category] = {}
+            found = in_category[category] & (target_lengths >= 0)
+            # Any not found are non-collapsed
+            lengths[category]["NC"] = int(
+                np.count_nonzero(in_category[category] & ~found)
+            )
+            counts = np.bincount(target_lengths[found])
+            for seql in np.flatnonzero(counts).tolist():
+                lengths[category][seql] = int(counts[seql])
 
         with tempdir("readlengths", sample) as workdir:
             with gzip.open(output, "wt") as outf:
@@ -854,103 +1228,10 @@ def readlengths(args):
 
 
 def humanviruses(args):
-    human_viruses = {}
-    with open(os.path.join(THISDIR, "human-viruses.tsv")) as inf:
-        for line in inf:
-            taxid, name = line.strip().split("\t")
-            human_viruses[int(taxid)] = name
-
-    available_inputs = get_files(args, "processed")
-    existing_outputs = get_files(args, "humanviruses")
-
-    for sample in get_samples(args):
-        output = "%s.humanviruses.tsv" % sample
-        if output in existing_outputs:
-            continue
-
-        inputs = [
-            input_fname
-            for input_fname in available_inputs
-            if input_fname.startswith(sample)
-        ]
-        if not inputs:
-            continue
-
-        counts = Counter()
-
-        for input_fname in inputs:
-            with tempdir("humanviruses", sample) as workdir:
-                s3_copy_down(args, "processed", input_fname)
-
-                with gzip.open(input_fname, "rt") as inf:
-                    for line in inf:
-                        (taxid,) = re.findall("[(]taxid ([0-9]+)[)]", line)
-                        taxid = int(taxid)
-                        if taxid in human_viruses:
-                            counts[taxid] += 1
-
-        with tempdir("humanviruses", sample) as workdir:
-            with open(output, "w") as outf:
-                for taxid, count in sorted(counts.items()):
-                    outf.write(
-                        "%s\t%s\t%s\n" % (taxid, count, human_viruses[taxid])
-                    )
-
-            s3_copy_up(args, output, "humanviruses")
+    run_kraken_consumers(args, ["humanviruses"])
 
 def allmatches(args):
-    human_viruses = {}
-    with open(os.path.join(THISDIR, "human-viruses.tsv")) as inf:
-        for line in inf:
-            taxid, name = line.strip().split("\t")
-            human_viruses[int(taxid)] = name
-
-    available_inputs = get_files(args, "processed")
-    existing_outputs = get_files(args, "allmatches")
-
-    for sample in get_samples(args):
-        output = "%s.allmatches.tsv" % sample
-        if output in existing_outputs:
-            continue
-
-        inputs = [
-            input_fname
-            for input_fname in available_inputs
-            if input_fname.startswith(sample)
-        ]
-        if not inputs:
-            continue
-
-        with tempdir("allmatches", sample) as workdir:
-            kept = []
-            for input_fname in inputs:
-                s3_copy_down(args, "processed", input_fname)
-
-                with gzip.open(input_fname, "rt") as inf:
-                    for line in inf:
-                        keep = False
-                        try:
-                            taxid_matches = line.strip().split("\t")[4]
-                            for taxid_match in taxid_matches.split(" "):
-                                taxid, n_kmers = taxid_match.split(":")
-                                if taxid == "A":
-                                    continue  # ambiguous nucleotide
-                                if taxid == "|":
-                                    continue  # paired end transition
-                                taxid = int(taxid)
-                                if taxid in human_viruses:
-                                    keep = True
-                        except Exception:
-                            print(line)
-                            raise
-                        if keep:
-                            kept.append(line)
-
-            with open(output, "w") as outf:
-                for line in kept:
-                    outf.write(line)
-
-            s3_copy_up(args, output, "allmatches")
+    run_kraken_consumers(args, ["allmatches"])
 
 def valreads(args):
     # The subset of hvreads where that pass an alignment threshold.
@@ -975,21 +1256,28 @@ def valreads(args):
             s3_copy_down(args, "hvreads", input_hvreads_fname)
             s3_copy_down(args, "alignments2", input_alignments2_fname)
 
-            accepted_read_ids = set()
-            with gzip.open(input_alignments2_fname, "rt") as inf:
+            def accepted_alignments(inf):
                 for line in inf:
                     (query_name, genomeid, taxid, cigarstring, ref_start,
                      as_val, query_len) = line.rstrip("\n").split("\t")
 
                     length_adjusted_score = int(as_val) / math.log(int(query_len))
                     if length_adjusted_score > 20:
-                        accepted_read_ids.add(query_name)
+                        yield query_name
+
+            with bgzf.open(input_alignments2_fname) as inf:
+                accepted_read_ids = readids.ReadIdSet(
+                    accepted_alignments(inf)
+                )
 
-            valreads_out = {}
             with open(input_hvreads_fname) as inf:
-               for read_id, record in json.load(inf).items():
-                   if read_id in accepted_read_ids:
-                       valreads_out[read_id] = record
+                hv_reads = json.load(inf)
+            valreads_out = {}
+            for read_id, accepted in zip(
+                hv_reads, accepted_read_ids.contains(list(hv_reads))
+            ):
+                if accepted:
+                    valreads_out[read_id] = hv_reads[read_id]
 
             with open(output, "w") as outf:
                 json.dump(valreads_out, outf)
@@ -1019,7 +1307,7 @@ def tmpvalreads(args):
             s3_copy_down(args, "alignments2", input_alignments2_fname)
 
             read_scores = defaultdict(float)
-            with gzip.open(input_alignments2_fname, "rt") as inf:
+            with bgzf.open(input_alignments2_fname) as inf:
                 for line in inf:
                     (query_name, genomeid, taxid, cigarstring, ref_start,
                      as_val, query_len) = line.rstrip("\n").split("\t")
@@ -1041,7 +1329,9 @@ def tmpvalreads(args):
 
 def hvreads(args):
     available_inputs = get_files(args, "allmatches")
-    available_cleaned_inputs = get_files(
+    available_kraken_inputs = get_sample_files(args, "processed")
+    fresh_captures = get_fresh_derived(args, "hvmatches", hv_capture_fname)
+    available_cleaned_inputs = get_sample_files(
         args,
         final_fastq_dirname(args),
         # tiny files are empty; ignore them
@@ -1064,57 +1354,321 @@ def hvreads(args):
         if input_fname not in available_inputs:
             continue
 
-        all_matches = [
-            x.strip().split("\t")
-
-            for x in subprocess.check_output(
-                [
-                    "aws",
-                    "s3",
-                    "cp",
-                    s3_file(args, "allmatches", input_fname),
-                    "-",
-                ]
+        # Where interpret captured the matching reads from a file it
+        # classified, we don't need to read that FASTQ.
+        capture_inputs = [
+            kraken_input
+            for kraken_input in available_kraken_inputs.files(
+                sample, exclude=["discarded"]
             )
-            .decode("utf-8")
-            .split("\n")
-            if x.strip()
+            if hv_capture_fname(kraken_input) in fresh_captures
         ]
 
-        seqs = {}  # seqid -> kraken_assignment, kraken_hits, fwd, rev
-        for _, seq_id, kraken_assignment, _, kraken_details in all_matches:
-            assignment_taxid = int(
-                re.search(r"\(taxid (\d+)\)", kraken_assignment).group(1)
+        cleaned_inputs = available_cleaned_inputs.files(
+            sample, exclude=["settings"]
+        )
+
+        with tempdir("hvreads", output) as workdir:
+            with contextlib.closing(
+                s3_open(args, "allmatches", input_fname)
+            ) as stream, open(output, "w") as outf:
+                all_matches = io.TextIOWrapper(stream, encoding="utf-8")
+                if args.hvreads_memory_mb:
+                    write_hvreads_external(
+                        args,
+                        all_matches,
+                        cleaned_inputs,
+                        capture_inputs,
+                        workdir,
+                        outf,
+                    )
+                else:
+                    write_hvreads(
+                        args, all_matches, cleaned_inputs, capture_inputs, outf
+                    )
+            s3_copy_up(args, output, "hvreads")
+
+def parse_all_matches(lines):
+    # Yields (seq_id, [assignment taxid, kraken hits]) for each allmatches
+    # line.
+    for line in lines:
+        if not line.strip():
+            continue
+        _, seq_id, kraken_assignment, _, kraken_details = (
+            line.strip().split("\t")
+        )
+        assignment_taxid = int(
+            re.search(r"\(taxid (\d+)\)", kraken_assignment).group(1)
+        )
+        yield seq_id, [assignment_taxid, kraken_details]
+
+def hv_matching_reads(args, cleaned_inputs, capture_inputs, targets):
+    # Yields (cleaned fname, seq_id, sequence, quality) for the reads in
+    # cleaned_inputs whose IDs are in targets, a readids.ReadIdSet, going
+    # through the files in sorted order so a read's mates always come in the
+    # same order.  Reads of FASTQ that capture_inputs' captures cover come
+    # from the captures, and the rest from the FASTQ itself.
+    captured = {}  # fastq fname -> [(seq_id, sequence, quality)]
+    for kraken_input in capture_inputs:
+        fastq_fnames, matches = load_hv_capture(args, kraken_input)
+        for i, fastq_fname in enumerate(fastq_fnames):
+            captured[fastq_fname] = [read[i] for _, read in matches]
+
+    dirname = final_fastq_dirname(args)
+    for cleaned_input in sorted(cleaned_inputs):
+        if cleaned_input in captured:
+            reads = captured.pop(cleaned_input)
+            wanted = targets.contains([seq_id for seq_id, _, _ in reads])
+            for j in np.flatnonzero(wanted).tolist():
+                yield (cleaned_input, *reads[j])
+            continue
+
+        source = read_index_source(args, dirname, cleaned_input)
+        if source:
+            for title, sequence, quality in fetch_file_reads(
+                args, source, cleaned_input, targets
+            ):
+                yield cleaned_input, fastq_seq_id(title), sequence, quality
+            continue
+
+        with tempdir("hvreads", cleaned_input) as workdir:
+            s3_copy_down(args, dirname, cleaned_input)
+            with bgzf.open(cleaned_input, "rb") as inf:
+                for title, sequence, quality in fastq.filter_records(
+                    inf, targets, processes=args.fastq_workers
+                ):
+                    yield (
+                        cleaned_input,
+                        fastq_seq_id(title),
+                        sequence,
+                        quality,
+                    )
+
+def write_hvreads(args, all_matches, cleaned_inputs, capture_inputs, outf):
+    # Writes seq_id -> [assignment taxid, kraken hits, [sequence, quality],
+    # ...] as JSON, sorted by seq_id.  Entries are kept by the read ID's
+    # position in targets, so each ID is only held once, as bytes.
+    details = []  # by allmatches line
+
+    def seq_ids():
+        for seq_id, line_details in parse_all_matches(all_matches):
+            details.append(line_details)
+            yield seq_id
+
+    targets = readids.ReadIdSet(
+        seq_ids(),
+        false_positive_rate=args.bloom_false_positive_rate,
+        keep_input_positions=True,
+    )
+    # Like dict(), keep the last line for each read ID.
+    entries = [None] * len(targets)
+    for line_number, position in enumerate(targets.input_positions):
+        entries[position] = details[line_number]
+    del details, targets.input_positions
+
+    reads = hv_matching_reads(args, cleaned_inputs, capture_inputs, targets)
+    while batch := list(itertools.islice(reads, READ_ID_BATCH_SIZE)):
+        positions = targets.positions([seq_id for _, seq_id, _, _ in batch])
+        for position, (_, _, sequence, quality) in zip(
+            positions.tolist(), batch
+        ):
+            entries[position].append([sequence, quality])
+
+    outf.write("{")
+    for i, position in enumerate(targets.sorted_positions()):
+        if i:
+            outf.write(", ")
+        outf.write(
+            "%s: %s"
+            % (
+                json.dumps(targets.id_at(position).decode("utf-8")),
+                json.dumps(entries[position]),
             )
+        )
+    outf.write("}")
+
+def write_hvreads_external(
+    args, all_matches, cleaned_inputs, capture_inputs, workdir, outf
+):
+    # Writes the same JSON as write_hvreads, keeping about
+    # --hvreads-memory-mb of allmatches lines and reads in memory at once.
+    #
+    # We sort allmatches by read ID on disk (see extsort.py), and then take
+    # it in runs of IDs small enough to hold.  For each run we pull out
+    # those IDs' reads, sort them on disk too, and merge-join the two sorted
+    # streams into the output.  Usually one run covers everything; each
+    # additional run means reading the FASTQ again.
+    budget = args.hvreads_memory_mb << 20
+    matches = extsort.RunWriter(workdir, "allmatches", budget // 4)
+    for line_number, (seq_id, details) in enumerate(
+        parse_all_matches(all_matches)
+    ):
+        matches.add([seq_id, line_number], details)
+    # Like dict(), keep the last line for each read ID.
+    sorted_matches = (
+        (seq_id, details[-1])
+        for seq_id, details in extsort.group_by_first(matches.sorted_items())
+    )
 
-            seqs[seq_id] = [assignment_taxid, kraken_details]
-        for cleaned_input in sorted(available_cleaned_inputs):
-            if not cleaned_input.startswith(sample):
-                continue
-            if ".settings" in cleaned_input:
+    outf.write("{")
+    first_entry = True
+    while True:
+        chunk = []
+        chunk_bytes = 0
+        for seq_id, details in sorted_matches:
+            chunk.append((seq_id, details))
+            chunk_bytes += len(seq_id) + len(details[1])
+            if chunk_bytes >= budget // 4:
+                break
+        if not chunk:
+            break
+
+        targets = readids.ReadIdSet(
+            (seq_id for seq_id, _ in chunk),
+            false_positive_rate=args.bloom_false_positive_rate,
+        )
+        reads = extsort.RunWriter(workdir, "reads", budget // 4)
+        for read_number, (_, seq_id, sequence, quality) in enumerate(
+            hv_matching_reads(args, cleaned_inputs, capture_inputs, targets)
+        ):
+            # hv_matching_reads decides the order of each read's mates, going
+            # through the files in sorted order, and write_hvreads appends
+            # them as they come; sorting on when we got them keeps that.
+            reads.add([seq_id, read_number], [sequence, quality])
+        sorted_reads = extsort.group_by_first(reads.sorted_items())
+        next_reads = next(sorted_reads, None)
+
+        for seq_id, details in chunk:
+            entry = list(details)
+            while next_reads is not None and next_reads[0] <= seq_id:
+                if next_reads[0] == seq_id:
+                    entry.extend(next_reads[1])
+                next_reads = next(sorted_reads, None)
+            if not first_entry:
+                outf.write(", ")
+            first_entry = False
+            outf.write("%s: %s" % (json.dumps(seq_id), json.dumps(entry)))
+    outf.write("}")
+
+
+def readindex(args):
+    # Optional: read ID indexes for the FASTQ going into kraken, so that
+    # fetch_reads can pull out a few reads without reading whole files.
+    # Files that aren't BGZF with an up-to-date block index (ex: cleaned
+    # without --bgzf-cleaned) get a BGZF copy in readindex/ next to their
+    # index, and their originals are left alone.
+    dirname = final_fastq_dirname(args)
+    if dirname == "raw":
+        return  # not ours to recompress
+
+    available_inputs = get_sample_files(args, dirname, min_size=100)
+    input_mtimes = get_file_mtimes(args, dirname)
+    index_mtimes = get_file_mtimes(args, block_index_dirname(dirname))
+    output_mtimes = get_file_mtimes(args, "readindex")
+
+    for sample in get_samples(args):
+        for input_fname in available_inputs.files(
+            sample, exclude=["settings"]
+        ):
+            output = fastqindex.index_fname(input_fname)
+            input_mtime = input_mtimes[input_fname]
+            if output_mtimes.get(output, "") >= input_mtime:
                 continue
 
-            with tempdir("hvreads", cleaned_input) as workdir:
-                s3_copy_down(args, final_fastq_dirname(args), cleaned_input)
-                with gzip.open(cleaned_input, "rt") as inf:
-                    for title, sequence, quality in FastqGeneralIterator(inf):
-                        seq_id = title.split()[0]
-                        if seq_id.endswith("/1") or seq_id.endswith("/2"):
-                            seq_id = seq_id[:-2]
-                        if seq_id in seqs:
-                            seqs[seq_id].append([sequence, quality])
+            with tempdir("readindex", input_fname) as workdir:
+                s3_copy_down(args, dirname, input_fname)
+                gzi = input_fname + bgzf.INDEX_SUFFIX
+                if index_mtimes.get(gzi, "") >= input_mtime:
+                    s3_copy_down(args, block_index_dirname(dirname), gzi)
+                else:
+                    bgzf.recompress_file(input_fname)
+                    s3_copy_up(args, input_fname, "readindex")
+                    s3_copy_up_block_index(args, input_fname, "readindex")
+
+                fastqindex.build_index(input_fname, output)
+                s3_copy_up(args, output, "readindex")
+
+
+def read_index_source(args, dirname, fname):
+    # The directory holding the BGZF copy of dirname/fname that its read ID
+    # index covers: dirname itself if the file was already BGZF, otherwise
+    # readindex/.  None if there's no index, or if the index, the copy, or
+    # the copy's block index is older than the file, since then offsets
+    # would point at the wrong reads.
+    data_mtime = get_file_mtimes(args, dirname).get(fname)
+    readindex_mtimes = get_file_mtimes(args, "readindex")
+    ridx_mtime = readindex_mtimes.get(fastqindex.index_fname(fname), "")
+    if data_mtime is None or ridx_mtime < data_mtime:
+        return None
+
+    for source, source_mtime in [
+        (dirname, data_mtime),
+        ("readindex", readindex_mtimes.get(fname, "")),
+    ]:
+        if source_mtime < data_mtime:
+            continue
+        gzi_mtime = get_file_mtimes(args, block_index_dirname(source)).get(
+            fname + bgzf.INDEX_SUFFIX, ""
+        )
+        if gzi_mtime >= source_mtime and ridx_mtime >= source_mtime:
+            return source
+    return None
+
+
+def fetch_file_reads(args, dirname, fname, read_ids):
+    # Yields (title, sequence, quality) for the reads in the remote file
+    # whose IDs are in read_ids, in file order, reading only the blocks that
+    # hold them.  dirname is from read_index_source.
+    url = s3_file(args, dirname, fname)
+
+    def read_range(start, end):
+        with contextlib.closing(STORAGE.open(url, start, end)) as inf:
+            return inf.read()
+
+    with contextlib.closing(
+        s3_open(args, block_index_dirname(dirname), fname + bgzf.INDEX_SUFFIX)
+    ) as inf:
+        offsets = bgzf.parse_index(inf.read())
+    bgzf_file = bgzf.BgzfFile(read_range, offsets)
+
+    with tempfile.TemporaryDirectory(
+        dir=os.path.expanduser("~/tmp/")
+    ) as workdir:
+        index_fname = os.path.join(
+            workdir, fastqindex.index_fname(fname)
+        )
+        STORAGE.download(
+            s3_file(
+                args, "readindex", fastqindex.index_fname(fname)
+            ),
+            index_fname,
+        )
+        index = fastqindex.load_index(index_fname)
+        yield from fastqindex.fetch_records(bgzf_file, index, read_ids)
+
+
+def fetch_reads(args, sample, read_ids):
+    # Yields (fname, title, sequence, quality) for the sample's reads whose
+    # IDs are in read_ids, using the read ID indexes.
+    dirname = final_fastq_dirname(args)
+    for fname in get_sample_files(args, dirname, min_size=100).files(
+        sample, exclude=["settings"]
+    ):
+        source = read_index_source(args, dirname, fname)
+        if not source:
+            raise Exception("%s has no up-to-date read index" % fname)
+        for title, sequence, quality in fetch_file_reads(
+            args, source, fname, read_ids
+        ):
+            yield fname, title, sequence, quality
 
-        with tempdir("hvreads", output) as workdir:
-            with open(output, "w") as outf:
-                json.dump(seqs, outf, sort_keys=True)
-            s3_copy_up(args, output, "hvreads")
 
 DB_DIR="/dev/shm/bowtie-db"
 def nonhuman(args):
     if not rm_human(args):
         return
 
-    available_inputs = get_files(
+    available_inputs = get_sample_files(
         args,
         no_adapters_dirname(args),
         # tiny files are empty; ignore them
@@ -1129,44 +1683,55 @@ def nonhuman(args):
             continue
 
         with tempdir("nonhuman", sample) as workdir:
-            for potential_input in available_inputs:
-                if not potential_input.startswith(sample):
-                    continue
+            for potential_input in available_inputs.files(sample):
                 s3_copy_down(args, no_adapters_dirname(args), potential_input)
 
                 local_output="nonhuman.fastq.gz"
-                subprocess.check_call([
-                    "/home/ec2-user/bowtie2-2.5.2-linux-x86_64/bowtie2",
-                    "-x", "%s/chm13.draft_v1.0_plusY" % DB_DIR,
-                    "--threads", "4", "--mm",
-                    "-U", potential_input,
-                    "--un-gz", local_output,
-                    "-S", "/dev/null",
+                with tool_threads(
+                    args, "nonhuman", "bowtie2", [potential_input]
+                ) as threads:
+                    subprocess.check_call([
+                        "/home/ec2-user/bowtie2-2.5.2-linux-x86_64/bowtie2",
+                        "-x", "%s/chm13.draft_v1.0_plusY" % DB_DIR,
+                        "--threads", str(threads), "--mm",
+                        "-U", potential_input,
+                        "--un", "nonhuman.fastq",
+                        "-S", "/dev/null",
 
-                    # Tweak the settings because we're running Nanopore
+                        # Tweak the settings because we're running Nanopore
 
-                    # allow more mismatches
-                    "--score-min", "L,0,-0.6",
+                        # allow more mismatches
+                        "--score-min", "L,0,-0.6",
 
-                    # shorter seed length
-                    "-L", "15",
+                        # shorter seed length
+                        "-L", "15",
 
-                    # more frequent reseeding
-                    "-i", "S,1,0.5",
+                        # more frequent reseeding
+                        "-i", "S,1,0.5",
 
-                    # allow one mismatch in the seed alignment
-                    "-N", "1",
+                        # allow one mismatch in the seed alignment
+                        "-N", "1",
 
-                    # less stringent gap penalties
-                    "--rdg", "5,3",  # read gap and open
-                    "--rfg", "5,3",  # reference gap and open
+                        # less stringent gap penalties
+                        "--rdg", "5,3",  # read gap and open
+                        "--rfg", "5,3",  # reference gap and open
 
-                ])
+                    ])
 
+                bgzf.compress_file("nonhuman.fastq", local_output)
                 s3_copy_up(args, local_output, "nonhuman", remote_fname=output)
+                with open("nonhuman.fastq", "rb") as inf:
+                    lengths = readcounts.count_lengths(inf)
+                manifest = readcounts.manifest_fname(sample, "nonhuman")
+                with open(manifest, "w") as outf:
+                    readcounts.write_manifest({output: lengths}, outf)
+                s3_copy_up(args, manifest, "readcounts")
+                s3_copy_up_block_index(
+                    args, local_output, "nonhuman", remote_fname=output
+                )
 
 def alignments2(args):
-    available_inputs = get_files(
+    available_inputs = get_sample_files(
         args,
         "hvreads",
         # tiny files are empty; ignore them
@@ -1188,9 +1753,7 @@ def alignments2(args):
         with tempdir("alignments2", sample) as workdir:
             tmp_outputs = []
             any_output = False
-            for potential_input in available_inputs:
-                if not potential_input.startswith(sample):
-                    continue
+            for potential_input in available_inputs.files(sample):
                 any_output = True
 
                 tmp_output = potential_input.replace(
@@ -1235,41 +1798,47 @@ def alignments2(args):
                 if not any_paired and not any_collapsed:
                     continue
 
-                cmd = [
-                    "/home/ec2-user/bowtie2-2.5.2-linux-x86_64/bowtie2"
-                ]
-                cmd.extend(["--threads", "4", "--mm"])
-
-                cmd.extend(["--no-unal",
-                            "--no-sq",
-                            "-S", tmp_output])
-
-                # Custom-built HV DB
-                cmd.extend(
-                    ["-x", "%s/human-viruses" % DB_DIR])
-                # When identifying HV reads use looser settings and
-                # filter more later.
-                cmd.extend(
-                    ["--local", "--very-sensitive-local",
-                     "--score-min", "G,1,0",
-                     "--mp", "4,1"])
-
-                if any_paired:
-                    cmd.extend([
-                        "-1", "pair1.fastq",
-                        "-2", "pair2.fastq",
-                    ])
-                if any_collapsed:
-                    cmd.extend(["-U", "collapsed.fastq"])
-
-                subprocess.check_call(cmd)
+                with tool_threads(
+                    args,
+                    "alignments2",
+                    "bowtie2",
+                    ["pair1.fastq", "pair2.fastq", "collapsed.fastq"],
+                ) as threads:
+                    cmd = [
+                        "/home/ec2-user/bowtie2-2.5.2-linux-x86_64/bowtie2"
+                    ]
+                    cmd.extend(["--threads", str(threads), "--mm"])
+
+                    cmd.extend(["--no-unal",
+                                "--no-sq",
+                                "-S", tmp_output])
+
+                    # Custom-built HV DB
+                    cmd.extend(
+                        ["-x", "%s/human-viruses" % DB_DIR])
+                    # When identifying HV reads use looser settings and
+                    # filter more later.
+                    cmd.extend(
+                        ["--local", "--very-sensitive-local",
+                         "--score-min", "G,1,0",
+                         "--mp", "4,1"])
+
+                    if any_paired:
+                        cmd.extend([
+                            "-1", "pair1.fastq",
+                            "-2", "pair2.fastq",
+                        ])
+                    if any_collapsed:
+                        cmd.extend(["-U", "collapsed.fastq"])
+
+                    subprocess.check_call(cmd)
 
                 tmp_outputs.append(tmp_output)
 
             if not any_output:
                 continue
 
-            with gzip.open(combined_output_compressed, "wt") as outf:
+            with bgzf.open(combined_output_compressed, "wt") as outf:
                 for tmp_output in tmp_outputs:
                     with open(tmp_output) as inf:
                         for line in inf:
@@ -1310,6 +1879,9 @@ def alignments2(args):
                             )
 
             s3_copy_up(args, combined_output_compressed, "alignments2")
+            s3_copy_up_block_index(
+                args, combined_output_compressed, "alignments2"
+            )
 
 def phred_to_q(phred_score):
     return ord(phred_score) - ord("!")
@@ -1326,6 +1898,47 @@ def average_quality(phred_counts):
     return round(np.average(xs, weights=weights))
 
 
+def delivery_read_count(delivery, samples):
+    # Reads going into kraken, summed over samples with read count manifests,
+    # or None if none have them.
+    manifest_fnames = {}  # sample -> manifest
+    available = set(
+        ls_s3_dir(
+            "%s/%s/%s/" % (S3_BUCKET, delivery, full_s3_dirname("readcounts"))
+        )
+    )
+    for sample in samples:
+        # If we removed human reads, count what's left.
+        for dirname in ["nonhuman", "cleaned"]:
+            manifest_fname = readcounts.manifest_fname(sample, dirname)
+            if manifest_fname in available:
+                manifest_fnames[sample] = manifest_fname
+                break
+    if not manifest_fnames:
+        return None
+
+    def sample_reads(manifest_fname):
+        with contextlib.closing(
+            STORAGE.open(
+                "%s/%s/%s/%s"
+                % (
+                    S3_BUCKET,
+                    delivery,
+                    full_s3_dirname("readcounts"),
+                    manifest_fname,
+                )
+            )
+        ) as inf:
+            return sum(
+                entry["reads"]
+                for fname, entry in readcounts.load_manifest(inf).items()
+                if listing.file_role(fname) != "discarded"
+            )
+
+    with concurrent.futures.ThreadPoolExecutor(16) as pool:
+        return sum(pool.map(sample_reads, manifest_fnames.values()))
+
+
 def print_status(args):
     if args.delivery:
         deliveries = [args.delivery]
@@ -1372,7 +1985,7 @@ def print_status(args):
 
     name_width = 21
     print(" " * name_width, end="\t")
-    print(*short_stages, sep="\t")
+    print(*short_stages, "reads", sep="\t")
     for delivery in sorted(deliveries):
         print(delivery)
 
@@ -1401,7 +2014,7 @@ def print_status(args):
                 for stage in stages:
                     print("\t", end="")
                     print(n_raw if stage == "raw" else "-", end="")
-                print(COLOR_END)
+                print("\t-" + COLOR_END)
                 continue
 
             s3_delivery_dir = "%s/%s" % (S3_BUCKET, delivery)
@@ -1420,12 +2033,11 @@ def print_status(args):
                     print("n/a", end="", flush=True)
                     continue
 
-                seen = set()
-                for fname in ls_s3_dir("%s/%s/" % (
-                        s3_delivery_dir, full_s3_dirname(stage))):
-                    for sample in samples:
-                        if fname.startswith(sample):
-                            seen.add(sample)
+                seen = listing.SampleIndex(
+                    samples,
+                    ls_s3_dir("%s/%s/" % (
+                        s3_delivery_dir, full_s3_dirname(stage))),
+                ).samples()
 
                 missing = prev is not None and len(seen) < prev
                 color = COLOR_RED if missing else ""
@@ -1437,16 +2049,30 @@ def print_status(args):
                 )
                 prev = len(seen)
 
-            print()
+            print("\t", end="", flush=True)
+            reads = delivery_read_count(delivery, samples)
+            print("%.1fM" % (reads / 1e6) if reads is not None else "-")
 
 
 STAGES_ORDERED = []
 STAGE_FNS = {}
+# Stages that only run when asked for by name.  krakenpass already does the
+# work of the four kraken consumer stages, so by default they'd only check
+# that their outputs are fresh.
+OPTIONAL_STAGES = [
+    "readindex",
+    "cladecounts",
+    "humanviruses",
+    "allmatches",
+    "samplereads",
+]
 for stage_name, stage_fn in [
     ("clean", clean),
     ("ribofrac", ribofrac),
     ("nonhuman", nonhuman),
+    ("readindex", readindex),
     ("interpret", interpret),
+    ("krakenpass", krakenpass),
     ("cladecounts", cladecounts),
     ("humanviruses", humanviruses),
     ("allmatches", allmatches),
@@ -1460,6 +2086,233 @@ for stage_name, stage_fn in [
     STAGES_ORDERED.append(stage_name)
     STAGE_FNS[stage_name] = stage_fn
 
+# What one sample of each stage needs while it runs, for scheduling samples
+# concurrently with --sample-workers.  Stages that run an external tool give it
+# this many threads.  Memory is what a sample needs beyond what concurrent
+# samples share, like the kraken and bowtie2 databases in /dev/shm.  The
+# resource class is what mostly limits the stage: "network" (streaming
+# delivery data), "cpu", or "db" (a large in-memory database); see
+# --class-limits.
+StageResources = collections.namedtuple(
+    "StageResources", ["cpus", "memory_gb", "resource_class"]
+)
+DEFAULT_STAGE_RESOURCES = StageResources(
+    cpus=1, memory_gb=2, resource_class="network"
+)
+STAGE_RESOURCES = {
+    "clean": StageResources(cpus=4, memory_gb=2, resource_class="cpu"),
+    "ribofrac": StageResources(cpus=28, memory_gb=8, resource_class="cpu"),
+    "nonhuman": StageResources(cpus=4, memory_gb=4, resource_class="db"),
+    "readindex": StageResources(cpus=1, memory_gb=2, resource_class="cpu"),
+    "interpret": StageResources(cpus=4, memory_gb=4, resource_class="db"),
+    "hvreads": StageResources(cpus=1, memory_gb=8, resource_class="network"),
+    "alignments2": StageResources(cpus=4, memory_gb=2, resource_class="db"),
+}
+
+# stage -> (dirnames it reads, dirnames it writes).  A stage depends on each
+# earlier stage that writes something it reads.
+STAGE_ARTIFACTS = {
+    "clean": (["raw"], ["cleaned", "cleaned-gzi", "readcounts"]),
+    "ribofrac": (["raw", "cleaned", "readcounts"], ["ribofrac"]),
+    "nonhuman": (
+        ["raw", "cleaned"],
+        ["nonhuman", "nonhuman-gzi", "readcounts"],
+    ),
+    "readindex": (
+        ["cleaned", "cleaned-gzi", "nonhuman", "nonhuman-gzi"],
+        ["readindex", "readindex-gzi"],
+    ),
+    "interpret": (
+        ["cleaned", "nonhuman"],
+        ["processed", "processed-gzi", "krakencols", "hvmatches"],
+    ),
+    "krakenpass": (
+        ["processed", "krakencols", "hvmatches", "cladepartials"],
+        ["cladepartials"] + list(KRAKEN_CONSUMER_OUTPUTS),
+    ),
+    "cladecounts": (
+        ["processed", "krakencols", "cladepartials"],
+        ["cladepartials", "cladecounts"],
+    ),
+    "humanviruses": (
+        ["processed", "krakencols", "cladepartials", "cladecounts"],
+        ["humanviruses"],
+    ),
+    "allmatches": (["processed", "krakencols", "hvmatches"], ["allmatches"]),
+    "hvreads": (
+        ["allmatches", "processed", "hvmatches", "cleaned", "cleaned-gzi",
+         "nonhuman", "nonhuman-gzi", "readindex", "readindex-gzi"],
+        ["hvreads"],
+    ),
+    "samplereads": (
+        ["processed", "krakencols", "cladepartials"],
+        ["samplereads"],
+    ),
+    "readlengths": (
+        ["samplereads", "processed", "krakencols"],
+        ["readlengths"],
+    ),
+    "alignments2": (["hvreads"], ["alignments2", "alignments2-gzi"]),
+    "valreads": (["hvreads", "alignments2"], ["valreads"]),
+    "tmpvalreads": (["hvreads", "alignments2"], ["tmpvalreads"]),
+}
+
+
+def stage_resources(stage):
+    return STAGE_RESOURCES.get(stage, DEFAULT_STAGE_RESOURCES)
+
+
+def stage_threads(stage):
+    return stage_resources(stage).cpus
+
+
+@contextlib.contextmanager
+def tool_threads(args, stage, tool, input_fnames):
+    # Yields how many threads to run tool with for stage: what the stage
+    # declares, or with --adaptive-threads a grant from resources.py of at
+    # least that many, and more for large local input files when other tools
+    # on this machine leave cores free.
+    if not args.adaptive_threads:
+        yield stage_threads(stage)
+        return
+    input_bytes = sum(
+        os.path.getsize(fname)
+        for fname in input_fnames
+        if os.path.exists(fname)
+    )
+    with resources.thread_grant(
+        tool, input_bytes, args.cpu_budget, stage_threads(stage)
+    ) as threads:
+        yield threads
+
+
+def stage_dependencies(stages):
+    # stage -> the stages in stages (in STAGES_ORDERED order) whose output it
+    # reads.
+    dependencies = {}
+    for i, stage in enumerate(stages):
+        inputs, _ = STAGE_ARTIFACTS[stage]
+        dependencies[stage] = [
+            earlier_stage
+            for earlier_stage in stages[:i]
+            if set(STAGE_ARTIFACTS[earlier_stage][1]) & set(inputs)
+        ]
+    return dependencies
+
+
+def run_stage_for_sample(args, stage, known_added):
+    # In a worker process, with args.sample set.  known_added is what the
+    # parent knows was uploaded since we forked.  Returns (traceback or None,
+    # listing entries we added), so the parent can report failures and tell
+    # other workers about our uploads.
+    delivery_listing(args.delivery).merge(known_added)
+    # Other workers share the machine, so inflate and deflate within the
+    # cores the scheduler budgeted for this stage.
+    bgzf.set_default_threads(stage_threads(stage))
+    error = None
+    try:
+        STAGE_FNS[stage](args)
+    except Exception:
+        error = traceback.format_exc()
+    return error, LISTINGS[args.delivery].added
+
+
+def run_pipeline(args, stages):
+    # Runs stages, in order, for each sample.  Returns (stage, sample) ->
+    # traceback for the ones that failed.
+    #
+    # With --sample-workers, each (stage, sample) is a task for
+    # scheduling.Scheduler instead: a sample's stage starts as soon as its
+    # earlier stages that it depends on (see STAGE_ARTIFACTS) are done for that
+    # sample, so one slow sample doesn't hold up the rest, and ex: one
+    # sample's downloads overlap with kraken on another.  Each worker is a
+    # process with its own working directory, so tempdir() is safe to use in
+    # them.  A failure skips that sample's dependent stages and nothing else.
+    if args.sample or args.sample_workers <= 1:
+        for stage in stages:
+            STAGE_FNS[stage](args)
+        return {}
+
+    samples = get_samples(args)
+    dependencies = stage_dependencies(stages)
+    tasks = []
+    for sample in samples:
+        for stage in stages:
+            resources = stage_resources(stage)
+            tasks.append(
+                scheduling.Task(
+                    key=(stage, sample),
+                    deps=[
+                        (dependency, sample)
+                        for dependency in dependencies[stage]
+                    ],
+                    resource_class=resources.resource_class,
+                    cpus=resources.cpus,
+                    memory_gb=resources.memory_gb,
+                )
+            )
+
+    sample_args = {}
+    for sample in samples:
+        sample_args[sample] = copy.copy(args)
+        sample_args[sample].sample = sample
+        # Split per-sample process pools between concurrent samples.
+        sample_args[sample].clade_workers = max(
+            1, args.clade_workers // args.sample_workers
+        )
+        sample_args[sample].fastq_workers = max(
+            1, args.fastq_workers // args.sample_workers
+        )
+
+    if set(stages) & {"krakenpass", "cladecounts", "samplereads"}:
+        load_taxonomy()  # download and compile once, before forking
+    listing = delivery_listing(args.delivery)
+
+    def submit(pool, task):
+        stage, sample = task.key
+        print("%s: starting %s" % (stage, sample))
+        return pool.submit(
+            run_stage_for_sample,
+            sample_args[sample],
+            stage,
+            dict(listing.added),
+        )
+
+    failures = {}
+
+    def finish(task, future):
+        stage, sample = task.key
+        error, added = future.result()
+        listing.merge(added)
+        if error:
+            print("%s: %s failed:\n%s" % (stage, sample, error))
+            failures[task.key] = error
+        return not error
+
+    scheduler = scheduling.Scheduler(
+        tasks,
+        max_workers=args.sample_workers,
+        cpu_budget=args.cpu_budget,
+        memory_budget_gb=args.memory_budget_gb,
+        class_limits=scheduling.parse_class_limits(args.class_limits),
+    )
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers=args.sample_workers
+    ) as pool:
+        status = scheduler.run(pool, submit, finish)
+
+    for (stage, sample), task_status in status.items():
+        if task_status == scheduling.SKIPPED:
+            print("%s: skipped %s after an earlier failure" % (stage, sample))
+    print(
+        "%s of %s tasks succeeded"
+        % (
+            sum(1 for x in status.values() if x == scheduling.SUCCEEDED),
+            len(status),
+        )
+    )
+    return failures
+
 
 def start():
     parser = argparse.ArgumentParser(
@@ -1490,7 +2343,9 @@ def start():
 
     parser.add_argument(
         "--stages",
-        default=",".join(STAGES_ORDERED),
+        default=",".join(
+            stage for stage in STAGES_ORDERED if stage not in OPTIONAL_STAGES
+        ),
         help="Comma-separated list of stages to run.  Allowed stages: %s"
         % (", ".join(repr(x) for x in STAGES_ORDERED)),
     )
@@ -1501,17 +2356,146 @@ def start():
         help="Comma-separated list of stages not to run.",
     )
 
+    parser.add_argument(
+        "--storage-root",
+        help="Read and write delivery data under this local directory "
+        "instead of S3.  Laid out the same way as the bucket: "
+        "<root>/<delivery>/<stage-dir>/<file>.",
+    )
+
+    parser.add_argument(
+        "--listing-ttl",
+        type=int,
+        default=listing.DEFAULT_TTL,
+        help="How many seconds a delivery's cached listing under "
+        "%s stays valid for other runs.  0 disables the cache."
+        % listing.CACHE_DIR,
+    )
+
+    parser.add_argument(
+        "--bgzf-cleaned",
+        action="store_true",
+        help="When running clean, recompress AdapterRemoval's output as "
+        "block gzip with an index, so later stages can decompress it in "
+        "parallel.  See bgzf.py.",
+    )
+
+    parser.add_argument(
+        "--capture-hvreads",
+        action="store_true",
+        help="When running interpret, also capture reads with human virus "
+        "hits to hvmatches/, so allmatches and hvreads don't need to "
+        "read the kraken output or FASTQ again.",
+    )
+
+    parser.add_argument(
+        "--kraken-columns",
+        action="store_true",
+        help="When running interpret, also write a columnar copy of the "
+        "kraken output to krakencols/, which later stages read instead of "
+        "parsing text.  See krakencols.py.",
+    )
+
+    parser.add_argument(
+        "--clade-workers",
+        type=int,
+        default=os.cpu_count(),
+        help="How many of a sample's kraken output files to count clades "
+        "for in parallel.",
+    )
+
+    parser.add_argument(
+        "--fastq-workers",
+        type=int,
+        default=os.cpu_count(),
+        help="How many processes to scan FASTQ for wanted reads with.",
+    )
+
+    parser.add_argument(
+        "--hvreads-memory-mb",
+        type=int,
+        default=0,
+        help="Build hvreads on disk, holding roughly this many megabytes of "
+        "allmatches lines and reads in memory at a time.  0 to build it in "
+        "memory, which is faster when it fits.",
+    )
+
+    parser.add_argument(
+        "--bloom-false-positive-rate",
+        type=float,
+        default=0.01,
+        help="When checking many read IDs against a few wanted ones, first "
+        "screen them with a Bloom filter over the end of each ID, with this "
+        "false positive rate, so we only hash the few that pass.  0 to "
+        "disable.",
+    )
+
+    parser.add_argument(
+        "--sample-workers",
+        type=int,
+        default=1,
+        help="How many (stage, sample) tasks to run at once, within "
+        "--cpu-budget, --memory-budget-gb, and --class-limits.  Each stage "
+        "declares what one sample needs in STAGE_RESOURCES.",
+    )
+
+    parser.add_argument(
+        "--cpu-budget",
+        type=int,
+        default=os.cpu_count(),
+        help="With --sample-workers, how many cores concurrent tasks may "
+        "use in total.",
+    )
+
+    parser.add_argument(
+        "--memory-budget-gb",
+        type=float,
+        default=os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+        / (1 << 30),
+        help="With --sample-workers, how much memory concurrent tasks may "
+        "use in total.",
+    )
+
+    parser.add_argument(
+        "--adaptive-threads",
+        action="store_true",
+        help="Let external tools use more threads than their stage's count "
+        "in STAGE_RESOURCES when their input is large and other tools on "
+        "this machine leave cores free.  See resources.py.",
+    )
+
+    parser.add_argument(
+        "--class-limits",
+        default="network=8,db=1",
+        help="With --sample-workers, the most stages of each resource class "
+        "in STAGE_RESOURCES to run at once, as class=limit pairs.  Classes "
+        "not listed are only limited by the budgets.",
+    )
+
+    parser.add_argument(
+        "--max-connections",
+        type=int,
+        default=storage.DEFAULT_MAX_CONNECTIONS,
+        help="Maximum number of concurrent connections to S3.",
+    )
+
     args = parser.parse_args()
 
     global S3_BUCKET
     global WORK_ROOT
+    global STORAGE
+    global LISTING_TTL
+    S3_BUCKET = bucket_for(args.restricted, args.storage_root)
     if args.restricted:
-        S3_BUCKET = "s3://nao-restricted"
         WORK_ROOT = "../mgs-restricted/"
     else:
-        S3_BUCKET = "s3://nao-mgs"
         WORK_ROOT = "./"
 
+    STORAGE = storage.open_storage(
+        S3_BUCKET, max_connections=args.max_connections
+    )
+    LISTING_TTL = args.listing_ttl
+
     if not args.status and not args.delivery:
         parser.print_help()
         exit(1)
@@ -1537,9 +2521,19 @@ def start():
             if stage not in STAGE_FNS:
                 raise Exception("Unknown stage %r" % stage)
 
-    for stage in STAGES_ORDERED:
-        if stage in selected_stages and stage not in skipped_stages:
-            STAGE_FNS[stage](args)
+    failures = run_pipeline(
+        args,
+        [
+            stage
+            for stage in STAGES_ORDERED
+            if stage in selected_stages and stage not in skipped_stages
+        ],
+    )
+    if failures:
+        print("Failed:")
+        for stage, sample in sorted(failures):
+            print("  %s %s" % (stage, sample))
+        exit(1)
 
 
 if __name__ == "__main__":
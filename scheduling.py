@@ -0,0 +1,102 @@
+# Running a graph of tasks in a process pool, within resource budgets.
+#
+# Each task names the tasks it depends on and what it needs while running:
+# cores, memory, and a resource class.  Classes let us cap how many of one
+# kind of task run at once (ex: one kraken at a time, since they contend for
+# the database's memory) while other kinds fill the remaining capacity (ex:
+# downloads, which mostly wait on the network).
+#
+# A task starts as soon as everything it depends on has succeeded and it fits
+# in what's left of the budgets; tasks earlier in the list go first.  A task
+# too big for a budget on its own still runs, alone.  If a task fails, the
+# tasks that depend on it are skipped, and everything else carries on.
+
+import collections
+import concurrent.futures
+
+Task = collections.namedtuple(
+    "Task", ["key", "deps", "resource_class", "cpus", "memory_gb"]
+)
+
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+SKIPPED = "skipped"
+
+
+def parse_class_limits(spec):
+    # "network=8,db=1" -> {"network": 8, "db": 1}
+    limits = {}
+    for item in spec.split(","):
+        if item:
+            resource_class, limit = item.split("=")
+            limits[resource_class] = int(limit)
+    return limits
+
+
+class Scheduler:
+    def __init__(
+        self, tasks, max_workers, cpu_budget, memory_budget_gb, class_limits
+    ):
+        self.tasks = list(tasks)
+        self.max_workers = max_workers
+        self.cpu_budget = cpu_budget
+        self.memory_budget_gb = memory_budget_gb
+        self.class_limits = class_limits
+        self.status = {}  # key -> SUCCEEDED, FAILED, or SKIPPED
+        self.running = {}  # future -> task
+
+    def ready(self, task):
+        return task.key not in self.status and all(
+            self.status.get(dep) == SUCCEEDED for dep in task.deps
+        )
+
+    def blocked(self, task):
+        return any(
+            self.status.get(dep) in [FAILED, SKIPPED] for dep in task.deps
+        )
+
+    def fits(self, task):
+        if not self.running:
+            return True
+        if len(self.running) >= self.max_workers:
+            return False
+        running = self.running.values()
+        if sum(t.cpus for t in running) + task.cpus > self.cpu_budget:
+            return False
+        if (
+            sum(t.memory_gb for t in running) + task.memory_gb
+            > self.memory_budget_gb
+        ):
+            return False
+        limit = self.class_limits.get(task.resource_class)
+        return limit is None or limit > sum(
+            1 for t in running if t.resource_class == task.resource_class
+        )
+
+    def run(self, pool, submit, finish):
+        # submit(pool, task) -> future.  finish(task, future) -> whether the
+        # task succeeded.  Returns key -> status.
+        started = set()
+        while True:
+            for task in self.tasks:
+                if task.key in self.status or task.key in started:
+                    continue
+                if self.blocked(task):
+                    self.status[task.key] = SKIPPED
+                elif self.ready(task) and self.fits(task):
+                    self.running[submit(pool, task)] = task
+                    started.add(task.key)
+
+            if not self.running:
+                break
+            done, _ = concurrent.futures.wait(
+                self.running, return_when=concurrent.futures.FIRST_COMPLETED
+            )
+            for future in done:
+                task = self.running.pop(future)
+                self.status[task.key] = (
+                    SUCCEEDED if finish(task, future) else FAILED
+                )
+        for task in self.tasks:
+            self.status.setdefault(task.key, SKIPPED)
+        return self.status
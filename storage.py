@@ -0,0 +1,224 @@
+# Object storage used by run.py.
+#
+# Every stage reads and writes delivery data through one of these backends
+# instead of shelling out to the aws CLI once per file.  S3Storage keeps a
+# single thread-safe boto3 client with a pool of keep-alive connections, while
+# LocalStorage implements the same interface on top of a directory tree, which
+# lets the whole pipeline run against local data for tests and benchmarks.
+#
+# Locations are given the same way run.py has always built them: either
+# "s3://bucket/key" URLs or, for LocalStorage, plain filesystem paths.
+# Listings follow the conventions of `aws s3 ls`: names are relative to the
+# directory containing the prefix, and unless recursive=True only objects
+# directly in that directory are returned.
+
+import io
+import os
+import shutil
+import datetime
+import tempfile
+import threading
+import collections
+
+DEFAULT_MAX_CONNECTIONS = 32
+
+# name: path relative to the listed directory
+# size: bytes
+# mtime: local time as "YYYY-MM-DD HH:MM:SS", so it can be compared against
+#        date prefixes like "2023-10-12" the same way `aws s3 ls` output was.
+ObjectInfo = collections.namedtuple("ObjectInfo", ["name", "size", "mtime"])
+
+
+def format_mtime(timestamp):
+    return datetime.datetime.fromtimestamp(timestamp).strftime(
+        "%Y-%m-%d %H:%M:%S"
+    )
+
+
+def split_s3_url(url):
+    if not url.startswith("s3://"):
+        raise ValueError("Not an S3 URL: %r" % url)
+    bucket, _, key = url[len("s3://") :].partition("/")
+    return bucket, key
+
+
+class S3Storage:
+    def __init__(self, max_connections=DEFAULT_MAX_CONNECTIONS):
+        self.max_connections = max_connections
+        self._client = None
+        self._transfer_config = None
+        self._lock = threading.Lock()
+        # boto3 clients aren't safe to share across fork(), so worker processes
+        # make their own.
+        os.register_at_fork(after_in_child=self._forget_client)
+
+    def _forget_client(self):
+        self._client = None
+        self._transfer_config = None
+        self._lock = threading.Lock()
+
+    def _get_client(self):
+        with self._lock:
+            if self._client is None:
+                import boto3
+                import boto3.s3.transfer
+                import botocore.config
+
+                self._client = boto3.session.Session().client(
+                    "s3",
+                    config=botocore.config.Config(
+                        max_pool_connections=self.max_connections,
+                        tcp_keepalive=True,
+                        retries={"max_attempts": 10, "mode": "adaptive"},
+                    ),
+                )
+                self._transfer_config = boto3.s3.transfer.TransferConfig(
+                    max_concurrency=self.max_connections
+                )
+            return self._client
+
+    def list(self, url, recursive=False):
+        bucket, key = split_s3_url(url)
+        dir_key = key[: key.rfind("/") + 1]
+
+        kwargs = {"Bucket": bucket, "Prefix": key}
+        if not recursive:
+            kwargs["Delimiter"] = "/"
+
+        paginator = self._get_client().get_paginator("list_objects_v2")
+        for page in paginator.paginate(**kwargs):
+            for obj in page.get("Contents", []):
+                yield ObjectInfo(
+                    obj["Key"][len(dir_key) :],
+                    obj["Size"],
+                    format_mtime(obj["LastModified"].timestamp()),
+                )
+
+    def exists(self, url):
+        bucket, key = split_s3_url(url)
+        response = self._get_client().list_objects_v2(
+            Bucket=bucket, Prefix=key, MaxKeys=1
+        )
+        return response.get("KeyCount", 0) > 0
+
+    def download(self, url, local_fname):
+        bucket, key = split_s3_url(url)
+        client = self._get_client()
+        client.download_file(
+            bucket, key, local_fname, Config=self._transfer_config
+        )
+
+    def upload(self, local_fname, url):
+        bucket, key = split_s3_url(url)
+        client = self._get_client()
+        client.upload_file(
+            local_fname, bucket, key, Config=self._transfer_config
+        )
+
+    def open(self, url, start=None, end=None):
+        # Returns a binary file-like object streaming the object's contents,
+        # optionally limited to bytes [start, end).  Closing it early stops the
+        # transfer.
+        bucket, key = split_s3_url(url)
+        kwargs = {"Bucket": bucket, "Key": key}
+        if start is not None or end is not None:
+            kwargs["Range"] = "bytes=%s-%s" % (
+                start or 0,
+                "" if end is None else end - 1,
+            )
+        return self._get_client().get_object(**kwargs)["Body"]
+
+
+class LocalStorage:
+    def list(self, url, recursive=False):
+        dir_path = url[: url.rfind("/") + 1]
+        name_prefix = url[len(dir_path) :]
+        if not os.path.isdir(dir_path):
+            return
+
+        if recursive:
+            walk = os.walk(dir_path)
+        else:
+            walk = [next(os.walk(dir_path))]
+
+        for walk_dir, _, fnames in walk:
+            for fname in fnames:
+                if fname.startswith(".upload."):
+                    continue  # in-progress upload
+                path = os.path.join(walk_dir, fname)
+                name = os.path.relpath(path, dir_path)
+                if not name.startswith(name_prefix):
+                    continue
+                stat = os.stat(path)
+                yield ObjectInfo(
+                    name, stat.st_size, format_mtime(stat.st_mtime)
+                )
+
+    def exists(self, url):
+        for _ in self.list(url, recursive=True):
+            return True
+        return False
+
+    def download(self, url, local_fname):
+        shutil.copyfile(url, local_fname)
+
+    def upload(self, local_fname, url):
+        # Write to a temporary file and rename, so concurrent readers never see
+        # a partially written object.
+        os.makedirs(os.path.dirname(url), exist_ok=True)
+        fd, tmp_fname = tempfile.mkstemp(
+            dir=os.path.dirname(url), prefix=".upload."
+        )
+        os.close(fd)
+        try:
+            shutil.copyfile(local_fname, tmp_fname)
+            os.replace(tmp_fname, url)
+        except BaseException:
+            os.unlink(tmp_fname)
+            raise
+
+    def open(self, url, start=None, end=None):
+        f = open(url, "rb")
+        if start:
+            f.seek(start)
+        if end is None:
+            return f
+        with f:
+            return io.BytesIO(f.read(end - (start or 0)))
+
+
+class RangeReader(io.RawIOBase):
+    # Reads an object of known size as a series of ranged requests, each
+    # twice as large as the last.  A reader that only wants the start of a
+    # large object transfers at most about twice what it uses, without
+    # guessing up front how much that will be.
+    def __init__(self, backend, url, size, first_range=1 << 20):
+        self.backend = backend
+        self.url = url
+        self.size = size
+        self.next_range = first_range
+        self.offset = 0  # start of the next range to fetch
+        self.current = memoryview(b"")
+
+    def readable(self):
+        return True
+
+    def readinto(self, buf):
+        if not self.current:
+            if self.offset >= self.size:
+                return 0
+            end = min(self.offset + self.next_range, self.size)
+            with self.backend.open(self.url, self.offset, end) as inf:
+                self.current = memoryview(inf.read())
+            self.offset = end
+            self.next_range *= 2
+        n = min(len(buf), len(self.current))
+        buf[:n] = self.current[:n]
+        self.current = self.current[n:]
+        return n
+
+
+def open_storage(root, max_connections=DEFAULT_MAX_CONNECTIONS):
+    if root.startswith("s3://"):
+        return S3Storage(max_connections=max_connections)
+    return LocalStorage()
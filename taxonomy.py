@@ -0,0 +1,331 @@
+#!/usr/bin/env python3
+
+# The NCBI taxonomy, compiled into memory-mappable arrays.
+#
+# Parsing dashboard/nodes.dmp and names.dmp takes several seconds and hundreds
+# of MB per process.  Instead we compile them once into dashboard/taxonomy/, a
+# directory of .npy files indexed by taxid:
+#
+#   parent.npy            int32, parent taxid, or -1 if not a taxid
+#   rank.npy              uint8, index into "ranks" in meta.json
+#   children_offsets.npy  int64, children of taxid t are
+#   children.npy          int32,   children[children_offsets[t]:
+#                                           children_offsets[t+1]]
+#   name_offsets.npy      int64, name of taxid t is utf-8 encoded at
+#   names.npy             uint8,   names[name_offsets[t]:name_offsets[t+1]]
+#   entry.npy             int32, position of t in a depth-first traversal
+#   exit.npy              int32, last position within t's subtree
+#
+# With the traversal numbering, taxid t is within clade c exactly when
+# entry[c] <= entry[t] <= exit[c], so clade membership is two comparisons
+# instead of a walk up to the root, and is_under_mask can answer it for a
+# whole array of taxids at once.
+#
+# Every process then opens them with mmap in milliseconds, and they share
+# pages through the OS cache.  The compiled copy is rebuilt automatically if
+# the .dmp files are newer.
+#
+# Names are scientific names, or if a taxid doesn't have one its first listed
+# name.
+#
+# Usage: ./taxonomy.py  (compiles if needed; otherwise load() does it lazily)
+
+import os
+import sys
+import json
+import fcntl
+import shutil
+import tempfile
+import numpy as np
+
+THISDIR = os.path.abspath(os.path.dirname(__file__))
+DASHBOARD_DIR = os.path.join(THISDIR, "dashboard")
+COMPILED_DIRNAME = "taxonomy"
+# Bump when the set of compiled arrays changes, so old copies are rebuilt.
+COMPILED_VERSION = 2
+
+
+def parse_dmp(fname):
+    with open(fname) as inf:
+        for line in inf:
+            yield line.replace("\t|\n", "").split("\t|\t")
+
+
+def compile_taxonomy(dashboard_dir, out_dir):
+    parents = {}  # taxid -> parent taxid
+    ranks = {}  # taxid -> rank
+    for child_taxid, parent_taxid, rank, *_ in parse_dmp(
+        os.path.join(dashboard_dir, "nodes.dmp")
+    ):
+        parents[int(child_taxid)] = int(parent_taxid)
+        ranks[int(child_taxid)] = rank
+
+    names = {}  # taxid -> name
+    for taxid, name, unique_name, name_class in parse_dmp(
+        os.path.join(dashboard_dir, "names.dmp")
+    ):
+        taxid = int(taxid)
+        if taxid not in names or name_class == "scientific name":
+            names[taxid] = name
+
+    size = max(parents) + 1
+    taxids = np.array(sorted(parents), dtype=np.int32)
+
+    parent = np.full(size, -1, dtype=np.int32)
+    parent[taxids] = [parents[taxid] for taxid in taxids.tolist()]
+
+    rank_names = sorted(set(ranks.values()))
+    rank_index = {rank: i for i, rank in enumerate(rank_names)}
+    rank = np.zeros(size, dtype=np.uint8)
+    rank[taxids] = [rank_index[ranks[taxid]] for taxid in taxids.tolist()]
+
+    # The root is its own parent; don't list it as its own child.
+    non_root = taxids[parent[taxids] != taxids]
+    order = np.argsort(parent[non_root], kind="stable")
+    children = non_root[order]
+    children_offsets = np.zeros(size + 1, dtype=np.int64)
+    np.cumsum(
+        np.bincount(parent[non_root], minlength=size),
+        out=children_offsets[1:],
+    )
+
+    entry, exit = number_subtrees(parent, children_offsets, children)
+
+    encoded = [names.get(taxid, "").encode("utf-8") for taxid in range(size)]
+    name_offsets = np.zeros(size + 1, dtype=np.int64)
+    np.cumsum([len(x) for x in encoded], out=name_offsets[1:])
+    names_blob = np.frombuffer(b"".join(encoded), dtype=np.uint8)
+
+    for array_name, array in [
+        ("parent", parent),
+        ("rank", rank),
+        ("children_offsets", children_offsets),
+        ("children", children),
+        ("name_offsets", name_offsets),
+        ("names", names_blob),
+        ("entry", entry),
+        ("exit", exit),
+    ]:
+        np.save(os.path.join(out_dir, "%s.npy" % array_name), array)
+
+    with open(os.path.join(out_dir, "meta.json"), "w") as outf:
+        json.dump({"version": COMPILED_VERSION, "ranks": rank_names}, outf)
+
+
+def number_subtrees(parent, children_offsets, children):
+    # Preorder depth-first numbering from the root.  Returns (entry, exit),
+    # where taxid t's subtree occupies positions entry[t]..exit[t] inclusive.
+    # Positions that aren't taxids have entry and exit -1.
+    offsets = children_offsets.tolist()
+    children = children.tolist()
+
+    order = []  # taxids in preorder
+    to_visit = [1]
+    while to_visit:
+        taxid = to_visit.pop()
+        order.append(taxid)
+        to_visit.extend(
+            reversed(children[offsets[taxid] : offsets[taxid + 1]])
+        )
+
+    # Every taxid comes after its parent in preorder, so walking backwards
+    # visits children before parents and sums subtree sizes in one pass.
+    parents = parent.tolist()
+    sizes = [1] * len(parents)
+    for taxid in reversed(order[1:]):
+        sizes[parents[taxid]] += sizes[taxid]
+
+    order = np.array(order, dtype=np.int32)
+    entry = np.full(len(parents), -1, dtype=np.int32)
+    exit = np.full(len(parents), -1, dtype=np.int32)
+    entry[order] = np.arange(len(order), dtype=np.int32)
+    exit[order] = entry[order] + np.array(sizes, dtype=np.int32)[order] - 1
+    return entry, exit
+
+
+def is_stale(dashboard_dir):
+    compiled_dir = os.path.join(dashboard_dir, COMPILED_DIRNAME)
+    meta_fname = os.path.join(compiled_dir, "meta.json")
+    if not os.path.exists(meta_fname):
+        return True
+    with open(meta_fname) as inf:
+        if json.load(inf).get("version") != COMPILED_VERSION:
+            return True
+    compiled_mtime = os.path.getmtime(meta_fname)
+    return any(
+        os.path.getmtime(os.path.join(dashboard_dir, dmp)) > compiled_mtime
+        for dmp in ["nodes.dmp", "names.dmp"]
+    )
+
+
+def ensure_compiled(dashboard_dir=DASHBOARD_DIR):
+    if not is_stale(dashboard_dir):
+        return
+
+    # Several processes may want to compile at once (ex: reprocess.py
+    # --sample-level starting many run.py), so only one compiles and the
+    # rest wait for it and then find the copy fresh.
+    with open(os.path.join(dashboard_dir, ".taxonomy.lock"), "w") as lockf:
+        fcntl.flock(lockf, fcntl.LOCK_EX)
+        try:
+            if is_stale(dashboard_dir):
+                compile_and_swap(dashboard_dir)
+        finally:
+            fcntl.flock(lockf, fcntl.LOCK_UN)
+
+
+def compile_and_swap(dashboard_dir):
+    # Compiles into a new versioned directory and points the "taxonomy"
+    # symlink at it with a single rename, so readers always see either the
+    # old copy or the new one.  We keep the copy we replaced, since readers
+    # may have resolved the link just before the swap, and remove older
+    # ones.
+    # stderr, since count_clades.py writes its output to stdout.
+    print("Compiling taxonomy in %s..." % dashboard_dir, file=sys.stderr)
+    compiled_dir = os.path.join(dashboard_dir, COMPILED_DIRNAME)
+    version_dir = tempfile.mkdtemp(
+        dir=dashboard_dir, prefix=".%s." % COMPILED_DIRNAME
+    )
+    try:
+        compile_taxonomy(dashboard_dir, version_dir)
+    except BaseException:
+        shutil.rmtree(version_dir, ignore_errors=True)
+        raise
+
+    previous_dir = None
+    if os.path.islink(compiled_dir):
+        previous_dir = os.path.join(dashboard_dir, os.readlink(compiled_dir))
+    elif os.path.exists(compiled_dir):
+        # A plain directory from before we used a symlink.
+        previous_dir = tempfile.mkdtemp(
+            dir=dashboard_dir, prefix=".%s." % COMPILED_DIRNAME
+        )
+        os.rename(compiled_dir, os.path.join(previous_dir, "old"))
+
+    tmp_link = version_dir + ".link"
+    os.symlink(os.path.basename(version_dir), tmp_link)
+    os.replace(tmp_link, compiled_dir)
+
+    keep = {version_dir, previous_dir}
+    for fname in os.listdir(dashboard_dir):
+        path = os.path.join(dashboard_dir, fname)
+        if (
+            fname.startswith(".%s." % COMPILED_DIRNAME)
+            and os.path.isdir(path)
+            and not os.path.islink(path)
+            and path not in keep
+        ):
+            shutil.rmtree(path, ignore_errors=True)
+
+
+class Taxonomy:
+    def __init__(self, compiled_dir):
+        # Resolve the symlink once, so all the arrays come from one copy even
+        # if it's swapped while we load.
+        compiled_dir = os.path.realpath(compiled_dir)
+
+        def load_array(array_name):
+            return np.load(
+                os.path.join(compiled_dir, "%s.npy" % array_name),
+                mmap_mode="r",
+            )
+
+        self.parent_array = load_array("parent")
+        self.rank_array = load_array("rank")
+        self.children_offsets = load_array("children_offsets")
+        self.children_array = load_array("children")
+        self.name_offsets = load_array("name_offsets")
+        self.names_blob = load_array("names")
+        self.entry_array = load_array("entry")
+        self.exit_array = load_array("exit")
+        with open(os.path.join(compiled_dir, "meta.json")) as inf:
+            self.rank_names = json.load(inf)["ranks"]
+
+    def __contains__(self, taxid):
+        return (
+            0 <= taxid < len(self.parent_array)
+            and self.parent_array[taxid] != -1
+        )
+
+    def check(self, taxid):
+        if taxid not in self:
+            raise KeyError(taxid)
+
+    def parent(self, taxid):
+        self.check(taxid)
+        return int(self.parent_array[taxid])
+
+    def rank(self, taxid):
+        self.check(taxid)
+        return self.rank_names[self.rank_array[taxid]]
+
+    def name(self, taxid):
+        self.check(taxid)
+        start, end = self.name_offsets[taxid : taxid + 2]
+        return bytes(self.names_blob[start:end]).decode("utf-8")
+
+    def children(self, taxid):
+        self.check(taxid)
+        start, end = self.children_offsets[taxid : taxid + 2]
+        return self.children_array[start:end].tolist()
+
+    def ancestors(self, taxid):
+        # [taxid, parent, grandparent, ..., 1]
+        self.check(taxid)
+        lineage = [taxid]
+        while taxid != 1:
+            taxid = int(self.parent_array[taxid])
+            lineage.append(taxid)
+        return lineage
+
+    def descendants(self, taxid):
+        # Every taxid strictly within taxid's clade.
+        found = []
+        to_visit = self.children(taxid)
+        while to_visit:
+            child = to_visit.pop()
+            found.append(child)
+            to_visit.extend(self.children(child))
+        return found
+
+    def is_under(self, taxid, clade):
+        # Whether taxid is clade or anywhere within it.
+        self.check(taxid)
+        if clade not in self:
+            return False
+        return bool(
+            self.entry_array[clade]
+            <= self.entry_array[taxid]
+            <= self.exit_array[clade]
+        )
+
+    def bottom_up(self, taxids):
+        # taxids as an array, ordered so every taxid comes before all of its
+        # ancestors.  This is reverse depth-first order, so children come
+        # before parents.
+        taxids = np.fromiter(taxids, dtype=np.int64)
+        return taxids[np.argsort(-self.entry_array[taxids], kind="stable")]
+
+    def is_under_mask(self, taxids, clade):
+        # Vectorized is_under: a boolean array with, for each taxid, whether
+        # it is clade or anywhere within it.  Unlike is_under, taxids that
+        # aren't in the taxonomy (ex: 0, unclassified) are just False.
+        taxids = np.asarray(taxids)
+        if clade not in self:
+            return np.zeros(taxids.shape, dtype=bool)
+        valid = (taxids >= 0) & (taxids < len(self.entry_array))
+        entries = np.where(
+            valid, self.entry_array[np.where(valid, taxids, 0)], -1
+        )
+        return (entries >= self.entry_array[clade]) & (
+            entries <= self.exit_array[clade]
+        )
+
+
+def load(dashboard_dir=DASHBOARD_DIR):
+    ensure_compiled(dashboard_dir)
+    return Taxonomy(os.path.join(dashboard_dir, COMPILED_DIRNAME))
+
+
+if __name__ == "__main__":
+    ensure_compiled()